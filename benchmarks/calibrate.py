@@ -0,0 +1,196 @@
+"""Accuracy versus cost calibration of MCMC settings for a trained model (panel).
+
+Simulates a cohort of subjects with known copy numbers from the model's HLN_Parameters (as in test_01_random_data,
+with contiguous CNVs), evaluates every subject with every combination of the given settings (in parallel processes),
+and reports call sensitivity and specificity, posterior calibration and CPU seconds per subject for each setting,
+along with the cheapest setting whose accuracy is within a tolerance of the most accurate one:
+
+    python benchmarks/calibrate.py run model.pickle calibration --n_iterations 2000,5000,10000 --num_chains 1,4
+"""
+
+import cPickle
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+
+import numpy as np
+import pandas as pd
+from mando import command, main
+
+from cnv.MCMC.ConvergenceAnalysis import ConvergenceAnalysis
+from cnv.MCMC.IntensitiesDistribution import IntensitiesDistribution
+
+CNV_SUPPORT = np.array([1e-10, 1, 2, 3])
+NORM_COPY_NUM = 2.
+SETTING_NAMES = ('n_iterations', 'burn_in_prop', 'autocor_slice', 'num_chains')
+
+
+def first_baseline_index(targets):
+    """Returns the index of the first baseline target (the number of targets if there are none)"""
+    return next((i for i, target in enumerate(targets) if 'Baseline' in target.label), len(targets))
+
+
+def simulate_subject(hln_parameters, first_baseline_i, n_reads, cnv_prob, max_cnv_length):
+    """Returns the true copy numbers and simulated coverage counts of a subject. With probability cnv_prob a run of up
+    to max_cnv_length contiguous non-baseline targets has a copy number other than the normal copy number, drawn
+    uniformly from the support. The intensities are drawn from the model's prior."""
+    copies = NORM_COPY_NUM * np.ones(len(hln_parameters.targets))
+    if first_baseline_i > 0 and np.random.rand() < cnv_prob:
+        length = np.random.randint(1, min(max_cnv_length, first_baseline_i) + 1)
+        start = np.random.randint(first_baseline_i - length + 1)
+        copies[start:start + length] = np.random.choice(CNV_SUPPORT[CNV_SUPPORT != NORM_COPY_NUM])
+    intensities = IntensitiesDistribution(hln_parameters.mu, hln_parameters.covariance).sample()
+    p_vector = copies * np.exp(intensities)
+    return copies, np.random.multinomial(n_reads, p_vector / np.sum(p_vector)).astype(float)
+
+
+def evaluate_wrapper(job):
+    """Globally defined function run by pool processes, evaluating a simulated subject with a setting.
+    Returns the job, the copy number posteriors, the CPU seconds used and the number of iterations run."""
+    setting_i, subject_i = job
+    n_iterations, burn_in_prop, autocor_slice, num_chains = calibration_settings[setting_i]
+    hln_parameters, first_baseline_i, max_iterations, seed = calibration_model
+    # forked pool processes share the RNG state of the parent; seed each evaluation independently but reproducibly
+    np.random.seed([seed, setting_i, subject_i])
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    convergence_analysis = ConvergenceAnalysis(CNV_SUPPORT, hln_parameters, calibration_subjects[subject_i][1],
+                                               first_baseline_i, n_iterations=n_iterations,
+                                               burn_in_prop=burn_in_prop, use_single_process=True)
+    if num_chains > 1:
+        convergence_analysis.gelman_rubin_analysis(num_chains, len(hln_parameters.targets),
+                                                   max_iterations=max(max_iterations, n_iterations))
+    copy_posteriors, _ = convergence_analysis.metastability_error_analysis(
+        autocor_slice=autocor_slice, max_iterations=max(max_iterations, n_iterations))
+
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (end_usage.ru_utime + end_usage.ru_stime) - (start_usage.ru_utime + start_usage.ru_stime)
+    return job, copy_posteriors, cpu_seconds, convergence_analysis.ploidy_model.total_iterations
+
+
+def calibration_error(probs, outcomes, n_bins=10):
+    """Returns the expected calibration error of predicted probabilities of binary outcomes: the mean absolute
+    difference between the mean probability and the observed frequency in equal width probability bins, weighted by
+    the number of predictions in each bin"""
+    bins = np.minimum((probs * n_bins).astype(int), n_bins - 1)
+    error = 0.
+    for bin_i in np.unique(bins):
+        in_bin = bins == bin_i
+        error += np.sum(in_bin) * np.absolute(np.mean(probs[in_bin]) - np.mean(outcomes[in_bin]))
+    return error / len(probs)
+
+
+def accuracy_summary(true_copies, copy_posteriors, norm_cutoff):
+    """Returns call sensitivity and specificity (a call is a normal copy number posterior below norm_cutoff), the
+    proportion of targets whose most probable copy number is correct, and the Brier score and expected calibration
+    error of the copy number posteriors, over non-baseline targets of all subjects"""
+    norm_index = np.where(CNV_SUPPORT == NORM_COPY_NUM)[0][0]
+    called = copy_posteriors[:, norm_index] < norm_cutoff
+    is_cnv = true_copies != NORM_COPY_NUM
+    true_indicators = (true_copies.reshape((-1, 1)) == CNV_SUPPORT).astype(float)
+    return {'sensitivity': np.mean(called[is_cnv]) if np.any(is_cnv) else np.nan,
+            'specificity': np.mean(~called[~is_cnv]) if np.any(~is_cnv) else np.nan,
+            'map_accuracy': np.mean(CNV_SUPPORT[np.argmax(copy_posteriors, axis=1)] == true_copies),
+            'brier_score': np.mean(np.sum(np.square(copy_posteriors - true_indicators), axis=1)),
+            'calibration_error': calibration_error(copy_posteriors.flatten(), true_indicators.flatten())}
+
+
+def recommend(summary_df, tolerance):
+    """Returns the row of the cheapest setting whose sensitivity and specificity are both within tolerance of the best
+    across settings"""
+    # sensitivity (specificity) is undefined if no simulated targets have (lack) CNVs
+    sensitivity = summary_df['sensitivity'].fillna(1)
+    specificity = summary_df['specificity'].fillna(1)
+    accurate = (sensitivity >= sensitivity.max() - tolerance) & (specificity >= specificity.max() - tolerance)
+    return summary_df[accurate].sort_values('cpu_seconds').iloc[0]
+
+
+def parse_grid(values, value_type):
+    return [value_type(value) for value in str(values).split(',')]
+
+
+@command('run')
+def run(parametersFile, outputPrefix, n_iterations='2000,5000,10000', burn_in_prop='0.2,0.3', autocor_slice='10,50',
+        num_chains='1,4', n_subjects=20, reads_per_target=500, cnv_prob=0.5, max_cnv_length=5, norm_cutoff=0.5,
+        max_iterations=25000, tolerance=0.02, jobs=0, seed=0, verbose=0):
+    """Calibrate MCMC settings for a trained model on a simulated cohort, writing the metrics of each setting to
+    {outputPrefix}_calibration.tsv and the recommended setting to {outputPrefix}_recommended.json
+
+    :param parametersFile: Pickled model file, as used by evaluate-sample
+    :param outputPrefix: Output file name without extension
+    :param n_iterations: Comma separated numbers of MCMC iterations (multiples of 200, as G-R analysis splits the
+                         iterations after burn-in in half) [2000,5000,10000]
+    :param burn_in_prop: Comma separated burn-in proportions [0.2,0.3]
+    :param autocor_slice: Comma separated autocorrelation slices (0 chooses them automatically) [10,50]
+    :param num_chains: Comma separated numbers of chains for G-R analysis (1 skips G-R analysis) [1,4]
+    :param n_subjects: Number of simulated subjects [20]
+    :param reads_per_target: Mean number of reads per target in simulated subjects [500]
+    :param cnv_prob: Probability of a simulated subject having a CNV [0.5]
+    :param max_cnv_length: Maximum number of contiguous targets in a simulated CNV [5]
+    :param norm_cutoff: Posterior probability of the normal copy number below which a target is called [0.5]
+    :param max_iterations: Maximum number of iterations during convergence analysis [25000]
+    :param tolerance: Sensitivity and specificity within which a setting is as accurate as the best [0.02]
+    :param jobs: Number of parallel processes, 0 for the number of CPUs [0]
+    :param seed: Seed for the simulated cohort and the MCMC of each evaluation [0]
+    :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
+    """
+    level = logging.DEBUG if verbose == 2 else logging.INFO if verbose == 1 else logging.WARNING
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=level)
+
+    hln_parameters = cPickle.load(open(parametersFile, 'rb'))['parameters']
+    first_baseline_i = first_baseline_index(hln_parameters.targets)
+    n_reads = reads_per_target * len(hln_parameters.targets)
+    np.random.seed(seed)
+    subjects = [simulate_subject(hln_parameters, first_baseline_i, n_reads, cnv_prob, max_cnv_length)
+                for _ in xrange(n_subjects)]
+    settings = list(itertools.product(parse_grid(n_iterations, int), parse_grid(burn_in_prop, float),
+                                      parse_grid(autocor_slice, int), parse_grid(num_chains, int)))
+    logging.info('Evaluating {} simulated subjects ({} with CNVs) with {} settings'.format(
+        n_subjects, sum(np.any(copies != NORM_COPY_NUM) for copies, _ in subjects), len(settings)))
+
+    # globally scoped so pool processes can access them
+    global calibration_model, calibration_settings, calibration_subjects  # pylint: disable=global-variable-undefined
+    calibration_model = (hln_parameters, first_baseline_i, max_iterations, seed)
+    calibration_settings = settings
+    calibration_subjects = subjects
+
+    job_list = list(itertools.product(xrange(len(settings)), xrange(n_subjects)))
+    pool = multiprocessing.Pool(jobs or None)
+    results = pool.map(evaluate_wrapper, job_list, chunksize=1)
+    pool.close()
+    pool.join()
+
+    rows = []
+    for setting_i, setting in enumerate(settings):
+        setting_results = [result for result in results if result[0][0] == setting_i]
+        true_copies = np.concatenate([subjects[subject_i][0][:first_baseline_i]
+                                      for (_, subject_i), _, _, _ in setting_results])
+        copy_posteriors = np.concatenate([posteriors[:first_baseline_i] for _, posteriors, _, _ in setting_results])
+        row = dict(zip(SETTING_NAMES, setting))
+        row.update(accuracy_summary(true_copies, copy_posteriors, norm_cutoff))
+        row['cpu_seconds'] = np.mean([cpu_seconds for _, _, cpu_seconds, _ in setting_results])
+        row['iterations_run'] = np.mean([iterations for _, _, _, iterations in setting_results])
+        rows.append(row)
+    summary_df = pd.DataFrame(rows, columns=list(SETTING_NAMES) + ['sensitivity', 'specificity', 'map_accuracy',
+                                                                   'brier_score', 'calibration_error', 'cpu_seconds',
+                                                                   'iterations_run'])
+    summary_df.to_csv('{}_calibration.tsv'.format(outputPrefix), sep='\t', index=False)
+
+    recommended = recommend(summary_df, tolerance)
+    recommendation = {'panel': os.path.basename(parametersFile), 'n_subjects': n_subjects,
+                      'reads_per_target': reads_per_target, 'tolerance': tolerance,
+                      'settings': dict(zip(SETTING_NAMES, settings[recommended.name])),
+                      'metrics': dict((name, float(recommended[name])) for name in summary_df.columns
+                                      if name not in SETTING_NAMES)}
+    with open('{}_recommended.json'.format(outputPrefix), 'w') as f:
+        json.dump(recommendation, f, indent=2, sort_keys=True)
+    logging.warning('Recommended settings: {} ({} CPU seconds per subject, sensitivity {}, specificity {})'.format(
+        recommendation['settings'], recommended['cpu_seconds'], recommended['sensitivity'],
+        recommended['specificity']))
+
+
+if __name__ == '__main__':
+    main()
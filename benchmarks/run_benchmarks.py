@@ -0,0 +1,257 @@
+"""Synthetic performance benchmarks of the three pipeline stages (coverage counting, model training and sample
+evaluation), with workloads generated by SimulateData and gen_hln_samples at a preset scale.
+
+Each benchmark case is timed as a Metrics phase (wall and CPU time, peak memory and throughput), and the results are
+written as JSON that can be compared between versions (with the cnv package installed, e.g. pip install -e .):
+
+    python benchmarks/run_benchmarks.py run results_new.json --scale small
+    python benchmarks/run_benchmarks.py compare results_old.json results_new.json
+"""
+
+import cPickle
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from mando import command, main
+
+from cnv import cli
+from cnv.LogisticNormal import gen_hln_samples, hln_EM
+from cnv.MCMC.PloidyModel import PloidyModel
+from cnv.MCMC.TargetJointDistribution import TargetJointDistribution
+from cnv.Targets.Target import Target
+from cnv.Targets.TargetCollection import TargetCollection
+from cnv.coverage_matrix import CoverageMatrix, WrappedBAM
+from cnv.hln_parameters import HLN_Parameters
+from cnv.utilities import SimulateData
+from cnv.utilities.Metrics import Metrics
+
+# Workloads of each benchmark at each scale: numbers of targets, or (targets, samples) pairs for training.
+# Sampling setup inverts the covariance once (O(targets^3) time, O(targets^2) memory), so every scale samples with
+# full covariances (about 35 seconds and 1 GB to set up with 5000 targets).
+SCALES = {
+    'small': {'coverage': [10, 80], 'em': [(10, 10), (10, 100), (80, 100)], 'sampling': [10, 80],
+              'evaluate': [80]},
+    'medium': {'coverage': [80, 500], 'em': [(80, 1000), (500, 100)], 'sampling': [80, 500], 'evaluate': [80]},
+    'large': {'coverage': [500, 5000], 'em': [(80, 10000), (500, 1000), (5000, 10)], 'sampling': [500, 5000],
+              'evaluate': [500]}
+}
+# expected reads per target in simulated subjects
+READS_PER_TARGET = 500
+CNV_SUPPORT = np.array([1e-10, 1, 2, 3])
+
+# the primary measure of each benchmark for comparisons, and whether larger values are better
+PRIMARY_MEASURES = {
+    'coverage': ('reads_per_second', True),
+    'em': ('seconds_per_em_iteration', False),
+    'target_sample': ('target_updates_per_second', True),
+    'run_mcmc': ('target_updates_per_second', True),
+    'evaluate_sample': ('wall_seconds', False)
+}
+
+
+def synthetic_targets(n_targets, baseline_prop=0.2):
+    """Returns n_targets non-overlapping targets on X, the last baseline_prop of which are labeled as baselines"""
+    n_baseline = int(round(baseline_prop * n_targets))
+    return [Target('X', 10000 + 2000 * i, 10100 + 2000 * i,
+                   'Baseline{}'.format(i) if i >= n_targets - n_baseline else 'T{}'.format(i))
+            for i in xrange(n_targets)]
+
+
+def synthetic_parameters(n_targets, rank=5, seed=0):
+    """Returns HLN_Parameters for synthetic targets, with a low rank plus diagonal covariance"""
+    rng = np.random.RandomState(seed)
+    factors = rng.normal(size=(n_targets - 1, rank))
+    covariance = 0.05 * np.dot(factors, factors.T) / rank + 0.02 * np.eye(n_targets - 1)
+    mu = rng.normal(0, 1, size=(n_targets - 1, 1))
+    return HLN_Parameters(synthetic_targets(n_targets), mu, covariance)
+
+
+def simulated_counts(hln_parameters, n_samples):
+    """Returns simulated normal ploidy coverage counts of n_samples subjects"""
+    n_targets = len(hln_parameters.targets)
+    counts, _ = gen_hln_samples(n_samples, READS_PER_TARGET * n_targets, hln_parameters.mu.flatten(),
+                                hln_parameters.covariance)
+    return counts
+
+
+def benchmark_coverage(metrics, n_targets, repeats, work_dir):
+    """Time get_subject_coverage on a simulated bam (scanned repeats times)"""
+    bed_file = os.path.join(work_dir, 'targets_{}.bed'.format(n_targets))
+    with open(bed_file, 'w') as f:
+        for target in synthetic_targets(n_targets):
+            f.write('{}\t{}\t{}\t{}\n'.format(target.chrom, target.start, target.end, target.label))
+    prefix = os.path.join(work_dir, 'coverage_{}'.format(n_targets))
+    SimulateData.make_simulated_data(prefix, bed_file, num_bams=1)
+    targets = TargetCollection.load_from_txt_file(bed_file)
+
+    matrix_instance = CoverageMatrix()
+    with WrappedBAM('{}_bam_1.bam'.format(prefix)) as bamfile:
+        with metrics.phase('coverage', matrix_instance.scan_counters) as counters:
+            for _ in xrange(repeats):
+                matrix_instance.get_subject_coverage(bamfile, targets)
+            counters['targets'] = n_targets
+            counters['samples'] = 1
+            counters['repeats'] = repeats
+
+
+def benchmark_em(metrics, n_targets, n_samples, em_iterations):
+    """Time a fixed number of hln_EM iterations on simulated coverage counts"""
+    counts = simulated_counts(synthetic_parameters(n_targets), n_samples)
+    em_stats = {}
+    with metrics.phase('em') as counters:
+        hln_EM(counts, max_iterations=em_iterations, tol=0, stats=em_stats)
+        counters['targets'] = n_targets
+        counters['samples'] = n_samples
+        counters['em_iterations'] = em_stats['iterations']
+        counters['seconds_per_em_iteration'] = float(np.mean(em_stats['iteration_seconds']))
+
+
+def benchmark_sampling(metrics, n_targets, target_updates, mcmc_iterations):
+    """Time single-target updates with TargetJointDistribution.sample, and full sweeps with RunMCMC"""
+    hln_parameters = synthetic_parameters(n_targets)
+    data = simulated_counts(hln_parameters, 1)[0]
+    first_baseline_i = next(i for i, target in enumerate(hln_parameters.targets) if 'Baseline' in target.label)
+
+    with metrics.phase('sampling_setup') as counters:
+        joint_target = TargetJointDistribution(hln_parameters.mu, hln_parameters.covariance, CNV_SUPPORT, data)
+        counters['targets'] = n_targets
+
+    copies = 2. * np.ones(n_targets)
+    intensities = np.concatenate((hln_parameters.mu.flatten(), [0]))
+    target_indices = np.random.randint(n_targets, size=target_updates)
+    with metrics.phase('target_sample') as counters:
+        for target_i in target_indices:
+            copies[target_i], intensities[target_i], _ = joint_target.sample(copies, intensities, target_i,
+                                                                             target_i >= first_baseline_i)
+        counters['targets'] = n_targets
+        counters['target_updates'] = target_updates
+
+    ploidy_model = PloidyModel(CNV_SUPPORT, hln_parameters, data=data, first_baseline_i=first_baseline_i)
+    with metrics.phase('run_mcmc', ploidy_model.WorkCounters) as counters:
+        ploidy_model.RunMCMC(mcmc_iterations, log_progress=False)
+        counters['targets'] = n_targets
+
+
+def benchmark_evaluate(metrics, n_targets, mcmc_iterations, work_dir):
+    """Time evaluate-sample end to end (single chain, no G-R analysis) on a simulated subject"""
+    hln_parameters = synthetic_parameters(n_targets)
+    subject_df = pd.DataFrame(simulated_counts(hln_parameters, 1),
+                              columns=[target.label for target in hln_parameters.targets])
+    subject_df.insert(0, 'sample', 'simulated')
+    prefix = os.path.join(work_dir, 'evaluate_{}'.format(n_targets))
+    subject_df.to_csv('{}_subject.csv'.format(prefix))
+    with open('{}_parameters.pickle'.format(prefix), 'w') as f:
+        cPickle.dump({'full_targets': hln_parameters.targets, 'parameters': hln_parameters,
+                      'unwanted_filters': None}, f, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    with metrics.phase('evaluate_sample') as counters:
+        cli.evaluate_sample('{}_subject.csv'.format(prefix), '{}_parameters.pickle'.format(prefix), prefix,
+                            n_iterations=mcmc_iterations, no_gelman_rubin=True, use_single_process=True,
+                            max_iterations=mcmc_iterations)
+        counters['targets'] = n_targets
+        counters['samples'] = 1
+
+
+@command('run')
+def run(outputFile, scale='small', coverage_repeats=5, em_iterations=2, target_updates=20000, mcmc_iterations=500,
+        evaluate_iterations=1000, seed=0, verbose=0):
+    """Run the benchmarks at a preset scale and write the results as JSON
+
+    :param outputFile: Path to the JSON results file
+    :param scale: Workload preset, one of small, medium or large (see SCALES) [small]
+    :param coverage_repeats: Number of times the simulated bam of each coverage workload is scanned [5]
+    :param em_iterations: Number of EM iterations timed for each training workload [2]
+    :param target_updates: Number of single-target updates timed for each sampling workload [20000]
+    :param mcmc_iterations: Number of RunMCMC iterations timed for each sampling workload [500]
+    :param evaluate_iterations: Number of MCMC iterations of end to end evaluate-sample runs [1000]
+    :param seed: Seed for the simulated workloads and sampling [0]
+    :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
+    """
+    cli.configure_logging(verbose)
+    if scale not in SCALES:
+        raise ValueError('Unknown scale {}, must be one of {}'.format(scale, ', '.join(sorted(SCALES))))
+    np.random.seed(seed)
+    metrics = Metrics('benchmarks')
+    work_dir = tempfile.mkdtemp(prefix='cnv_benchmarks_')
+    try:
+        for n_targets in SCALES[scale]['coverage']:
+            logging.info('Benchmarking coverage with {} targets'.format(n_targets))
+            benchmark_coverage(metrics, n_targets, coverage_repeats, work_dir)
+        for n_targets, n_samples in SCALES[scale]['em']:
+            logging.info('Benchmarking EM with {} targets and {} samples'.format(n_targets, n_samples))
+            benchmark_em(metrics, n_targets, n_samples, em_iterations)
+        for n_targets in SCALES[scale]['sampling']:
+            logging.info('Benchmarking sampling with {} targets'.format(n_targets))
+            benchmark_sampling(metrics, n_targets, target_updates, mcmc_iterations)
+        for n_targets in SCALES[scale]['evaluate']:
+            logging.info('Benchmarking evaluate-sample with {} targets'.format(n_targets))
+            benchmark_evaluate(metrics, n_targets, evaluate_iterations, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    summary = metrics.summary()
+    summary.update({'scale': scale, 'seed': seed, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': sys.version.split()[0], 'numpy': np.__version__})
+    with open(outputFile, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    sys.stdout.write(format_results(summary['phases']))
+
+
+def case_key(phase):
+    """Identifies a benchmark case by its phase name and workload size"""
+    return phase['phase'], phase.get('targets'), phase.get('samples')
+
+
+def format_results(phases):
+    """Returns a table of the primary measure of each benchmark case"""
+    lines = []
+    for phase in phases:
+        if phase['phase'] in PRIMARY_MEASURES:
+            measure = PRIMARY_MEASURES[phase['phase']][0]
+            lines.append('{:<16} targets={:<6} samples={:<6} {}: {:.4g}\n'.format(
+                phase['phase'], phase.get('targets'), phase.get('samples'), measure, phase[measure]))
+    return ''.join(lines)
+
+
+@command('compare')
+def compare(baselineFile, resultsFile, threshold=0.1):
+    """Compare the primary measure of each benchmark case between two results files, exiting with status 1 if any
+    case is worse by more than threshold (as a proportion of the baseline)
+
+    :param baselineFile: JSON results of the baseline (e.g. previous) version
+    :param resultsFile: JSON results to compare with the baseline
+    :param threshold: Proportional change counted as a regression [0.1]
+    """
+    with open(baselineFile) as f:
+        baseline = json.load(f)
+    with open(resultsFile) as f:
+        results = json.load(f)
+    baseline_phases = dict((case_key(phase), phase) for phase in baseline['phases'])
+
+    regressions = 0
+    sys.stdout.write('Comparing {} (version {}) with {} (version {})\n'.format(
+        resultsFile, results['version'], baselineFile, baseline['version']))
+    for phase in results['phases']:
+        key = case_key(phase)
+        if phase['phase'] not in PRIMARY_MEASURES or key not in baseline_phases:
+            continue
+        measure, larger_is_better = PRIMARY_MEASURES[phase['phase']]
+        ratio = phase[measure] / baseline_phases[key][measure]
+        regressed = (ratio < 1 - threshold) if larger_is_better else (ratio > 1 + threshold)
+        regressions += regressed
+        sys.stdout.write('{:<16} targets={:<6} samples={:<6} {}: {:.4g} -> {:.4g} ({:.2f}x){}\n'.format(
+            key[0], key[1], key[2], measure, baseline_phases[key][measure], phase[measure], ratio,
+            ' REGRESSION' if regressed else ''))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import logging
+import multiprocessing
+import time
 import numpy as np
+import scipy.linalg
 import scipy.optimize
 
 # note that the log-likelihood here is negative since we want to maximize it
@@ -24,14 +27,20 @@ def _grad_vcond(z, n, edf, mu, inv_cov):
     grad = -(n * (edf - pz) - np.dot(inv_cov,(z - mu)))
     return grad.flatten()
 
+def _inverse_covariance(cov):
+    """Inverse of a covariance matrix from its Cholesky factorization, computed once per E-step and shared by all
+    subjects"""
+    return scipy.linalg.cho_solve(scipy.linalg.cho_factor(cov), np.eye(len(cov)))
+
 # based on matlab code from https://www.mathworks.com/matlabcentral/fileexchange/11275-hlnfit
-def _conditional_mode(y, mu, cov, EMiter, initialz):
+def _conditional_mode(y, mu, cov, EMiter, initialz, inv_cov=None):
     """Calculates the conditional mode of z given data for a single individual and current estimates
     of mu and cov
     y -- kx1 array of read counts in each exon for single individual (histogram of multinomial draws)
     mu -- currrent estimate of mu, k-1 x 1 array
     cov -- current estimate of cov, k-1 x k-1 array
     initialz -- initial estimate for z, k-1 x 1 array
+    inv_cov -- inverse of cov if already computed, k-1 x k-1 array
 
     Some important intermediate computations:
     pz -- the logistically normalized probabilities -- computed by exponentiating z and normalizing by sum
@@ -40,6 +49,7 @@ def _conditional_mode(y, mu, cov, EMiter, initialz):
     mu_hat -- conditional mode of z, k-1 x 1 array
     cov_hat -- inverse of the negative hessian calculated using conditional mode mu_hat, k-1 x k-1 array
     loglike -- log-likelihood of z and data after convergence, float
+    logdet_neg_hess -- log determinant of the negative hessian, float
     """
     max_iterations = 25
     tol = 1e-9
@@ -50,9 +60,11 @@ def _conditional_mode(y, mu, cov, EMiter, initialz):
     n = np.sum(y)
     # get empirical distribution function (y vector normalized by sum)
     edf = (y / float(n))[:-1].reshape(-1, 1) # must be column vector
-    inv_cov = np.linalg.inv(cov)
+    if inv_cov is None:
+        inv_cov = _inverse_covariance(cov)
     grad = np.zeros((k-1, 1))
     neg_hess = np.zeros((k-1, k-1))
+    neg_hess_factor = None
 
     change = tol+1
     iters = 0
@@ -76,7 +88,14 @@ def _conditional_mode(y, mu, cov, EMiter, initialz):
         grad = n * (edf - pz) - np.dot(inv_cov, (z - mu))
         # negative hessian (second derivative)
         neg_hess = inv_cov + n * (np.diag(pz.flatten())) - n * (np.dot(pz, pz.T)) # note outer product here
-        z = z + np.dot(np.linalg.inv(neg_hess), grad)
+        # the negative hessian is symmetric positive definite, so solve with its Cholesky factorization rather than
+        # inverting it (the factorization is reused for cov_hat after convergence)
+        try:
+            neg_hess_factor = scipy.linalg.cho_factor(neg_hess, check_finite=False)
+            z = z + scipy.linalg.cho_solve(neg_hess_factor, grad, check_finite=False)
+        except np.linalg.LinAlgError:
+            neg_hess_factor = None
+            z = z + np.linalg.solve(neg_hess, grad)
 
         change = np.amax(np.absolute(z - oldz))
         iters += 1
@@ -94,51 +113,430 @@ def _conditional_mode(y, mu, cov, EMiter, initialz):
             iters = max_iterations
 
     mu_hat = z
-    cov_hat = np.linalg.inv(neg_hess)
+    if neg_hess_factor is not None:
+        cov_hat = scipy.linalg.cho_solve(neg_hess_factor, np.eye(k-1), check_finite=False)
+        logdet_neg_hess = 2 * np.sum(np.log(np.diagonal(neg_hess_factor[0])))
+    else:
+        cov_hat = np.linalg.inv(neg_hess)
+        logdet_neg_hess = np.linalg.slogdet(neg_hess)[1]
     # conditional log likelihood
     loglike = (n * np.dot(z.flatten(), edf.flatten()) - n * np.log(1 + np.sum(np.exp(z))) -
                0.5 *np.dot(np.dot((z - mu).T, inv_cov), (z - mu)))
 
-    return mu_hat, cov_hat, loglike
+    return mu_hat, cov_hat, loglike, logdet_neg_hess
+
+def _batched_neg_hess(pz, n, inv_cov):
+    """Negative hessians of the conditional log-likelihoods of a batch of subjects, a x k-1 x k-1 array
+    pz -- logistically normalized probabilities of each subject, a x k-1 array
+    n -- total reads of each subject, array of len a
+    """
+    neg_hess = (-n.reshape((-1, 1, 1)) * pz[:, :, np.newaxis]) * pz[:, np.newaxis, :]
+    diagonal = np.arange(pz.shape[1])
+    neg_hess[:, diagonal, diagonal] += n.reshape((-1, 1)) * pz
+    neg_hess += inv_cov
+    return neg_hess
+
+def _batched_newton_steps(neg_hess, grad):
+    """Newton steps of a batch of subjects, solving the stacked negative hessians in a single (LU) call, which only
+    copies one hessian at a time"""
+    return np.linalg.solve(neg_hess, grad[:, :, np.newaxis])[:, :, 0]
+
+def _batched_pz(z):
+    """Logistically normalized probabilities (without the final dimension, z_k = 0) of each row of z"""
+    max_z = np.amax(z, axis=1).reshape((-1, 1))
+    pz = np.exp(z - max_z)
+    return pz / (np.exp(-max_z) + np.sum(pz, axis=1).reshape((-1, 1)))
+
+def _batched_loglikes(z, n, edf, mu_row, inv_cov):
+    """Conditional log-likelihoods of each row of z, computed stably for large intensities"""
+    max_z = np.maximum(np.amax(z, axis=1), 0)
+    log_norm = max_z + np.log(np.exp(-max_z) + np.sum(np.exp(z - max_z.reshape((-1, 1))), axis=1))
+    centered = z - mu_row
+    return n * np.sum(z * edf, axis=1) - n * log_norm - 0.5 * np.sum(np.dot(centered, inv_cov) * centered, axis=1)
+
+def _batched_conditional_modes(Y, mu, cov, EMiter, initial_mu_hat, inv_cov):
+    """Calculates the conditional modes of z for a batch of subjects (rows of Y) together, advancing Newton-Raphson
+    iterations of all subjects that have not yet converged with stacked array operations. In place of the coarse
+    conjugate gradient optimization of _conditional_mode, steps are halved until they don't decrease the (concave)
+    conditional log-likelihood, so starting far from the mode is safe. Subjects that do not converge within
+    max_iterations are restarted around their initial values as in _conditional_mode, and any still not converged
+    after the maximum number of restarts fall back to _conditional_mode.
+
+    Memory peaks at the end, when the stacked hessians and their stacked inverses are both held, at twice
+    8 x (k-1)^2 x number of subjects bytes, so batches should be sized by the caller.
+
+    Returns
+    mu_hat -- conditional modes, k-1 x m array
+    cov_hat_sum -- sum over subjects of the inverse negative hessians at the modes, k-1 x k-1 array
+    loglikes -- log-likelihood of each subject's mode and data, array of len m
+    logdet_neg_hess -- log determinant of each subject's negative hessian at its mode, array of len m
+    """
+    max_iterations = 25
+    tol = 1e-9
+    max_tries = max(EMiter * 5, 20)
+    m, k = Y.shape
+    n = np.sum(Y, axis=1)
+    edf = Y[:, :-1] / n.reshape((-1, 1))
+    mu_row = mu.reshape((1, -1))
+    initial_z = initial_mu_hat.T
+    z = np.copy(initial_z)
+
+    max_halvings = 30
+    iters = np.zeros(m, dtype=int)
+    tries = np.zeros(m, dtype=int)
+    active = np.arange(m)
+    fallback = []
+    while len(active) > 0:
+        z_active = z[active]
+        n_active = n[active]
+        pz = _batched_pz(z_active)
+        grad = n_active.reshape((-1, 1)) * (edf[active] - pz) - np.dot(z_active - mu_row, inv_cov)
+        step = _batched_newton_steps(_batched_neg_hess(pz, n_active, inv_cov), grad)
+
+        # halve the steps of subjects whose log-likelihood would decrease
+        loglikes = _batched_loglikes(z_active, n_active, edf[active], mu_row, inv_cov)
+        step_size = np.ones(len(active))
+        decreasing = np.arange(len(active))
+        for _ in xrange(max_halvings):
+            new_loglikes = _batched_loglikes(z_active[decreasing] + step_size[decreasing].reshape((-1, 1)) *
+                                             step[decreasing], n_active[decreasing], edf[active[decreasing]],
+                                             mu_row, inv_cov)
+            decreasing = decreasing[~(new_loglikes >= loglikes[decreasing] - 1e-12 * np.absolute(loglikes[decreasing]))]
+            if len(decreasing) == 0:
+                break
+            step_size[decreasing] /= 2
+        z[active] = z_active + step_size.reshape((-1, 1)) * step
+        iters[active] += 1
+
+        # converged when the full Newton step is within tolerance
+        converged = np.amax(np.absolute(step), axis=1) <= tol
+        # try reinitializing with different values if stuck (or diverged)
+        stuck = ~converged & ((iters[active] >= max_iterations) | ~np.all(np.isfinite(z[active]), axis=1))
+        if np.any(stuck):
+            restart = active[stuck]
+            z[restart] = initial_z[restart] + 2 * (np.random.rand(len(restart), k - 1) - 0.5)
+            iters[restart] = 0
+            tries[restart] += 1
+            given_up = tries[active] > max_tries
+            fallback.extend(active[given_up])
+            converged |= given_up
+        active = active[~converged]
+
+    for i in fallback:
+        logging.warning('Giving up on batched Newton Raphson for subject {}, optimizing individually'.format(i))
+        z[i] = _conditional_mode(Y[i], mu, cov, EMiter, initial_mu_hat[:, i], inv_cov)[0].flatten()
+
+    # the stacked inverses take as much memory again as the stacked hessians (see batch sizes in _conditional_modes)
+    neg_hess = _batched_neg_hess(_batched_pz(z), n, inv_cov)
+    cov_hat_sum = np.sum(np.linalg.inv(neg_hess), axis=0)
+    logdet_neg_hess = np.linalg.slogdet(neg_hess)[1]
+
+    return z.T, cov_hat_sum, _batched_loglikes(z, n, edf, mu_row, inv_cov), logdet_neg_hess
+
+def _conditional_modes(Y, mu, cov, EMiter, initial_mu_hat, e_step='batched', batch_bytes=2 ** 28):
+    """E-step for a set of subjects: calculates the conditional mode of z for each subject (row of Y), either one
+    subject at a time with _conditional_mode (e_step 'single'), or for batches of subjects together with
+    _batched_conditional_modes (e_step 'batched'), sized so their peak memory (stacked hessians and their stacked
+    inverses) is up to about batch_bytes.
+
+    The inverse of cov is computed once and shared by all subjects, and the inverse negative hessians are summed as
+    they are computed, so memory beyond Y and the modes is O(k^2) (plus batch_bytes for batches).
+
+    Returns
+    mu_hat -- conditional modes, k-1 x m array
+    cov_hat_sum -- sum over subjects of the inverse negative hessians at the modes, k-1 x k-1 array
+    loglikes -- Laplace approximation of the marginal log-likelihood of each subject's data given mu and cov (up to
+                constants that don't depend on them), from its mode and negative hessian, array of len m
+    """
+    m = Y.shape[0]
+    mu_hat = np.zeros(initial_mu_hat.shape)
+    cov_hat_sum = np.zeros(cov.shape)
+    loglikes = np.zeros(m)
+    logdet_neg_hess = np.zeros(m)
+    inv_cov = _inverse_covariance(cov)
+    if e_step == 'batched':
+        batch_size = max(1, batch_bytes // (2 * 8 * cov.size))
+        for start in range(0, m, batch_size):
+            batch = slice(start, start + batch_size)
+            mu_hat[:, batch], batch_cov_hat_sum, loglikes[batch], logdet_neg_hess[batch] = _batched_conditional_modes(
+                Y[batch], mu, cov, EMiter, initial_mu_hat[:, batch], inv_cov)
+            cov_hat_sum += batch_cov_hat_sum
+    else:
+        for i in range(m):
+            mu_hat[:, i:i+1], cov_hat, loglikes[i], logdet_neg_hess[i] = _conditional_mode(
+                Y[i, :], mu, cov, EMiter, initial_mu_hat[:, i], inv_cov)
+            cov_hat_sum += cov_hat
+
+    return mu_hat, cov_hat_sum, loglikes - 0.5 * np.linalg.slogdet(cov)[1] - 0.5 * logdet_neg_hess
+
+# coverage matrix of an E-step pool process, set once when the process starts
+_e_step_Y = None
+
+def _init_e_step_process(Y):
+    """Pool process initializer, keeping the coverage matrix so it isn't sent with every E-step"""
+    global _e_step_Y  # pylint: disable=global-statement
+    _e_step_Y = Y
+
+def _conditional_modes_wrapper(args):
+    """Globally defined function that can be run by pool processes, running the E-step for a chunk (slice) of the
+    subjects of the coverage matrix given to _init_e_step_process"""
+    chunk, mu, cov, EMiter, initial_mu_hat, e_step = args
+    # reseed so random restarts differ between processes
+    np.random.seed()
+    return _conditional_modes(_e_step_Y[chunk], mu, cov, EMiter, initial_mu_hat, e_step)
+
+def _em_iteration(Y, mu, cov, EMiter, mu_hat, e_step, fit_diag_only, pool, chunks, iteration_seconds):
+    """One EM iteration from mu and cov, starting the conditional modes from mu_hat and appending its wall time to
+    iteration_seconds. Returns the updated mu and cov, the conditional modes at mu and cov, and the (Laplace
+    approximate) log-likelihood of the data given mu and cov."""
+    start_time = time.time()
+    m = Y.shape[0]
+    # conditional modes of all subjects, in chunks across processes if there is a pool
+    if pool is None:
+        mu_hat, cov_hat_sum, per_sub_loglikes = _conditional_modes(Y, mu, cov, EMiter, mu_hat, e_step)
+    else:
+        results = pool.map(_conditional_modes_wrapper,
+                           [(chunk, mu, cov, EMiter, mu_hat[:, chunk], e_step) for chunk in chunks])
+        mu_hat = np.concatenate([result[0] for result in results], axis=1)
+        cov_hat_sum = np.sum([result[1] for result in results], axis=0)
+        per_sub_loglikes = np.concatenate([result[2] for result in results])
+
+    # update based on maximization with multivariate normal approximation
+    new_mu = (1. / m) * np.sum(mu_hat, axis=1).reshape((-1, 1))
+    c_mu_hat = mu_hat - np.tile(new_mu, [1, m])
+    new_cov = (1. / m) * (np.dot(c_mu_hat, c_mu_hat.T) + cov_hat_sum)
+    if fit_diag_only:
+        new_cov = np.diag(np.diagonal(new_cov))
 
-def hln_EM(Y, max_iterations=25, tol=1e-6, fit_diag_only=False):
-    """Returns estimates for mu and cov after EM on subject data.
+    iteration_seconds.append(time.time() - start_time)
+    return new_mu, new_cov, mu_hat, np.sum(per_sub_loglikes)
+
+def _squarem_extrapolation(mu, cov, mu1, cov1, mu2, cov2):
+    """Returns mu and cov extrapolated from two EM iterations (mu, cov -> mu1, cov1 -> mu2, cov2) with the SQUAREM
+    (S3) step length, computed on mu and the upper triangle of cov. A step length of -1 returns mu2, cov2."""
+    upper = np.triu_indices(len(cov))
+    r = np.concatenate(((mu1 - mu).flatten(), (cov1 - cov)[upper]))
+    v = np.concatenate(((mu2 - mu1).flatten(), (cov2 - cov1)[upper])) - r
+    alpha = min(-np.sqrt(np.dot(r, r) / np.dot(v, v)), -1.) if np.dot(v, v) > 0 else -1.
+    extrapolate = lambda x, x1, x2: x - 2 * alpha * (x1 - x) + alpha ** 2 * (x2 - 2 * x1 + x)
+    return extrapolate(mu, mu1, mu2), extrapolate(cov, cov1, cov2)
+
+def _is_positive_definite(cov):
+    try:
+        np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        return False
+    return True
+
+def hln_EM(Y, max_iterations=25, tol=1e-6, fit_diag_only=False, stats=None, jobs=1, e_step='batched',
+           initial_mu=None, initial_cov=None, initial_mu_hat=None, return_modes=False, accelerate=False):
+    """Returns estimates for mu and cov after EM on subject data (and the conditional modes of each subject if
+    return_modes).
     Y -- N x k matrix where k is the number of exons and N is the number of subjects
+    max_iterations -- maximum number of EM iterations (passes over all subjects)
+    stats -- optional dict, filled with the number of iterations run, the wall time of each iteration (in seconds),
+             the final change in parameters, and if accelerated the numbers of extrapolations tried and rejected and of
+             EM iterations saved (two per accepted extrapolation)
+    jobs -- number of processes to distribute the E-step across, each given Y once when started, and the current mu,
+            cov and conditional modes of its chunk of subjects once per iteration (1 runs it in this process)
+    e_step -- 'batched' to compute conditional modes of batches of subjects together with stacked Newton-Raphson
+              iterations, or 'single' to compute them one subject at a time (conjugate gradient then Newton-Raphson)
+    initial_mu, initial_cov -- optional starting estimates (e.g. from a model trained on overlapping subjects), instead
+                               of 0 and the identity
+    initial_mu_hat -- optional starting conditional modes of each subject, k-1 x N array with NaN columns for subjects
+                      without one, which start at mu
+    accelerate -- accelerate convergence with SQUAREM: every two EM iterations are extrapolated and followed by a
+                  stabilizing EM iteration, falling back to the second EM iteration's estimates if the extrapolated
+                  covariance isn't positive definite or the extrapolated estimates have a lower log-likelihood than
+                  those the two iterations started from
     """
+    if e_step not in ('batched', 'single'):
+        raise ValueError('Unknown E-step {}, must be batched or single'.format(e_step))
     m = Y.shape[0]
     k = Y.shape[1]
-    mu = np.zeros((k-1, 1))
-    cov = np.eye(k-1)
-    cov_hat = np.zeros((k-1, k-1, m))
-    per_sub_loglikes = np.zeros((m, 1))
+    mu = np.zeros((k-1, 1)) if initial_mu is None else np.array(initial_mu, dtype=float).reshape((k-1, 1))
+    cov = np.eye(k-1) if initial_cov is None else np.array(initial_cov, dtype=float)
 
     change = tol+1
     iters = 0
     mu_hat = np.tile(mu, [1, m])
+    if initial_mu_hat is not None:
+        has_mode = ~np.any(np.isnan(initial_mu_hat), axis=0)
+        mu_hat[:, has_mode] = initial_mu_hat[:, has_mode]
 
-    while iters < max_iterations and change > tol:
-        oldmu = mu
-        oldcov = cov
+    chunks = [slice(chunk[0], chunk[-1] + 1) for chunk in np.array_split(np.arange(m), min(jobs, m)) if len(chunk) > 0]
+    pool = multiprocessing.Pool(len(chunks), _init_e_step_process, (Y,)) if len(chunks) > 1 else None
+    em_args = (e_step, fit_diag_only, pool, chunks)
 
-        # for each subject
-        for i in range(m):
-            mu_hat[:, i:i+1], cov_hat[:, :, i], per_sub_loglikes[i]=_conditional_mode(Y[i, :], mu, cov,
-                                                                                      iters, mu_hat[:, i])
+    iteration_seconds = []
+    extrapolations = 0
+    rejected_extrapolations = 0
+    try:
+        while iters < max_iterations and change > tol:
+            oldmu = mu
+            oldcov = cov
 
-        # update based on maximization with multivariate normal approximation
-        mu = (1. / m) * np.sum(mu_hat, axis=1).reshape((-1, 1))
-        c_mu_hat = mu_hat - np.tile(mu, [1, m])
-        cov = (1. / m) * (np.dot(c_mu_hat, c_mu_hat.T) + np.sum(cov_hat, axis=2))
-        if fit_diag_only:
-            cov = np.diag(np.diagonal(cov))
+            mu1, cov1, mu_hat, loglike = _em_iteration(Y, mu, cov, iters, mu_hat, *em_args,
+                                                       iteration_seconds=iteration_seconds)
+            iters += 1
+            if accelerate and iters < max_iterations:
+                mu2, cov2, mu_hat, _ = _em_iteration(Y, mu1, cov1, iters, mu_hat, *em_args,
+                                                     iteration_seconds=iteration_seconds)
+                iters += 1
+                extrapolated_mu, extrapolated_cov = _squarem_extrapolation(mu, cov, mu1, cov1, mu2, cov2)
+                extrapolations += 1
+                accepted = False
+                if iters < max_iterations and _is_positive_definite(extrapolated_cov):
+                    # the stabilizing iteration also gives the log-likelihood of the extrapolated estimates
+                    new_mu, new_cov, new_mu_hat, extrapolated_loglike = _em_iteration(
+                        Y, extrapolated_mu, extrapolated_cov, iters, mu_hat, *em_args,
+                        iteration_seconds=iteration_seconds)
+                    iters += 1
+                    # modes are only found to within Newton-Raphson's tolerance, so allow for rounding near convergence
+                    accepted = extrapolated_loglike >= loglike - 1e-10 * np.absolute(loglike)
+                if accepted:
+                    mu, cov, mu_hat = new_mu, new_cov, new_mu_hat
+                else:
+                    rejected_extrapolations += 1
+                    mu, cov = mu2, cov2
+            else:
+                mu, cov = mu1, cov1
 
-        change = np.amax([np.amax(np.absolute(mu - oldmu)), np.amax(np.absolute(cov - oldcov))])
-        iters += 1
-        logging.debug('iteration: {}, change: {}'.format(iters, change))
+            change = np.amax([np.amax(np.absolute(mu - oldmu)), np.amax(np.absolute(cov - oldcov))])
+            logging.debug('iteration: {}, change: {}, mean subject log-likelihood: {}'.format(
+                iters, change, loglike / m))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # each accepted extrapolation stands in for (at least) the two EM iterations it extrapolates beyond
+    iterations_saved = 2 * (extrapolations - rejected_extrapolations)
+    if accelerate:
+        logging.info('EM ran {} iterations, accepting {} of {} SQUAREM extrapolations (saving {} iterations)'.format(
+            iters, extrapolations - rejected_extrapolations, extrapolations, iterations_saved))
+    if stats is not None:
+        stats['iterations'] = iters
+        stats['iteration_seconds'] = iteration_seconds
+        stats['final_change'] = float(change)
+        if accelerate:
+            stats['extrapolations'] = extrapolations
+            stats['rejected_extrapolations'] = rejected_extrapolations
+            stats['iterations_saved'] = iterations_saved
 
+    if return_modes:
+        return mu, cov, mu_hat
     return mu, cov
 
 
+def _sample_heldout(read_chunks, n_heldout, random_state):
+    """Reservoir samples n_heldout subjects uniformly from a pass over the chunks of a coverage matrix, returning their
+    row indices (in order) and their coverage as a n_heldout x k array"""
+    rows = []
+    heldout = []
+    m = 0
+    for chunk in read_chunks():
+        for y in chunk:
+            if m < n_heldout:
+                rows.append(m)
+                heldout.append(y)
+            else:
+                replace_i = random_state.randint(m + 1)
+                if replace_i < n_heldout:
+                    rows[replace_i] = m
+                    heldout[replace_i] = y
+            m += 1
+    if m <= n_heldout:
+        raise ValueError('Need more than {} subjects to hold out {}'.format(m, n_heldout))
+    order = np.argsort(rows)
+    return np.array(rows)[order], np.array(heldout)[order], m
+
+def hln_minibatch_EM(read_chunks, n_heldout=100, max_passes=20, tol=1e-6, fit_diag_only=False, stats=None,
+                     e_step='batched', initial_mu=None, initial_cov=None, step_decay=0.6, seed=0):
+    """Returns estimates for mu and cov after streaming (stepwise) mini-batch EM, for coverage matrices too large to
+    hold in memory: memory is bounded by the chunk size and the held-out subjects, and time per pass is linear in the
+    number of subjects.
+
+    Each chunk of subjects is a mini-batch. Its conditional modes are computed from the current mu (no per-subject state
+    is kept between passes), and the running sufficient statistics (mean mode and second moment, including the inverse
+    negative hessians) are moved towards the chunk's by a step size of update ** -step_decay before mu and cov are
+    updated from them. After each pass, training stops when the mean Laplace approximate log-likelihood of the held-out
+    subjects improves by less than tol (relative), returning the parameters with the best held-out log-likelihood.
+
+    read_chunks -- callable returning an iterable over chunks of the coverage matrix (each a N_c x k array, in the same
+                   order each time), called once to sample held-out subjects and once per pass
+    n_heldout -- number of subjects, sampled uniformly and left out of training, to monitor convergence on
+    stats -- optional dict, filled with the number of passes run, the wall time of each pass (in seconds), the
+             held-out log-likelihood after each pass, and the numbers of training subjects and updates
+    step_decay -- in (0.5, 1], larger values average over more mini-batches
+    """
+    if e_step not in ('batched', 'single'):
+        raise ValueError('Unknown E-step {}, must be batched or single'.format(e_step))
+    if n_heldout < 1:
+        raise ValueError('At least one held-out subject is needed to monitor convergence')
+    random_state = np.random.RandomState(seed)
+    heldout_rows, Y_heldout, m = _sample_heldout(read_chunks, n_heldout, random_state)
+    k = Y_heldout.shape[1]
+    mu = np.zeros((k-1, 1)) if initial_mu is None else np.array(initial_mu, dtype=float).reshape((k-1, 1))
+    cov = np.eye(k-1) if initial_cov is None else np.array(initial_cov, dtype=float)
+    heldout_mu_hat = np.tile(mu, [1, n_heldout])
+
+    best = (-np.inf, mu, cov)
+    heldout_loglikes = []
+    pass_seconds = []
+    updates = 0
+    passes = 0
+    while passes < max_passes:
+        start_time = time.time()
+        row = 0
+        for chunk in read_chunks():
+            # leave out held-out subjects
+            training = ~np.in1d(np.arange(row, row + len(chunk)), heldout_rows)
+            row += len(chunk)
+            Y = np.asarray(chunk, dtype=float)[training]
+            if len(Y) == 0:
+                continue
+
+            mu_hat, cov_hat_sum, _ = _conditional_modes(Y, mu, cov, passes, np.tile(mu, [1, len(Y)]), e_step)
+            batch_mean = np.mean(mu_hat, axis=1).reshape((-1, 1))
+            batch_second_moment = (np.dot(mu_hat, mu_hat.T) + cov_hat_sum) / len(Y)
+
+            # stepwise update of the sufficient statistics (the first mini-batch replaces the initial values)
+            updates += 1
+            step = updates ** -step_decay
+            if updates == 1:
+                mean, second_moment = batch_mean, batch_second_moment
+            else:
+                mean = (1 - step) * mean + step * batch_mean
+                second_moment = (1 - step) * second_moment + step * batch_second_moment
+            mu = mean
+            cov = second_moment - np.dot(mean, mean.T)
+            if fit_diag_only:
+                cov = np.diag(np.diagonal(cov))
+
+        heldout_mu_hat, _, loglikes = _conditional_modes(Y_heldout, mu, cov, passes, heldout_mu_hat, e_step)
+        heldout_loglikes.append(float(np.mean(loglikes)))
+        passes += 1
+        pass_seconds.append(time.time() - start_time)
+        logging.debug('pass: {}, updates: {}, held-out log-likelihood: {}'.format(passes, updates,
+                                                                                   heldout_loglikes[-1]))
+
+        improvement = heldout_loglikes[-1] - best[0]
+        if heldout_loglikes[-1] > best[0]:
+            best = (heldout_loglikes[-1], mu, cov)
+        if improvement < tol * np.absolute(heldout_loglikes[-1]):
+            break
+
+    if stats is not None:
+        stats['iterations'] = passes
+        stats['iteration_seconds'] = pass_seconds
+        stats['heldout_loglikes'] = heldout_loglikes
+        stats['training_subjects'] = m - n_heldout
+        stats['updates'] = updates
+
+    return best[1], best[2]
+
+
 def gen_hln_samples(numdocs, numdraws, mu, cov):
     """Generate probability vectors for multinomial distributions from hierarchical logistic normal model
     Not part of the training flow, but useful for testing and experimentation."""
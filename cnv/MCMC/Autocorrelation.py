@@ -0,0 +1,57 @@
+"""Autocorrelation and effective sample size estimates for MCMC traces, computed with FFTs"""
+
+import numpy as np
+
+
+def autocorrelation(traces):
+    """Returns the normalized autocorrelation function of each trace (column) in traces, computed with a zero-padded FFT.
+    Traces with zero variance are treated as uncorrelated (autocorrelation of 1 at lag 0 and 0 elsewhere).
+
+    traces -- n_iterations x n_traces array (or single trace of length n_iterations)
+    """
+    traces = np.asarray(traces, dtype=float)
+    if traces.ndim == 1:
+        traces = traces.reshape((-1, 1))
+    n = traces.shape[0]
+
+    # pad to a power of two at least twice the trace length to avoid circular correlation
+    n_fft = 2 ** int(np.ceil(np.log2(2 * n)))
+    centered = traces - np.mean(traces, axis=0)
+    transformed = np.fft.rfft(centered, n=n_fft, axis=0)
+    autocovariance = np.fft.irfft(transformed * np.conjugate(transformed), n=n_fft, axis=0)[:n]
+
+    acf = np.zeros(autocovariance.shape)
+    acf[0] = 1.
+    variance = autocovariance[0]
+    nonconstant = variance > 0
+    acf[:, nonconstant] = autocovariance[:, nonconstant] / variance[nonconstant]
+    return acf
+
+
+def integrated_autocorrelation_time(traces, window_coef=5.):
+    """Returns the integrated autocorrelation time of each trace (column) in traces, using the automatic windowing
+    procedure of Sokal (the smallest window M such that M >= window_coef * tau(M)). Values are bounded below by 1.
+
+    traces -- n_iterations x n_traces array (or single trace of length n_iterations)
+    window_coef -- Coefficient for automatic window selection, values of 4-10 are generally used
+    """
+    acf = autocorrelation(traces)
+    n = acf.shape[0]
+
+    # tau(M) = 1 + 2 * sum_{t=1}^{M} acf[t]
+    taus = 2 * np.cumsum(acf, axis=0) - 1
+    in_window = np.arange(n).reshape((-1, 1)) >= window_coef * taus
+    window = np.where(np.any(in_window, axis=0), np.argmax(in_window, axis=0), n - 1)
+    tau = taus[window, np.arange(acf.shape[1])]
+
+    return np.maximum(tau, 1.)
+
+
+def effective_sample_size(traces, window_coef=5.):
+    """Returns the effective sample size of each trace (column) in traces (n_iterations / integrated autocorrelation time)
+
+    traces -- n_iterations x n_traces array (or single trace of length n_iterations)
+    window_coef -- Coefficient for automatic window selection, as in integrated_autocorrelation_time
+    """
+    traces = np.asarray(traces, dtype=float)
+    return traces.shape[0] / integrated_autocorrelation_time(traces, window_coef)
@@ -18,10 +18,17 @@ def pool_process_context(message='in pool process'):
         logging.error('Error {}'.format(message))
         raise exc
 
+def work_done(ploidy_model, start_work):
+    """Returns the iterations (sweeps) and single-target updates run by a ploidy model since its WorkCounters were
+    start_work"""
+    return dict((counter, value - start_work[counter]) for counter, value in ploidy_model.WorkCounters().iteritems())
+
 def run_mcmc_wrapper(run_params):
-    """Globally defined function that can be run by pool processes (without needing to call a ConvergenceAnalysis instance method)"""
+    """Globally defined function that can be run by pool processes (without needing to call a ConvergenceAnalysis instance method)
+    Returns the run params for continuing the chain, along with the work done by this run (see work_done)."""
     with pool_process_context():
-        stored_data, sampling_args, iter_step_size = run_params
+        stored_data, sampling_args, iter_step_size = run_params[:3]
+        start_work = convergence_analysis_instance.ploidy_model.WorkCounters()
 
         # run chain using passed data
         np.random.seed()
@@ -31,14 +38,40 @@ def run_mcmc_wrapper(run_params):
         # store data in same form as run_params to be used in continuing chains
         stored_data = [np.copy(convergence_analysis_instance.ploidy_model.ploidy), np.copy(convergence_analysis_instance.ploidy_model.intensities)]
         sampling_args = [iter_step_size, np.copy(convergence_analysis_instance.ploidy_model.mcmc_copy_data),
-                         np.copy(convergence_analysis_instance.ploidy_model.mcmc_intens), np.copy(convergence_analysis_instance.ploidy_model.likelihoods)]
+                         np.copy(convergence_analysis_instance.ploidy_model.mcmc_intens), np.copy(convergence_analysis_instance.ploidy_model.likelihoods),
+                         np.copy(convergence_analysis_instance.ploidy_model.acceptance)]
+
+        return (stored_data, sampling_args, iter_step_size,
+                work_done(convergence_analysis_instance.ploidy_model, start_work))
+
+def run_tempered_wrapper(run_params):
+    """Globally defined function that runs a single tempered replica for a number of iterations in pool processes.
+    Returns the final replica state, its untempered data log-likelihood, the sampling data (only for the
+    untempered chain), and the work done (see work_done)."""
+    with pool_process_context('in tempered replica'):
+        stored_data, inverse_temperature, n_iterations = run_params
+        ploidy_model = convergence_analysis_instance.ploidy_model
+        start_work = ploidy_model.WorkCounters()
+
+        np.random.seed()
+        ploidy_model.joint_target.inverse_temperature = inverse_temperature
+        ploidy_model.initStates(*stored_data)
+        ploidy_model.RunMCMC(n_iterations, log_progress=False)
+
+        stored_data = [np.copy(ploidy_model.ploidy), np.copy(ploidy_model.intensities)]
+        data_loglike = ploidy_model.joint_target.log_data_likelihood(ploidy_model.intensities, ploidy_model.ploidy)
+        sampling_data = None
+        if inverse_temperature == 1:
+            sampling_data = [np.copy(ploidy_model.mcmc_copy_data), np.copy(ploidy_model.mcmc_intens),
+                             np.copy(ploidy_model.likelihoods), np.copy(ploidy_model.acceptance)]
 
-        return (stored_data, sampling_args, iter_step_size)
+        return (stored_data, data_loglike, sampling_data, work_done(ploidy_model, start_work))
 
 class ConvergenceAnalysis(object):
-    """A class for analyzing convergence and metastability error of MCMC sampler, given specific data and parameters. """
+    """A class for analyzing convergence and metastability error of MCMC sampler, given specific data and parameters.
+    Any additional keyword arguments (sampler settings) are passed to the PloidyModel. """
     def __init__(self, cnv_support, hln_parameters, data, first_baseline_i=None, exclude_covar=False,
-                 n_iterations=10000, burn_in_prop=0.3, use_single_process=False):
+                 n_iterations=10000, burn_in_prop=0.3, use_single_process=False, **model_options):
         self.cnv_support = cnv_support
         self.hln_parameters = hln_parameters
         self.data = data
@@ -47,8 +80,16 @@ class ConvergenceAnalysis(object):
         self.n_iterations = n_iterations
         self.burn_in_prop = burn_in_prop
         self.use_single_process = use_single_process
+        # PSRF of the final Gelman-Rubin round and parallel tempering swap proposals and acceptance, if run
+        self.psrf_loglikes = None
+        self.psrf_intensities = None
+        self.swap_proposals = None
+        self.swap_acceptance = None
+        # normal copy number estimated before sampling (if any), checked against the sampled posteriors
+        self.estimated_norm_copy_num = model_options.get('norm_copy_num', None)
         self.ploidy_model = PloidyModel(self.cnv_support, self.hln_parameters, data=self.data,
-                                        first_baseline_i=self.first_baseline_i, exclude_covar=self.exclude_covar)
+                                        first_baseline_i=self.first_baseline_i, exclude_covar=self.exclude_covar,
+                                        **model_options)
 
         # globally scoped so multiprocessing wrapper function can access
         global convergence_analysis_instance  # pylint: disable=global-variable-undefined
@@ -108,6 +149,7 @@ class ConvergenceAnalysis(object):
                     run_params = pool.map(run_mcmc_wrapper, run_params)
                     pool.close()
                     pool.join()
+                    self.add_pool_work([params[3] for params in run_params])
 
                 # get appropriate data from returned run_params
                 for c_i in range(num_chains):
@@ -153,6 +195,9 @@ class ConvergenceAnalysis(object):
             self.burn_in_prop += 0.05
             tries += 1
 
+        self.psrf_loglikes = psrf_loglikes
+        self.psrf_intensities = psrf_intensities
+
         if self.n_iterations > max_iterations:
             self.n_iterations = max_iterations
             self.burn_in_prop = orig_burn_in_prop
@@ -179,8 +224,128 @@ class ConvergenceAnalysis(object):
         self.ploidy_model.initStates(*run_params[best_chain_i][0])  # access stored data
         self.ploidy_model.RunMCMC(0, *run_params[best_chain_i][1][1:])  # access sampling args (skip n_iterations)
 
+    def parallel_tempering_analysis(self, num_temperatures=4, max_temperature=2., swap_interval=20,
+                                    thresh_loglike_diff=-30, autocor_slice=50):
+        """Run replica exchange (parallel tempering) sampling for n_iterations, as an alternative to detecting and
+        rerunning metastable chains. Replicas sample the posterior with the likelihood raised to 1/T for a geometric
+        ladder of temperatures from 1 to max_temperature, run in parallel (unless use_single_process) for swap_interval
+        iterations at a time, after which states of neighboring replicas are exchanged with Metropolis Hastings
+        (alternating between even and odd pairs). Only the T=1 chain is used for the posteriors.
+
+        Returns copy_posteriors and the log-likelihood difference between the optimized mode and normal ploidy states.
+
+        num_temperatures -- Number of replicas, including the untempered chain
+        max_temperature -- Temperature of the hottest replica
+        swap_interval -- Number of iterations between swap moves
+        thresh_loglike_diff -- Lower bound for log-likelihood difference, below which a metastability error is logged
+        autocor_slice -- Autocor_slice to use in computing copy_posteriors (chosen automatically if 0 or None)
+        """
+        if self.ploidy_model.scan == 'adaptive':
+            # replicas are restarted every swap_interval iterations, too few to adapt scan weights to
+            logging.warning('Adaptive scan is not supported with parallel tempering, using systematic scan')
+            self.ploidy_model.scan = 'systematic'
+
+        temperatures = max_temperature ** (np.arange(num_temperatures) / max(num_temperatures - 1., 1.))
+        inverse_temperatures = 1. / temperatures
+        inverse_temperatures[0] = 1.
+        logging.info('Running parallel tempering with temperatures {}'.format(temperatures))
+
+        stored_data = [[None] * 2 for t_i in range(num_temperatures)]
+        data_loglikes = np.zeros(num_temperatures)
+        swaps_proposed = np.zeros(num_temperatures - 1)
+        swaps_accepted = np.zeros(num_temperatures - 1)
+        cold_sampling_data = []
+
+        if not self.use_single_process:
+            pool = multiprocessing.Pool(min(num_temperatures, multiprocessing.cpu_count()))
+        n_rounds = int(np.ceil(self.n_iterations / float(swap_interval)))
+        for round_i in xrange(n_rounds):
+            round_iterations = min(swap_interval, self.n_iterations - round_i * swap_interval)
+            run_params = zip(stored_data, inverse_temperatures, [round_iterations] * num_temperatures)
+            if self.use_single_process:
+                results = [run_tempered_wrapper(params) for params in run_params]
+            else:
+                results = pool.map(run_tempered_wrapper, run_params)
+                self.add_pool_work([result[3] for result in results])
+
+            for t_i, (t_stored_data, t_data_loglike, t_sampling_data, _) in enumerate(results):
+                stored_data[t_i] = t_stored_data
+                data_loglikes[t_i] = t_data_loglike
+            cold_sampling_data.append(results[0][2])
+
+            # propose swaps between neighboring replicas
+            for t_i in xrange(round_i % 2, num_temperatures - 1, 2):
+                log_swap_ratio = ((inverse_temperatures[t_i] - inverse_temperatures[t_i + 1]) *
+                                  (data_loglikes[t_i + 1] - data_loglikes[t_i]))
+                swaps_proposed[t_i] += 1
+                if log_swap_ratio > 0 or np.random.rand() < np.exp(log_swap_ratio):
+                    stored_data[t_i], stored_data[t_i + 1] = stored_data[t_i + 1], stored_data[t_i]
+                    data_loglikes[t_i], data_loglikes[t_i + 1] = data_loglikes[t_i + 1], data_loglikes[t_i]
+                    swaps_accepted[t_i] += 1
+
+            if (round_i + 1) % max(1, n_rounds / 10) == 0:
+                logging.info('Completed {} iterations of parallel tempering'.format((round_i + 1) * swap_interval))
+        if not self.use_single_process:
+            pool.close()
+            pool.join()
+
+        self.swap_proposals = swaps_proposed
+        self.swap_acceptance = swaps_accepted / np.maximum(swaps_proposed, 1)
+        for t_i in xrange(num_temperatures - 1):
+            logging.info('Swap acceptance between temperatures {} and {}: {}'.format(
+                temperatures[t_i], temperatures[t_i + 1], self.swap_acceptance[t_i]))
+
+        # load the untempered chain into the ploidy model (running with 0 iterations)
+        self.ploidy_model.joint_target.inverse_temperature = 1.
+        self.ploidy_model.initStates(*stored_data[0])
+        self.ploidy_model.RunMCMC(0, np.concatenate([data[0] for data in cold_sampling_data], axis=1),
+                                  np.concatenate([data[1] for data in cold_sampling_data], axis=0),
+                                  np.concatenate([data[2] for data in cold_sampling_data]),
+                                  np.concatenate([data[3] for data in cold_sampling_data], axis=0))
+
+        copy_posteriors = self.ploidy_model.ReportMCMCData(int(round(self.burn_in_prop * self.n_iterations)), autocor_slice)
+        self.get_norm_copy_num(copy_posteriors)
+        if not self.norm_copy_num_consistent():
+            logging.warning('Using normal copy number {} from sampled posteriors'.format(self.norm_copy_num))
+        loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
+        if loglike_diff < thresh_loglike_diff:
+            logging.error('Metastability error: tempered chain did not reach a copy number state with '
+                          'greater likelihood than normal ploidy state')
+
+        return copy_posteriors, loglike_diff
+
+    def add_pool_work(self, pool_work):
+        """Adds the work done in pool processes (a list of work_done dicts) to the work counters of the ploidy model,
+        which only count work done in this process"""
+        for work in pool_work:
+            self.ploidy_model.total_iterations += work['sweeps']
+            self.ploidy_model.total_target_updates += work['target_updates']
+
+    def run_chain(self, min_ess=None, max_iterations=25000):
+        """Run (or continue) the chain of the ploidy model for n_iterations. If min_ess is given, sampling continues in
+        batches until every non-baseline target reaches that effective sample size (or max_iterations is reached).
+        Returns the length of the chain. n_iterations is left unchanged, so chains rerun later start from n_iterations
+        rather than from the length of this (extended) chain."""
+        if self.ploidy_model.likelihoods is None:
+            self.ploidy_model.RunMCMC(self.n_iterations)
+        if min_ess:
+            return self.ploidy_model.RunMCMCUntilESS(min_ess, self.burn_in_prop,
+                                                     batch_iterations=int(round(self.n_iterations * 0.5)),
+                                                     max_iterations=max(max_iterations, self.n_iterations))
+        return len(self.ploidy_model.likelihoods)
+
+    @contextmanager
+    def _phase(self, metrics, name):
+        """Times a phase of sampling with metrics (counting the work of the ploidy model), yielding a dict of phase
+        counters; does nothing if metrics is None"""
+        if metrics is None:
+            yield {}
+        else:
+            with metrics.phase(name, self.ploidy_model.WorkCounters) as counters:
+                yield counters
+
     def metastability_error_analysis(self, grad_threshold=0.35, thresh_loglike_diff=-30, autocor_slice=50,
-                                     max_iterations=25000, max_tries=5):
+                                     max_iterations=25000, max_tries=5, min_ess=None, metrics=None):
         """Checks for metastability error (causing false positives) in MCMC sampling results. Compares optimized
         log-likelihood of normal ploidy state and reported ploidy state -- assumes that normal ploidy state should not
         have significantly lower optimized log-likelihood.
@@ -193,16 +358,31 @@ class ConvergenceAnalysis(object):
         norm_copy_num -- Normal ploidy state (used to generate normal copy numbers)
         grad_threshold -- Threshold for gradient of log-likelihood above which a mode switch is registered
         thresh_loglike_diff -- Lower bound for log-likelihood difference
-        autocor_slice -- Autocor_slice to use in computing copy_posteriors
+        autocor_slice -- Autocor_slice to use in computing copy_posteriors (chosen automatically if 0 or None)
         max_tries -- Maximum number of attempts in finding convergence conditions
+        min_ess -- Minimum effective sample size per non-baseline target, sampling is extended until reached if given
+        metrics -- Optional Metrics instance recording the first chain ('sampling'), the rerun with the sampled normal
+                   copy number ('norm_copy_num_rerun'), metastability reruns ('metastability_rerun', with a try
+                   counter) and likelihood comparisons ('likelihood_comparison') as separate phases
         """
-        # check if iterations have already been run
-        if self.ploidy_model.likelihoods is None:
-            self.ploidy_model.RunMCMC(self.n_iterations)
-
-        copy_posteriors = self.ploidy_model.ReportMCMCData(int(round(self.burn_in_prop * self.n_iterations)), autocor_slice)
+        # run iterations if not already run (and extend them to reach min_ess)
+        with self._phase(metrics, 'sampling'):
+            chain_length = self.run_chain(min_ess, max_iterations)
+            copy_posteriors = self.ploidy_model.ReportMCMCData(int(round(self.burn_in_prop * chain_length)), autocor_slice)
         self.get_norm_copy_num(copy_posteriors)
-        loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
+        if not self.norm_copy_num_consistent():
+            # rerun once with chains started at (and proposals biased towards) the sampled normal copy number
+            logging.info('Rerunning sampling with normal copy number {}'.format(self.norm_copy_num))
+            with self._phase(metrics, 'norm_copy_num_rerun'):
+                self.estimated_norm_copy_num = self.norm_copy_num
+                self.ploidy_model.SetNormCopyNum(self.norm_copy_num)
+                self.ploidy_model.initStates()
+                self.ploidy_model.RunMCMC(self.n_iterations)
+                chain_length = self.run_chain(min_ess, max_iterations)
+                copy_posteriors = self.ploidy_model.ReportMCMCData(int(round(self.burn_in_prop * chain_length)), autocor_slice)
+            self.get_norm_copy_num(copy_posteriors)
+        with self._phase(metrics, 'likelihood_comparison'):
+            loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
 
         tries = 0
         iter_step_size = int(round(self.n_iterations * 0.5))
@@ -217,20 +397,27 @@ class ConvergenceAnalysis(object):
                 #                    'greater likelihood than normal ploidy state')
             # check if metastability error in this chain after increasing n_iterations
             if tries > 0:
-                self.ploidy_model.initStates()
-                self.ploidy_model.RunMCMC(self.n_iterations)
-                copy_posteriors = self.ploidy_model.ReportMCMCData(self.burn_in, autocor_slice)
-                loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
+                with self._phase(metrics, 'metastability_rerun') as counters:
+                    counters['try'] = tries
+                    self.ploidy_model.initStates()
+                    self.ploidy_model.RunMCMC(self.n_iterations)
+                    chain_length = self.run_chain(min_ess, max_iterations)
+                    copy_posteriors = self.ploidy_model.ReportMCMCData(self.burn_in, autocor_slice)
+                with self._phase(metrics, 'likelihood_comparison') as counters:
+                    counters['try'] = tries
+                    loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
 
             # first choose more appropriate burn-in before increasing n_iterations again
             if loglike_diff < thresh_loglike_diff:
                 peak_pos, peak_height = self.ploidy_model.DetectModeJump()
                 # use significant peak, otherwise set back to default
-                self.burn_in = peak_pos if peak_height > grad_threshold else int(round(self.burn_in_prop * self.n_iterations))
+                self.burn_in = peak_pos if peak_height > grad_threshold else int(round(self.burn_in_prop * chain_length))
                 logging.info('Setting burn-in to {} on run {}'.format(self.burn_in, tries))
 
                 copy_posteriors = self.ploidy_model.ReportMCMCData(self.burn_in, autocor_slice)
-                loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
+                with self._phase(metrics, 'likelihood_comparison') as counters:
+                    counters['try'] = tries
+                    loglike_diff = self.ploidy_model.LikelihoodComparison(self.norm_copy_num)
             tries += 1
             # increase number of iterations with tries unless already large number
             if self.n_iterations < max_iterations:
@@ -238,6 +425,28 @@ class ConvergenceAnalysis(object):
 
         return copy_posteriors, loglike_diff
 
+    def diagnostics(self):
+        """Returns mixing diagnostics of the sampled chain (see PloidyModel.Diagnostics, using the burn-in and
+        autocor_slice of the reported posteriors), along with the per-target intensity and log-likelihood PSRF of the
+        final Gelman-Rubin round and the swap acceptance between neighboring temperatures of parallel tempering
+        (where run)."""
+        diagnostics = self.ploidy_model.Diagnostics(self.ploidy_model.burn_in, self.ploidy_model.autocor_slice)
+        if self.psrf_intensities is not None:
+            diagnostics['psrf_intensities'] = self.psrf_intensities
+            diagnostics['psrf_loglikes'] = self.psrf_loglikes
+        if self.swap_acceptance is not None:
+            diagnostics['swap_acceptance'] = self.swap_acceptance
+        return diagnostics
+
+    def norm_copy_num_consistent(self):
+        """Returns whether the normal copy number determined from sampled posteriors agrees with the normal copy number
+        estimated before sampling (always True if there is no estimate), logging a warning if not."""
+        if self.estimated_norm_copy_num is None or self.estimated_norm_copy_num == self.norm_copy_num:
+            return True
+        logging.warning('Normal copy number from sampled posteriors ({}) differs from the estimate before sampling '
+                        '({})'.format(self.norm_copy_num, self.estimated_norm_copy_num))
+        return False
+
     def get_norm_copy_num(self, copy_posteriors):
         """Determines most likely 'normal ploidy' number on X chromosome targets
         (essentially determining sex of sample)
@@ -2,12 +2,18 @@ import numpy as np
 
 class IntensitiesDistribution(object):
     """A class which stores our current parameters and contains methods to update them during MCMC Steps"""
-    def __init__(self, mu, covariance):
+    def __init__(self, mu, covariance, covariance_chol=None):
         self.mu = mu
         self.covariance = covariance
+        # lower cholesky factor of covariance, if already computed
+        self.covariance_chol = covariance_chol
 
     def sample(self):
         """Given a current ploidy state, and an internally maintained vector of current intensities, sample a
         new intensity vector.  This will be a no-op until we can better define the model."""
-        intensities = np.concatenate((np.random.multivariate_normal(self.mu.flatten(), self.covariance), [0]))
+        if self.covariance_chol is not None:
+            intensities = self.mu.flatten() + np.dot(self.covariance_chol, np.random.randn(len(self.covariance)))
+        else:
+            intensities = np.random.multivariate_normal(self.mu.flatten(), self.covariance)
+        intensities = np.concatenate((intensities, [0]))
         return intensities
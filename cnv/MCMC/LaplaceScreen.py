@@ -0,0 +1,108 @@
+"""Fast screening for copy number changes with Laplace-approximated marginal likelihoods"""
+
+import logging
+import numpy as np
+
+from TargetJointDistribution import TargetJointDistribution
+
+
+class LaplaceScreen(object):
+    """Approximates per-target copy number posteriors without sampling, for samples expected to be normal.
+    The intensities are integrated out with a Laplace approximation (around the mode found by Newton optimization) for
+    the normal ploidy state and every state that differs from it at a single non-baseline target, and the posterior is
+    computed over only those candidate states (assuming a uniform prior over copy numbers).
+
+    cnv_support -- array-like containing the different possible ploidy states
+    hln_parameters -- instance of HLN_Parameters containing mu (array), covariance (matrix), and targets(list)
+    """
+    def __init__(self, cnv_support, hln_parameters, data, first_baseline_i=None, exclude_covar=False):
+        self.cnv_support = np.asarray(cnv_support, dtype=float)
+        self.targets = hln_parameters.targets
+        self.n_targets = len(self.targets)
+        self.first_baseline_i = self.n_targets if first_baseline_i is None else first_baseline_i
+        self.data = data
+        self.joint_target = TargetJointDistribution(hln_parameters.mu, hln_parameters.covariance, self.cnv_support, data,
+                                                    exclude_covar=exclude_covar, compute_conditionals=False,
+                                                    inference_cache=hln_parameters.inference_cache)
+
+    def normal_ploidy(self, norm_copy_num):
+        """Returns the normal ploidy state given the normal copy number of non-baseline targets"""
+        ploidy = 2. * np.ones(self.n_targets)
+        ploidy[:self.first_baseline_i] = norm_copy_num
+        return ploidy
+
+    def candidate_norm_copy_nums(self):
+        """Returns the possible normal copy numbers of non-baseline targets (1 or 2 for X chromosome targets)"""
+        return [1., 2.] if self.targets[0].chrom == 'X' else [2.]
+
+    def estimate_norm_copy_num(self, target_base_mean=None, target_base_sd=None):
+        """Returns the most probable normal copy number of non-baseline targets and the probabilities of each candidate
+        (assuming equal prior probabilities), from the Laplace-approximated marginal likelihoods of the normal ploidy
+        states and, if given, the ratio of total non-baseline target coverage to baseline sum coverage.
+
+        target_base_mean -- Mean target-to-baseline-sum ratio of the training samples (as stored by train-model with
+                            use_baseline_sum), assumed to have normal copy number 2
+        target_base_sd -- Standard deviation of the target-to-baseline-sum ratio of the training samples
+        """
+        norm_copy_nums = self.candidate_norm_copy_nums()
+        if len(norm_copy_nums) == 1:
+            return norm_copy_nums[0], np.ones(1)
+
+        log_scores, _, _ = self.joint_target.laplace_log_marginals(
+            np.array([self.normal_ploidy(norm) for norm in norm_copy_nums]))
+        logging.info('Laplace log marginal likelihoods of normal copy numbers {}: {}'.format(norm_copy_nums, log_scores))
+
+        if target_base_mean and self.n_targets - self.first_baseline_i == 1:
+            # ratio scales with the normal copy number relative to the training samples
+            sample_ratio = np.sum(self.data[:self.first_baseline_i]) / self.data[self.first_baseline_i]
+            scales = np.array(norm_copy_nums) / 2.
+            zscores = (sample_ratio - scales * target_base_mean) / (scales * target_base_sd)
+            logging.info('Z-scores of sample target-to-baseline-sum ratio for normal copy numbers {}: {}'.format(
+                norm_copy_nums, zscores))
+            log_scores = log_scores - 0.5 * zscores ** 2 - np.log(scales)
+
+        norm_probs = np.exp(log_scores - np.amax(log_scores))
+        norm_probs /= np.sum(norm_probs)
+        return norm_copy_nums[np.argmax(log_scores)], norm_probs
+
+    def screen(self, norm_copy_num=None):
+        """Returns approximate copy_posteriors, the normal copy number used, and whether the approximation is reliable
+        (all optimizations converged with positive definite Hessians and the normal state is the most probable).
+
+        norm_copy_num -- Normal copy number of non-baseline targets, chosen by largest approximate marginal likelihood
+                         of the candidate normal states if not given
+        """
+        if norm_copy_num is None:
+            norm_copy_num, _ = self.estimate_norm_copy_num()
+
+        # normal state followed by every single-target deviation from it
+        normal_ploidy = self.normal_ploidy(norm_copy_num)
+        alternate_copies = self.cnv_support[self.cnv_support != norm_copy_num]
+        deviations = [(target_i, copy_num) for target_i in xrange(self.first_baseline_i) for copy_num in alternate_copies]
+        candidates = np.tile(normal_ploidy, (len(deviations) + 1, 1))
+        for candidate_i, (target_i, copy_num) in enumerate(deviations):
+            candidates[candidate_i + 1, target_i] = copy_num
+
+        # warm start all candidates from the mode of the normal state
+        normal_log_marginal, normal_mode, normal_reliable = self.joint_target.laplace_log_marginals(normal_ploidy)
+        log_marginals, _, reliable = self.joint_target.laplace_log_marginals(candidates[1:], normal_mode[0])
+        log_marginals = np.concatenate((normal_log_marginal, log_marginals))
+        reliable = np.concatenate((normal_reliable, reliable))
+
+        candidate_posteriors = np.exp(log_marginals - np.amax(log_marginals))
+        candidate_posteriors /= np.sum(candidate_posteriors)
+
+        norm_index = np.where(self.cnv_support == norm_copy_num)[0][0]
+        copy_posteriors = np.zeros((self.n_targets, len(self.cnv_support)))
+        copy_posteriors[self.first_baseline_i:, np.where(self.cnv_support == 2.)[0][0]] = 1.
+        for candidate_i, (target_i, copy_num) in enumerate(deviations):
+            copy_posteriors[target_i, np.where(self.cnv_support == copy_num)[0][0]] = candidate_posteriors[candidate_i + 1]
+        copy_posteriors[:self.first_baseline_i, norm_index] = 1. - np.sum(copy_posteriors[:self.first_baseline_i], axis=1)
+
+        is_reliable = bool(np.all(reliable) and np.argmax(log_marginals) == 0)
+        if not np.all(reliable):
+            logging.warning('Laplace approximation unreliable for {} of {} candidate ploidy states'.format(
+                np.sum(~reliable), len(reliable)))
+        logging.info('Approximate posterior probability of normal ploidy state: {}'.format(candidate_posteriors[0]))
+
+        return copy_posteriors, norm_copy_num, is_reliable
@@ -2,9 +2,9 @@
 
 import logging
 import numpy as np
-import scipy
 from scipy.signal import savgol_filter
 
+from Autocorrelation import integrated_autocorrelation_time
 from IntensitiesDistribution import IntensitiesDistribution
 from TargetJointDistribution import TargetJointDistribution
 from CopyNumberDistribution import CopyNumberDistribution
@@ -15,10 +15,42 @@ class PloidyModel(object):
     posterior probability of different ploidy states.
     cnv_support -- array-like containing the different possible ploidy states (ints)
     hln_parameters -- instance of HLN_Parameters containing mu (array), covariance (matrix), and targets(list)
+    segment_rate -- Rate of multi-target segment copy number proposals, as the expected number of segment proposals
+                    per non-baseline target per iteration, between 0 and 1 (0 uses single-target proposals only)
+    max_segment_length -- Maximum number of targets in a segment proposal
+    copy_update -- 'metropolis' to propose copy numbers jointly with intensities from the prior, or 'gibbs' to sample
+                   each copy number exactly from its conditional distribution followed by a separate intensity update
+    prune_threshold -- With Gibbs copy updates, copy numbers whose conditional probability for a target stays below
+                       this threshold over prune_interval iterations are removed from that target's support
+    prune_interval -- Number of iterations between checks for copy numbers to prune
+    init_from_mode -- Initialize chains around a data-driven ploidy guess and the conditional mode of the intensities
+                      given it, instead of drawing from the priors
+    init_overdispersion -- Scale of the initial intensity spread relative to the Laplace approximation of the
+                           posterior at the mode (values above 1 overdisperse chains for Gelman-Rubin analysis)
+    init_copy_jitter -- Probability of drawing each non-baseline initial copy number from the prior instead of the guess
+    intensity_update -- 'single' to update intensities one target at a time (with the copy number updates), or
+                        'elliptical' to update all intensities jointly by elliptical slice sampling once per iteration,
+                        interleaved with copy number only updates of the non-baseline targets
+    rao_blackwell -- Report copy number posteriors as the average over retained iterations of each target's full
+                     conditional distribution given the other states, instead of the frequency of sampled copy numbers
+    scan -- 'systematic' to update every target in order each iteration, or 'adaptive' to make the same number of
+            single-target updates each iteration at targets drawn at random, weighted towards targets whose copy
+            number is uncertain (scan_floor plus one minus the frequency of the most visited copy number so far)
+    scan_adapt_iterations -- Number of initial iterations of a chain during which adaptive scan weights are updated,
+                             after which they are frozen (should not exceed the burn-in)
+    scan_floor -- Minimum adaptive scan weight of each target, relative to a weight of up to 1 added for uncertainty
+    norm_copy_num -- Estimated normal copy number of non-baseline targets (if known before sampling), used to start
+                     chains at the normal ploidy state (or around its mode if init_from_mode, with init_copy_jitter
+                     applied in both cases) and to bias copy number proposals towards it
+    norm_proposal_weight -- Additional probability of proposing norm_copy_num in single-target copy number proposals
     """
 
     def __init__(self, cnv_support, hln_parameters, data=None, ploidy=None, intensities=None, first_baseline_i=None,
-                 exclude_covar=False):
+                 exclude_covar=False, segment_rate=0., max_segment_length=10, copy_update='metropolis',
+                 prune_threshold=1e-8, prune_interval=500, init_from_mode=False, init_overdispersion=2.,
+                 init_copy_jitter=0.1, intensity_update='single',
+                 rao_blackwell=False, scan='systematic', scan_adapt_iterations=1000, scan_floor=0.5,
+                 norm_copy_num=None, norm_proposal_weight=0.5):
         """Initialize the data model with its input arguments.
         Load the parameters and initialize starting states as necessary."""
 
@@ -30,46 +62,218 @@ class PloidyModel(object):
         self.data = data
 
         self.cnv_support = cnv_support
+        self.segment_rate = segment_rate
+        self.max_segment_length = max_segment_length
+        if copy_update not in ('metropolis', 'gibbs'):
+            raise ValueError('Unknown copy number update {}, must be metropolis or gibbs'.format(copy_update))
+        self.copy_update = copy_update
+        if intensity_update not in ('single', 'elliptical'):
+            raise ValueError('Unknown intensity update {}, must be single or elliptical'.format(intensity_update))
+        self.intensity_update = intensity_update
+        self.rao_blackwell = rao_blackwell
+        if scan not in ('systematic', 'adaptive'):
+            raise ValueError('Unknown scan {}, must be systematic or adaptive'.format(scan))
+        self.scan = scan
+        self.scan_adapt_iterations = scan_adapt_iterations
+        self.scan_floor = scan_floor
+        self.prune_threshold = prune_threshold
+        self.prune_interval = prune_interval
+        self.init_from_mode = init_from_mode
+        self.init_overdispersion = init_overdispersion
+        self.init_copy_jitter = init_copy_jitter
+        self.mode_states = None
+        # cholesky factor of the prior covariance if precomputed in a compiled model, for drawing initial intensities
+        self.prior_chol = (hln_parameters.inference_cache or {}).get('covariance_chol')
+
+        # initialize joint distribution with data and parameters
+        self.joint_target = TargetJointDistribution(self.mu, self.covariance, self.cnv_support, self.data,
+                                                    exclude_covar=exclude_covar,
+                                                    inference_cache=hln_parameters.inference_cache)
+        self.norm_proposal_weight = norm_proposal_weight
+        self.SetNormCopyNum(norm_copy_num)
 
         # initialize values
         self.initStates(ploidy, intensities)
         self.likelihoods = None
-
-        # initialize joint distribution with data and parameters
-        self.joint_target = TargetJointDistribution(self.mu, self.covariance, self.cnv_support, self.data,
-                                                    exclude_covar=exclude_covar)
+        # total sampling work done by this instance (not including copies in other processes)
+        self.total_iterations = 0
+        self.total_target_updates = 0
 
     def initStates(self, ploidy=None, intensities=None):
-        """Reset the ploidy and intensity states"""
-        self.intensities = IntensitiesDistribution(self.mu, self.covariance).sample() if intensities is None else intensities
+        """Reset the ploidy and intensity states, drawn from the priors or around the mode if init_from_mode"""
+        if self.init_from_mode:
+            mode_ploidy, mode_intensities, mode_cov_chol = self.ModeStates()
+            if intensities is None:
+                intensities = mode_intensities + self.init_overdispersion * np.concatenate(
+                    (np.dot(mode_cov_chol, np.random.randn(self.n_targets - 1)), [0]))
+            if ploidy is None:
+                ploidy = np.copy(mode_ploidy)
+                jitter = np.where(np.random.rand(self.first_baseline_i) < self.init_copy_jitter)[0]
+                ploidy[jitter] = np.random.choice(self.cnv_support, size=len(jitter))
+        elif self.norm_copy_num is not None and ploidy is None:
+            ploidy = self.NormalPloidy()
+            jitter = np.where(np.random.rand(self.first_baseline_i) < self.init_copy_jitter)[0]
+            ploidy[jitter] = np.random.choice(self.cnv_support, size=len(jitter))
+
+        self.intensities = IntensitiesDistribution(self.mu, self.covariance,
+                                                   self.prior_chol).sample() if intensities is None else intensities
         self.ploidy = CopyNumberDistribution(self.n_targets,
                                              support=self.cnv_support).sample_prior(self.first_baseline_i) if ploidy is None else ploidy
-
-    def RunMCMC(self, n_iterations=10000, prior_copy_data=None, prior_mcmc_intens=None, prior_likelihoods=None):
+        # copy numbers available to Gibbs updates for each target, and largest conditional probabilities since last pruning
+        self.active_support = np.ones((self.n_targets, len(self.cnv_support)), dtype=bool)
+        self.max_copy_probs = np.zeros((self.n_targets, len(self.cnv_support)))
+
+    def SetNormCopyNum(self, norm_copy_num):
+        """Set the estimated normal copy number of non-baseline targets (None if unknown), used to initialize chains
+        and bias copy number proposals. Clears any cached mode states."""
+        self.norm_copy_num = norm_copy_num
+        self.mode_states = None
+        self.joint_target.set_copy_proposal(norm_copy_num, self.norm_proposal_weight)
+
+    def NormalPloidy(self):
+        """Returns the normal ploidy state: norm_copy_num for non-baseline targets and 2 for baseline targets"""
+        ploidy = 2. * np.ones(self.n_targets)
+        ploidy[:self.first_baseline_i] = self.norm_copy_num
+        return ploidy
+
+    def ModeStates(self, max_iterations=10):
+        """Returns a data-driven guess of the ploidy state, the conditional mode of the intensities given it and data,
+        and the Cholesky factor of the inverse negative Hessian at that mode (computed once and cached).
+
+        The guess starts from the normal ploidy state with the largest Laplace-approximated marginal likelihood
+        (normal copy number 1 or 2 for X chromosome targets) and alternates setting each non-baseline copy number to
+        its conditional mode with re-optimizing the intensities (iterated conditional modes). Copy numbers are compared
+        with the target's intensity shifted to keep its expected coverage (copy number times exponentiated intensity)
+        unchanged, as intensities at the mode of one copy number absorb the coverage change of another."""
+        if self.mode_states is None:
+            if self.norm_copy_num is not None:
+                norm_copy_nums = [self.norm_copy_num]
+            else:
+                norm_copy_nums = [1., 2.] if self.targets[0].chrom == 'X' else [2.]
+            normal_ploidies = 2. * np.ones((len(norm_copy_nums), self.n_targets))
+            normal_ploidies[:, :self.first_baseline_i] = np.array(norm_copy_nums).reshape((-1, 1))
+            log_marginals, modes, _ = self.joint_target.laplace_log_marginals(normal_ploidies)
+            norm_copy_num = norm_copy_nums[np.argmax(log_marginals)]
+            ploidy = normal_ploidies[np.argmax(log_marginals)]
+            intensities = modes[np.argmax(log_marginals)]
+
+            for _ in xrange(max_iterations):
+                previous_ploidy = np.copy(ploidy)
+                for target_i in xrange(self.first_baseline_i):
+                    if target_i == self.n_targets - 1:
+                        # the last intensity is fixed at 0
+                        ploidy[target_i] = self.cnv_support[np.argmax(self.joint_target.copy_conditional_probs(
+                            ploidy, intensities, target_i))]
+                        continue
+                    shifted_intensities = np.tile(intensities, (len(self.cnv_support), 1))
+                    shifted_intensities[:, target_i] += np.log(ploidy[target_i] / self.cnv_support)
+                    shifted_loglikes = []
+                    for copy_num, copy_intensities in zip(self.cnv_support, shifted_intensities):
+                        ploidy[target_i] = copy_num
+                        shifted_loglikes.append(self.joint_target.log_joint_likelihood(copy_intensities, ploidy))
+                    ploidy[target_i] = self.cnv_support[np.argmax(shifted_loglikes)]
+                    intensities = shifted_intensities[np.argmax(shifted_loglikes)]
+                if np.all(ploidy == previous_ploidy):
+                    break
+                intensities = self.joint_target.optimize_intensities(ploidy, intensities)[0][0]
+
+            _, neg_hess = self.joint_target.intensity_grad_neg_hess(intensities[:-1].reshape((1, -1)),
+                                                                    np.log(ploidy).reshape((1, -1)))
+            self.mode_states = (ploidy, intensities, np.linalg.cholesky(np.linalg.inv(neg_hess[0])))
+            logging.info('Initializing chains around mode with normal copy number {} and {} other copy numbers'.format(
+                norm_copy_num, np.sum(ploidy[:self.first_baseline_i] != norm_copy_num)))
+
+        return self.mode_states
+
+    def RunMCMC(self, n_iterations=10000, prior_copy_data=None, prior_mcmc_intens=None, prior_likelihoods=None,
+                prior_acceptance=None, log_progress=True):
         """Metropolis Hastings sampling of the posterior likelihood"""
         self.mcmc_copy_data = np.zeros((self.n_targets, n_iterations))
         self.mcmc_intens = np.zeros((n_iterations, self.n_targets))
         self.likelihoods = np.zeros(n_iterations)
         self.acceptance = np.zeros((n_iterations, self.n_targets))
+        segment_proposals = 0
+        segment_acceptances = 0
+        slice_evaluations = 0
+
+        # with elliptical intensity updates only non-baseline copy numbers are updated one target at a time
+        self.updates_per_iteration = self.first_baseline_i if self.intensity_update == 'elliptical' else self.n_targets
+        adaptive_scan = self.scan == 'adaptive' and self.updates_per_iteration > 0
+        if adaptive_scan:
+            # copy number visits of this chain during adaptation (including any previous iterations passed in)
+            n_previous = 0 if prior_likelihoods is None else len(prior_likelihoods)
+            scan_copy_counts = np.zeros((self.n_targets, len(self.cnv_support)))
+            if n_previous > 0:
+                previous_copies = prior_copy_data[:, :self.scan_adapt_iterations]
+                for cni, copy_num in enumerate(self.cnv_support):
+                    scan_copy_counts[:, cni] = np.sum(previous_copies == copy_num, axis=1)
+            self.scan_weights = self.ScanWeights(scan_copy_counts)
 
         # Targets with labels beginning with 'Baseline' only have their intensities sampled.
         for i in xrange(n_iterations):
-            for target_i in xrange(self.n_targets):
-                self.ploidy[target_i], self.intensities[target_i], self.acceptance[i, target_i] = self.joint_target.sample(
-                    self.ploidy, self.intensities, target_i, target_i >= self.first_baseline_i)
-                self.mcmc_copy_data[target_i, i] = self.ploidy[target_i]
-                self.mcmc_intens[i, target_i] = self.intensities[target_i]
-
+            if self.intensity_update == 'elliptical':
+                # block update of all intensities (always accepted), then copy numbers alone given the intensities
+                self.intensities, n_evaluations = self.joint_target.sample_intensities_elliptical(self.ploidy,
+                                                                                                  self.intensities)
+                slice_evaluations += n_evaluations
+                self.acceptance[i, self.first_baseline_i:] = 1.
+
+            if adaptive_scan:
+                # random scan with the same number of updates as a systematic sweep (targets may be updated more than
+                # once or not at all), acceptance is averaged over updates and NaN for targets not updated
+                updated_targets = np.random.choice(self.updates_per_iteration, size=self.updates_per_iteration,
+                                                   p=self.scan_weights)
+                accepts = np.zeros(self.updates_per_iteration)
+                for target_i in updated_targets:
+                    accepts[target_i] += self.UpdateTarget(target_i)
+                visits = np.bincount(updated_targets, minlength=self.updates_per_iteration)
+                self.acceptance[i, :self.updates_per_iteration] = np.where(visits > 0, accepts / np.maximum(visits, 1),
+                                                                           np.nan)
+            else:
+                for target_i in xrange(self.updates_per_iteration):
+                    self.acceptance[i, target_i] = self.UpdateTarget(target_i)
+
+            # mix in copy number proposals shared across contiguous runs of non-baseline targets
+            if self.segment_rate > 0:
+                for _ in xrange(np.random.binomial(self.first_baseline_i, min(self.segment_rate, 1.))):
+                    self.ploidy, accepted = self.joint_target.sample_segment(self.ploidy, self.intensities,
+                                                                             self.first_baseline_i, self.max_segment_length)
+                    segment_proposals += 1
+                    segment_acceptances += accepted
+
+            if self.copy_update == 'gibbs' and (i + 1) % self.prune_interval == 0:
+                self.PruneSupport()
+
+            self.mcmc_copy_data[:, i] = self.ploidy
+            self.mcmc_intens[i] = self.intensities
             self.likelihoods[i] = self.joint_target.log_joint_likelihood(self.intensities, self.ploidy)
 
+            # adapt scan weights to the copy number visits so far, until they are frozen
+            if adaptive_scan and n_previous + i < self.scan_adapt_iterations:
+                scan_copy_counts[np.arange(self.n_targets), np.searchsorted(self.cnv_support, self.ploidy)] += 1
+                self.scan_weights = self.ScanWeights(scan_copy_counts)
+
             # Log some convergence info at decile intervals.
-            if (i + 1) % (n_iterations / 10) == 0:
+            if log_progress and (i + 1) % max(1, n_iterations / 10) == 0:
                 logging.info('Completed {} iterations'.format(i + 1))
                 logging.debug('After {} iterations:\ncnv: {}\nlikelihood: {}\n'.format(
                     i + 1, self.ploidy, self.likelihoods[i]))
 
+        self.total_iterations += n_iterations
+        self.total_target_updates += n_iterations * self.updates_per_iteration
+
         # Log acceptance ratio at end
-        logging.info('Acceptance ratio: {}'.format((np.mean(self.acceptance) if n_iterations > 0 else 'None')))
+        if log_progress:
+            logging.info('Acceptance ratio: {}'.format((np.nanmean(self.acceptance) if n_iterations > 0 else 'None')))
+        if log_progress and segment_proposals > 0:
+            logging.info('Segment proposal acceptance ratio: {} ({} proposals)'.format(
+                segment_acceptances / float(segment_proposals), segment_proposals))
+        if log_progress and slice_evaluations > 0:
+            logging.info('Mean likelihood evaluations per elliptical slice update: {}'.format(
+                slice_evaluations / float(n_iterations)))
+        if log_progress and adaptive_scan:
+            logging.info('Proportion of adaptive scan updates at non-baseline targets: {}'.format(
+                np.sum(self.scan_weights[:self.first_baseline_i])))
 
         # Combine with any previously computed sampling data
         # all or none should be passed in
@@ -77,15 +281,181 @@ class PloidyModel(object):
             self.mcmc_copy_data = np.concatenate((prior_copy_data, np.copy(self.mcmc_copy_data)), axis=1)
             self.mcmc_intens = np.concatenate((prior_mcmc_intens, np.copy(self.mcmc_intens)), axis=0)
             self.likelihoods = np.concatenate((prior_likelihoods, np.copy(self.likelihoods)))
+            # acceptance is optional, without it only acceptance of this run is kept
+            if prior_acceptance is not None:
+                self.acceptance = np.concatenate((prior_acceptance, np.copy(self.acceptance)), axis=0)
 
             logging.info('Using previously passed iteration data, updating to {} total iterations'.format(len(self.likelihoods)))
 
+    def WorkCounters(self):
+        """Returns the total number of iterations (sweeps) and single-target updates run by this instance"""
+        return {'sweeps': self.total_iterations, 'target_updates': self.total_target_updates}
+
+    def UpdateTarget(self, target_i):
+        """Update the state of a single target, returning whether the update was accepted. With elliptical intensity
+        updates only the copy number is updated (non-baseline targets only), otherwise the intensity is updated along
+        with the copy number (for non-baseline targets)."""
+        propose_copy = target_i < self.first_baseline_i
+        if self.intensity_update == 'elliptical':
+            if self.copy_update == 'gibbs':
+                self.SampleCopyGibbs(target_i)
+                return 1.
+            self.ploidy[target_i], accepted = self.joint_target.sample_copy(self.ploidy, self.intensities, target_i)
+            return accepted
+
+        if self.copy_update == 'gibbs' and propose_copy:
+            # sample copy number exactly, then update intensity alone
+            self.SampleCopyGibbs(target_i)
+            propose_copy = False
+        self.ploidy[target_i], self.intensities[target_i], accepted = self.joint_target.sample(
+            self.ploidy, self.intensities, target_i, not propose_copy)
+        return accepted
+
+    def ScanWeights(self, copy_counts):
+        """Returns the probability of choosing each target for an update in the adaptive random scan, given counts of
+        the visits to each copy number by each target: scan_floor plus the proportion of visits away from the most
+        visited copy number for non-baseline targets, and scan_floor for baseline targets (except for the last target
+        with single-target intensity updates, whose intensity is fixed so it is never chosen)."""
+        weights = self.scan_floor * np.ones(self.updates_per_iteration)
+        n_visits = np.sum(copy_counts[:self.first_baseline_i], axis=1)
+        if np.all(n_visits > 0):
+            weights[:self.first_baseline_i] += 1. - np.amax(copy_counts[:self.first_baseline_i], axis=1) / n_visits
+        if self.updates_per_iteration > self.first_baseline_i:
+            weights[-1] = 0
+        return weights / np.sum(weights)
+
+    def UpdatesPerEffectiveSample(self, burn_in=0):
+        """Returns the number of single-target updates made after burn-in per effective sample of the non-baseline
+        target with the smallest effective sample size (log-likelihood if there are none), as a measure of the total
+        work needed per effective sample."""
+        n_kept = self.mcmc_intens.shape[0] - burn_in
+        target_ess, loglike_ess = self.EffectiveSampleSize(burn_in)
+        min_ess = np.amin(target_ess[:self.first_baseline_i]) if self.first_baseline_i > 0 else loglike_ess
+        return self.updates_per_iteration * n_kept / min_ess
+
+    def Diagnostics(self, burn_in=0, autocor_slice=1, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """Returns a dict of per-target and log-likelihood mixing diagnostics of the chain: the acceptance rate of each
+        target after burn-in (NaN for targets never updated), effective sample sizes, log-likelihood trace summaries
+        after burn-in, the index and height of the largest log-likelihood jump found by DetectModeJump (-1 and NaN if
+        the chain is too short), and the intensity and log-likelihood traces after burn-in thinned by autocor_slice
+        (with their iteration indices).
+
+        quantiles -- Quantiles of the log-likelihood trace to report
+        """
+        n_total = len(self.likelihoods)
+        # acceptance may only cover the most recent iterations if earlier runs did not pass it on
+        kept_acceptance = self.acceptance[max(burn_in - (n_total - len(self.acceptance)), 0):]
+        n_updated = np.sum(~np.isnan(kept_acceptance), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acceptance = np.nansum(kept_acceptance, axis=0) / n_updated
+
+        target_ess, loglike_ess = self.EffectiveSampleSize(burn_in)
+        kept_loglikes = self.likelihoods[burn_in:]
+        mode_jump_index, mode_jump_height = -1, np.nan
+        if n_total > 1000:
+            mode_jump_index, mode_jump_height = self.DetectModeJump()
+        thinned_iterations = np.arange(burn_in, n_total, max(1, autocor_slice))
+
+        return {'acceptance': acceptance,
+                'target_ess': target_ess,
+                'loglike_ess': loglike_ess,
+                'loglike_mean': np.mean(kept_loglikes),
+                'loglike_sd': np.std(kept_loglikes),
+                'loglike_quantile_levels': np.array(quantiles),
+                'loglike_quantiles': np.percentile(kept_loglikes, 100 * np.array(quantiles)),
+                'mode_jump_index': mode_jump_index,
+                'mode_jump_height': mode_jump_height,
+                'burn_in': burn_in,
+                'autocor_slice': autocor_slice,
+                'n_iterations': n_total,
+                'thinned_iterations': thinned_iterations,
+                'thinned_intensities': self.mcmc_intens[thinned_iterations],
+                'thinned_loglikes': self.likelihoods[thinned_iterations]}
+
+    def SampleCopyGibbs(self, target_i):
+        """Sample the copy number of a single non-baseline target exactly from its conditional distribution over its
+        active support, keeping track of the largest conditional probabilities for pruning."""
+        self.ploidy[target_i], copy_probs = self.joint_target.sample_copy_gibbs(
+            self.ploidy, self.intensities, target_i, self.active_support[target_i])
+        self.max_copy_probs[target_i] = np.maximum(self.max_copy_probs[target_i], copy_probs)
+
+    def PruneSupport(self):
+        """Remove copy numbers whose conditional probability for a non-baseline target has stayed below prune_threshold
+        since the last pruning from that target's active support (never removing the current copy number)."""
+        negligible = self.max_copy_probs[:self.first_baseline_i] < self.prune_threshold
+        negligible[np.asarray(self.cnv_support).reshape((1, -1)) == self.ploidy[:self.first_baseline_i].reshape((-1, 1))] = False
+        self.active_support[:self.first_baseline_i] &= ~negligible
+        self.max_copy_probs[:] = 0
+        if np.any(negligible):
+            logging.debug('Pruned {} copy number states, mean active support size is {}'.format(
+                np.sum(negligible), np.mean(np.sum(self.active_support[:self.first_baseline_i], axis=1))))
+
+    def RunMCMCUntilESS(self, min_ess, burn_in_prop=0.3, batch_iterations=5000, max_iterations=25000):
+        """Run (or continue) sampling in batches of batch_iterations until every non-baseline target has an effective
+        sample size of at least min_ess after burn-in, or until max_iterations total iterations have been run.
+        Returns the total number of iterations run.
+
+        min_ess -- Minimum effective sample size required for each non-baseline target
+        burn_in_prop -- Proportion of total iterations excluded as burn-in when computing effective sample sizes
+        batch_iterations -- Number of iterations to run between effective sample size checks
+        max_iterations -- Maximum total number of iterations
+        """
+        if self.likelihoods is None or len(self.likelihoods) == 0:
+            self.RunMCMC(min(batch_iterations, max_iterations))
+
+        while True:
+            n_total = len(self.likelihoods)
+            target_ess, loglike_ess = self.EffectiveSampleSize(int(round(burn_in_prop * n_total)))
+            min_target_ess = np.amin(target_ess[:self.first_baseline_i]) if self.first_baseline_i > 0 else loglike_ess
+            logging.info('Minimum target ESS after {} iterations: {} (log-likelihood ESS: {})'.format(
+                n_total, min_target_ess, loglike_ess))
+
+            if min_target_ess >= min_ess:
+                break
+            if n_total >= max_iterations:
+                logging.warning('Minimum target ESS of {} not reached after {} iterations'.format(min_ess, n_total))
+                break
+            self.RunMCMC(min(batch_iterations, max_iterations - n_total), self.mcmc_copy_data, self.mcmc_intens,
+                         self.likelihoods, self.acceptance)
+
+        return len(self.likelihoods)
+
+    def EffectiveSampleSize(self, burn_in=0):
+        """Returns the effective sample size of each target after burn-in (the smaller of the intensity and copy number
+        trace ESS), and the effective sample size of the log-likelihood trace.
+        Traces which are constant after burn-in (e.g. the last target intensity) are treated as uncorrelated."""
+        n_kept = self.mcmc_intens.shape[0] - burn_in
+        intens_tau = integrated_autocorrelation_time(self.mcmc_intens[burn_in:])
+        copy_tau = integrated_autocorrelation_time(self.mcmc_copy_data[:, burn_in:].T)
+        loglike_tau = integrated_autocorrelation_time(self.likelihoods[burn_in:])[0]
+
+        return n_kept / np.maximum(intens_tau, copy_tau), n_kept / loglike_tau
+
+    def AutoThinning(self, burn_in=0):
+        """Returns the thinning interval (autocor_slice) given by the largest integrated autocorrelation time across
+        non-baseline target traces and the log-likelihood trace after burn-in."""
+        n_kept = self.mcmc_intens.shape[0] - burn_in
+        target_ess, loglike_ess = self.EffectiveSampleSize(burn_in)
+        min_ess = min(np.amin(target_ess[:self.first_baseline_i]) if self.first_baseline_i > 0 else loglike_ess, loglike_ess)
+
+        return max(1, int(np.ceil(n_kept / min_ess)))
+
     def ReportMCMCData(self, burn_in=1000, autocor_slice=100):
         """Report on the posterior distribution obtained by the sampling procedure,
-           incorporating burn-in and autocorrelation corrections. """
+           incorporating burn-in and autocorrelation corrections.
+           If autocor_slice is 0 or None, it is chosen automatically from the integrated autocorrelation times. """
+        if not autocor_slice:
+            autocor_slice = self.AutoThinning(burn_in)
+            logging.info('Using automatically selected autocorrelation slice of {}'.format(autocor_slice))
+        self.burn_in = burn_in
+        self.autocor_slice = autocor_slice
 
         self.copy_posteriors = np.zeros((self.n_targets, len(self.cnv_support)))
 
+        if self.rao_blackwell:
+            self.copy_posteriors = self.RaoBlackwellPosteriors(burn_in, autocor_slice)
+            return self.copy_posteriors
+
         for target_i in xrange(self.n_targets):
             # Exclude samples before burn in and then take only every 100th sample to reduce autocorrelation.
             copy_slice = self.mcmc_copy_data[target_i][burn_in:][::autocor_slice]
@@ -96,6 +466,25 @@ class PloidyModel(object):
         # find some way to return the intensity distributions?
         return self.copy_posteriors
 
+    def RaoBlackwellPosteriors(self, burn_in=1000, autocor_slice=1, batch_size=1000):
+        """Returns copy number posteriors estimated by averaging, over the iterations retained after burn-in and
+        thinning, the conditional distribution of each non-baseline target's copy number given the intensities and
+        the other copy numbers. Baseline targets have copy number 2.
+
+        batch_size -- Number of retained iterations whose conditionals are computed together
+        """
+        copy_data = self.mcmc_copy_data[:, burn_in:][:, ::autocor_slice].T
+        intens_data = self.mcmc_intens[burn_in:][::autocor_slice]
+
+        copy_posteriors = np.zeros((self.n_targets, len(self.cnv_support)))
+        copy_posteriors[self.first_baseline_i:, list(self.cnv_support).index(2)] = 1.
+        for start in xrange(0, len(copy_data), batch_size):
+            copy_posteriors[:self.first_baseline_i] += np.sum(self.joint_target.copy_conditional_probs_rows(
+                copy_data[start:start + batch_size], intens_data[start:start + batch_size], self.first_baseline_i), axis=0)
+        copy_posteriors[:self.first_baseline_i] /= float(len(copy_data))
+
+        return copy_posteriors
+
     def LikelihoodComparison(self, norm_copy_num):
         """Returns the difference in intensity-optimized log-likelihood between the ploidy state comprised of
         individual target modes and the expected normal ploidy state (determined by norm_copy_num). Can only
@@ -112,17 +501,12 @@ class PloidyModel(object):
         normal_ploidy = norm_copy_num * np.ones(self.n_targets)
         normal_ploidy[self.first_baseline_i:] = 2.
 
-        args_map = (MAP_ploidy, True)
-        args_norm = (normal_ploidy, True)
-
-        # optimize joint log likelihood for intensities given copy numbers and data
-        optarg_map = scipy.optimize.minimize(self.joint_target.log_joint_likelihood, self.mu.flatten(),
-                                             args=args_map, tol=1e-6)
-        optarg_norm = scipy.optimize.minimize(self.joint_target.log_joint_likelihood, self.mu.flatten(),
-                                              args=args_norm, tol=1e-6)
+        # optimize joint log likelihood for intensities given copy numbers and data (both optimizations together),
+        # warm-started from the posterior mean intensities
+        _, optimized_loglikes = self.joint_target.optimize_intensities(np.array([MAP_ploidy, normal_ploidy]),
+                                                                       np.mean(self.mcmc_intens[self.burn_in:], axis=0))
 
-        log_like_diff = (self.joint_target.log_joint_likelihood(np.concatenate((optarg_map.x, [0])), MAP_ploidy) -
-                         self.joint_target.log_joint_likelihood(np.concatenate((optarg_norm.x, [0])), normal_ploidy))
+        log_like_diff = optimized_loglikes[0] - optimized_loglikes[1]
         return log_like_diff
 
     def DetectModeJump(self, window_length=201, polyorder=5, initial_offset=500):
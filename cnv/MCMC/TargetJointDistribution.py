@@ -1,36 +1,53 @@
 import logging
+import time
 import numpy as np
 
 
 class TargetJointDistribution(object):
     """Describes the joint distribution for hierarchical logistic normal model (with multinomial draws).
        Includes methods for calculating unnormalized log likelihood of joint distribution given data
-       and sampling both intensity and ploidy for single target conditional on other targets. """
+       and sampling both intensity and ploidy for single target conditional on other targets.
+       The multinomial likelihood is raised to inverse_temperature (1 for the untempered distribution).
+       inference_cache -- optional dict of arrays precomputed from mu and covariance by inference_arrays (e.g. loaded
+                          from a compiled model), used instead of computing them (unless excluding covariances) """
 
-    def __init__(self, mu, covariance, support, data=None, exclude_covar=False):
+    def __init__(self, mu, covariance, support, data=None, exclude_covar=False, inverse_temperature=1.,
+                 compute_conditionals=True, inference_cache=None):
         self.data = data
         self.support = support
         self.exclude_covar = exclude_covar
-
-        # compute all repeated matrix components for conditional covariance one time upfront
-        if not self.exclude_covar:
-            self.conditional_mats = [self.get_conditional_mvn(mu, covariance, index, return_matrix_comp=True) for index in xrange(len(mu))]
-            logging.info('Finished computing conditional matrix components')
+        self.inverse_temperature = inverse_temperature
 
         self.mu = mu
         # keep only diagonal if excluding covariances
         self.covariance = np.diag(np.diagonal(covariance)) if self.exclude_covar else covariance
-        self.mu_full = np.concatenate((mu.flatten(), [0]))
-        self.inv_covariance_full = np.concatenate((np.concatenate((np.linalg.inv(self.covariance), np.zeros((1,len(self.covariance)))), axis=0),
-                                                   np.zeros((len(self.covariance)+1,1))), axis=1)
+        # compute all repeated matrix components one time upfront
+        # (conditionals are only needed for sampling, not optimization)
+        if inference_cache is None or self.exclude_covar:
+            inference_cache = self.inference_arrays(mu, self.covariance,
+                                                    conditionals=compute_conditionals and not self.exclude_covar)
+        self.mu_full = inference_cache['mu_full']
+        self.inv_covariance_full = inference_cache['inv_covariance_full']
+        # regression coefficients on the other intensities (with a zero for itself) and variance of each intensity
+        # conditional on the others
+        self.conditional_coefs = inference_cache.get('conditional_coefs')
+        self.conditional_vars = inference_cache.get('conditional_vars')
+        # cholesky factor of the prior covariance, computed on first use by elliptical slice sampling if not cached
+        self.covariance_chol = inference_cache.get('covariance_chol')
+        # single-target copy number proposal probabilities over the support (uniform if None)
+        self.copy_proposal_probs = None
+        # time and acceptance of single-target updates are added to this TargetProfile (cnv.utilities.Profiling) if set
+        self.target_profile = None
 
     def sample(self, copies, intensities, target_index, is_baseline):
         """Given a current set of intensities, and the current ploidy state maintained in this class,
         sample a new ploidy state and intensity for a particular target using the prior distribution as the proposal distribution."""
+        if self.target_profile is not None:
+            start_time = time.time()
         intensities_proposed = np.copy(intensities)
         if not is_baseline:
             copies_proposed = np.copy(copies)
-            copy_proposed = np.random.choice(self.support, size=1)
+            copy_proposed = np.random.choice(self.support, size=1, p=self.copy_proposal_probs)
             copies_proposed[target_index] = copy_proposed
         else:
             copies_proposed = copies
@@ -42,8 +59,9 @@ class TargetJointDistribution(object):
                 mu_bar = self.mu[target_index]
                 cov_bar = self.covariance[target_index, target_index]
             else:
-                mu_bar, cov_bar = self.get_conditional_mvn(self.mu, self.covariance, target_index,
-                                                           intensities[:-1], self.conditional_mats[target_index])
+                mu_bar = self.mu_full[target_index] + np.dot(self.conditional_coefs[target_index],
+                                                             intensities[:-1] - self.mu_full[:-1])
+                cov_bar = self.conditional_vars[target_index]
 
             # sample intensity from conditional normal
             intensity_proposed = np.random.normal(mu_bar, np.sqrt(cov_bar))
@@ -63,14 +81,172 @@ class TargetJointDistribution(object):
         joint_previous = self.log_joint_likelihood(intensities, copies)
 
         log_test_ratio = joint_proposed + jump_previous - joint_previous - jump_proposed
+        if not is_baseline:
+            log_test_ratio += self.copy_proposal_log_ratio(copies[target_index], copy_proposed)
 
         # sample for new joint state and keep track of acceptance
         # Note python's "or" is equivalent to || not |, saving the RNG and exp
-        if log_test_ratio > 0 or np.random.rand() < np.exp(log_test_ratio):
+        accepted = log_test_ratio > 0 or np.random.rand() < np.exp(log_test_ratio)
+        if self.target_profile is not None:
+            self.target_profile.add(target_index, sample_seconds=time.time() - start_time, proposals=1,
+                                    accepted=int(accepted), rejected=int(not accepted))
+        if accepted:
             return copy_proposed, intensity_proposed, 1.0
 
         return copies[target_index], intensities[target_index], 0.0
 
+    def set_copy_proposal(self, preferred_copy=None, weight=0.):
+        """Bias single-target copy number proposals (in sample and sample_copy) towards preferred_copy, which is
+        proposed with additional probability weight, otherwise proposals are uniform over the support. Acceptance
+        probabilities are corrected for the bias. With no preferred_copy or weight 0 proposals are uniform."""
+        if preferred_copy is None or weight == 0:
+            self.copy_proposal_probs = None
+            return
+        support = np.asarray(self.support)
+        self.copy_proposal_probs = (1. - weight) * np.ones(len(support)) / len(support)
+        self.copy_proposal_probs[np.where(support == preferred_copy)[0][0]] += weight
+
+    def copy_proposal_log_ratio(self, copy_current, copy_proposed):
+        """Returns the log ratio of the probabilities of proposing copy_current and copy_proposed (0 if uniform)"""
+        if self.copy_proposal_probs is None:
+            return 0.
+        support = np.asarray(self.support)
+        return (np.log(self.copy_proposal_probs[np.where(support == copy_current)[0][0]]) -
+                np.log(self.copy_proposal_probs[np.where(support == copy_proposed)[0][0]]))
+
+    def copy_conditional_probs(self, copies, intensities, target_index, active_support=None):
+        """Returns the probability of each copy number in the support for a single target, conditional on the current
+        intensities, the copy numbers of all other targets and the data. Only the multinomial term depends on copy number,
+        so this only requires the total weight of the other targets.
+
+        active_support -- optional boolean mask over the support, states outside of it have probability 0
+        """
+        support = np.asarray(self.support)
+        target_weight = np.exp(intensities[target_index])
+        other_weight = np.sum(np.multiply(copies, np.exp(intensities))) - copies[target_index] * target_weight
+
+        log_probs = self.inverse_temperature * (self.data[target_index] * np.log(support) -
+                                                np.sum(self.data) * np.log(other_weight + support * target_weight))
+        if active_support is not None:
+            log_probs[~active_support] = -np.inf
+        probs = np.exp(log_probs - np.amax(log_probs))
+        return probs / np.sum(probs)
+
+    def copy_conditional_probs_rows(self, copies, intensities, n_sampled_targets):
+        """Returns the conditional probabilities of each copy number in the support (as in copy_conditional_probs) for
+        each of the first n_sampled_targets, for every row of copies and intensities at once.
+
+        copies -- n x k array of copy numbers (e.g. stored sampler states)
+        intensities -- n x k array of intensities
+        Returns an n x n_sampled_targets x len(support) array.
+        """
+        support = np.asarray(self.support).reshape((1, 1, -1))
+        target_weights = np.exp(intensities[:, :n_sampled_targets])
+        other_weights = (np.sum(copies * np.exp(intensities), axis=1).reshape((-1, 1)) -
+                         copies[:, :n_sampled_targets] * target_weights)
+
+        log_probs = self.inverse_temperature * (
+            self.data[:n_sampled_targets].reshape((1, -1, 1)) * np.log(support) -
+            np.sum(self.data) * np.log(other_weights[:, :, np.newaxis] + support * target_weights[:, :, np.newaxis]))
+        probs = np.exp(log_probs - np.amax(log_probs, axis=2)[:, :, np.newaxis])
+        return probs / np.sum(probs, axis=2)[:, :, np.newaxis]
+
+    def sample_copy_gibbs(self, copies, intensities, target_index, active_support=None):
+        """Sample a new copy number for a single target exactly from its conditional distribution over the support
+        (a Gibbs update), given the current intensities and other copy numbers.
+        Returns the sampled copy number and the conditional probabilities of the support."""
+        probs = self.copy_conditional_probs(copies, intensities, target_index, active_support)
+        return self.support[np.searchsorted(np.cumsum(probs), np.random.rand() * np.sum(probs), side='right')], probs
+
+    def sample_segment(self, copies, intensities, n_sampled_targets, max_segment_length):
+        """Given a current set of intensities and copy numbers, propose a single shared copy number for a random
+        contiguous run of (non-baseline) targets, and accept or reject it with Metropolis Hastings.
+
+        The run is chosen independently of the current state (uniform start among the first n_sampled_targets, uniform
+        length up to max_segment_length, truncated at the last sampled target), and the new copy number is drawn uniformly
+        from the support excluding the run's current copy number. The move can only be reversed when the run shares a
+        single copy number, so runs with mixed copy numbers are rejected outright; otherwise the proposal ratio is 1.
+
+        Returns the (possibly updated) copy numbers and whether the proposal was accepted."""
+        start = np.random.randint(n_sampled_targets)
+        end = min(start + np.random.randint(1, max_segment_length + 1), n_sampled_targets)
+        copy_current = copies[start]
+        if np.any(copies[start:end] != copy_current):
+            return copies, 0.0
+
+        support = np.asarray(self.support)
+        copies_proposed = np.copy(copies)
+        copies_proposed[start:end] = np.random.choice(support[support != copy_current])
+
+        log_test_ratio = (self.log_joint_likelihood(intensities, copies_proposed) -
+                          self.log_joint_likelihood(intensities, copies))
+        if log_test_ratio > 0 or np.random.rand() < np.exp(log_test_ratio):
+            return copies_proposed, 1.0
+
+        return copies, 0.0
+
+    def sample_copy(self, copies, intensities, target_index):
+        """Propose a new copy number for a single target uniformly from the support, keeping all intensities fixed,
+        and accept or reject it with Metropolis Hastings (the proposal is symmetric unless biased with set_copy_proposal).
+        Returns the (possibly updated) copy number and whether the proposal was accepted."""
+        if self.target_profile is not None:
+            start_time = time.time()
+        copies_proposed = np.copy(copies)
+        copies_proposed[target_index] = np.random.choice(self.support, p=self.copy_proposal_probs)
+
+        log_test_ratio = (self.inverse_temperature * (self.log_data_likelihood(intensities, copies_proposed) -
+                                                      self.log_data_likelihood(intensities, copies)) +
+                          self.copy_proposal_log_ratio(copies[target_index], copies_proposed[target_index]))
+        accepted = log_test_ratio > 0 or np.random.rand() < np.exp(log_test_ratio)
+        if self.target_profile is not None:
+            self.target_profile.add(target_index, sample_seconds=time.time() - start_time, proposals=1,
+                                    accepted=int(accepted), rejected=int(not accepted))
+        if accepted:
+            return copies_proposed[target_index], 1.0
+
+        return copies[target_index], 0.0
+
+    def sample_intensities_elliptical(self, copies, intensities):
+        """Update all intensities (except the last, fixed at 0) jointly given the copy numbers with elliptical slice
+        sampling (Murray, Adams & MacKay 2010). The Gaussian prior is handled exactly by moving along an ellipse through
+        the current state and a draw from the prior, so only the (tempered) multinomial likelihood is evaluated and
+        there is no step size to tune.
+        Returns the new intensities and the number of likelihood evaluations used."""
+        if self.covariance_chol is None:
+            self.covariance_chol = np.linalg.cholesky(self.covariance)
+
+        mean = self.mu.flatten()
+        current = intensities[:-1] - mean
+        prior_draw = np.dot(self.covariance_chol, np.random.randn(len(mean)))
+        log_threshold = (self.inverse_temperature * self.log_data_likelihood(intensities, copies) +
+                         np.log(np.random.rand()))
+
+        angle = np.random.uniform(0, 2 * np.pi)
+        angle_min, angle_max = angle - 2 * np.pi, angle
+        n_evaluations = 1
+        while True:
+            proposed = np.concatenate((mean + current * np.cos(angle) + prior_draw * np.sin(angle), [0]))
+            n_evaluations += 1
+            if self.inverse_temperature * self.log_data_likelihood(proposed, copies) > log_threshold:
+                return proposed, n_evaluations
+            # shrink the bracket towards the current state (angle 0), which is always acceptable
+            if angle < 0:
+                angle_min = angle
+            else:
+                angle_max = angle
+            angle = np.random.uniform(angle_min, angle_max)
+
+    def log_data_likelihood(self, intensities, copies):
+        """ Returns the (untempered) multinomial log likelihood of the subject data, up to a constant, given the full set
+            of copy numbers and full set of intensities."""
+
+        # pad intensities with 0 if length is k-1
+        if len(intensities) == len(copies) - 1:
+            intensities = np.concatenate((intensities, [0]))
+
+        return (np.sum(self.data) * -1 * np.log(np.sum(np.multiply(copies, np.exp(intensities)))) +
+                np.sum(np.multiply(self.data, (np.log(copies) + intensities))))
+
     def log_joint_likelihood(self, intensities, copies, return_neg=False):
         """ Returns unnormalized log likelihood of joint probability given subject data, full set of copy numbers and
             full set of intensities."""
@@ -79,27 +255,141 @@ class TargetJointDistribution(object):
         if len(intensities) == len(copies) - 1:
             intensities = np.concatenate((intensities, [0]))
 
-        log_joint = (np.sum(self.data) * -1 * np.log(np.sum(np.multiply(copies, np.exp(intensities)))) +
-                     np.sum(np.multiply(self.data, (np.log(copies) + intensities))) +
+        log_joint = (self.inverse_temperature * self.log_data_likelihood(intensities, copies) +
                      (-0.5 * np.dot(np.dot((intensities - self.mu_full).reshape((1,-1)), self.inv_covariance_full),
                                     (intensities - self.mu_full).reshape((-1,1)))))
         if return_neg:
             log_joint *= -1.
         return log_joint[0][0]
 
+    def optimize_intensities(self, copies, initial_intensities=None, tol=1e-8, max_iterations=50):
+        """Returns the intensities maximizing the log joint likelihood for each set of copy numbers (each row of copies),
+        along with the maximized log joint likelihoods. Uses Newton steps with the analytic gradient and negative Hessian
+        (the precision matrix plus the diagonal-minus-rank-one multinomial term) and a backtracking line search, which
+        converges since the log joint likelihood is concave in the intensities. All rows are optimized together.
+
+        copies -- n x k array of copy numbers (or single array of length k)
+        initial_intensities -- starting intensities, n x k or k array (defaults to mu)
+        tol -- Maximum absolute change in intensities at convergence
+        max_iterations -- Maximum number of Newton steps
+        """
+        copies = np.atleast_2d(copies).astype(float)
+        n_sets, k = copies.shape
+        log_copies = np.log(copies)
+
+        initial_intensities = self.mu_full if initial_intensities is None else initial_intensities
+        z = np.zeros((n_sets, k - 1)) + np.atleast_2d(initial_intensities)[:, :k - 1]
+        values = self._log_joint_rows(z, log_copies)
+
+        active = np.ones(n_sets, dtype=bool)
+        for _ in xrange(max_iterations):
+            z_active = z[active]
+            values_active = values[active]
+            grad, neg_hess = self.intensity_grad_neg_hess(z_active, log_copies[active])
+            step = np.linalg.solve(neg_hess, grad[:, :, np.newaxis])[:, :, 0]
+
+            # halve steps where the objective would decrease
+            step_size = np.ones((len(step), 1))
+            for _ in xrange(30):
+                z_new = z_active + step_size * step
+                values_new = self._log_joint_rows(z_new, log_copies[active])
+                decreased = values_new < values_active - 1e-12 * np.absolute(values_active)
+                if not np.any(decreased):
+                    break
+                step_size[decreased] *= 0.5
+
+            change = np.amax(np.absolute(z_new - z_active), axis=1)
+            z[active] = z_new
+            values[active] = values_new
+            active[np.where(active)[0][change < tol]] = False
+            if not np.any(active):
+                break
+
+        return np.concatenate((z, np.zeros((n_sets, 1))), axis=1), values
+
+    def laplace_log_marginals(self, copies, initial_intensities=None, batch_size=64):
+        """Returns the Laplace approximation to the log marginal likelihood of the data (integrating over intensities, up
+        to a constant shared by all copy number states) for each set of copy numbers (each row of copies), the optimized
+        intensities, and whether each approximation is reliable (optimization converged with a positive definite
+        negative Hessian). Rows are processed in batches of batch_size to bound memory.
+
+        copies -- n x k array of copy numbers (or single array of length k)
+        initial_intensities -- starting intensities for optimization, n x k or k array (defaults to mu)
+        """
+        copies = np.atleast_2d(copies).astype(float)
+        initial_intensities = self.mu_full if initial_intensities is None else initial_intensities
+        initial_intensities = np.zeros(copies.shape) + initial_intensities
+        log_marginals = np.zeros(len(copies))
+        optimal = np.zeros(copies.shape)
+        reliable = np.zeros(len(copies), dtype=bool)
+
+        for start in xrange(0, len(copies), batch_size):
+            rows = slice(start, start + batch_size)
+            optimal[rows], loglikes = self.optimize_intensities(copies[rows], initial_intensities[rows])
+            grad, neg_hess = self.intensity_grad_neg_hess(optimal[rows, :-1], np.log(copies[rows]))
+            sign, log_det = np.linalg.slogdet(neg_hess)
+
+            log_marginals[rows] = loglikes - 0.5 * log_det
+            reliable[rows] = (sign > 0) & (np.amax(np.absolute(grad), axis=1) < 1e-3 * max(1., np.sqrt(np.sum(self.data))))
+
+        return log_marginals, optimal, reliable
+
+    def intensity_grad_neg_hess(self, z, log_copies):
+        """Returns the gradient and negative Hessian of the log joint likelihood with respect to the (k-1 length)
+        intensities for each row of intensities z and log copy numbers"""
+        weights = log_copies + np.concatenate((z, np.zeros((len(z), 1))), axis=1)
+        probs = np.exp(weights - np.amax(weights, axis=1).reshape((-1, 1)))
+        probs = (probs / np.sum(probs, axis=1).reshape((-1, 1)))[:, :-1]
+        n_reads = np.sum(self.data)
+        precision = self.inv_covariance_full[:-1, :-1]
+
+        grad = self.inverse_temperature * (self.data[:-1] - n_reads * probs) - np.dot(z - self.mu_full[:-1], precision)
+        neg_hess = precision + self.inverse_temperature * n_reads * (
+            probs[:, :, np.newaxis] * np.eye(z.shape[1]) - probs[:, :, np.newaxis] * probs[:, np.newaxis, :])
+        return grad, neg_hess
+
+    def _log_joint_rows(self, z, log_copies):
+        """Returns the log joint likelihood for each row of (k-1 length) intensities z and log copy numbers"""
+        weights = log_copies + np.concatenate((z, np.zeros((len(z), 1))), axis=1)
+        max_weights = np.amax(weights, axis=1)
+        log_total = max_weights + np.log(np.sum(np.exp(weights - max_weights.reshape((-1, 1))), axis=1))
+        centered = z - self.mu_full[:-1]
+        return (self.inverse_temperature * (np.dot(weights, self.data) - np.sum(self.data) * log_total) -
+                0.5 * np.sum(np.dot(centered, self.inv_covariance_full[:-1, :-1]) * centered, axis=1))
+
     @staticmethod
-    def get_conditional_mvn(mu, cov, index, intensities=None, matrix_comp=None, return_matrix_comp=False):
-        """ Returns mu and covariance for conditional normal distribution for single unknown value,
-        or covariance matrix components needed to compute conditional mu and covariance.
+    def inference_arrays(mu, covariance, conditionals=True, cholesky=False):
+        """ Returns a dict of the arrays derived from mu and covariance that inference uses repeatedly:
+        mu_full and inv_covariance_full -- mu and the precision matrix padded for the final intensity (fixed at 0)
+        conditional_coefs, conditional_vars -- if conditionals, the regression coefficients of each intensity on the
+            others (k x k, with zeros on the diagonal) and its conditional variance, from the precision matrix (the
+            conditional of intensity i has variance 1 / P_ii and mean mu_i - sum_j!=i P_ij (x_j - mu_j) / P_ii)
+        covariance_chol -- if cholesky, the lower cholesky factor of covariance
+        """
+        k = len(covariance)
+        precision = np.linalg.inv(covariance)
+        inference_cache = {'mu_full': np.concatenate((np.asarray(mu).flatten(), [0])),
+                           'inv_covariance_full': np.zeros((k + 1, k + 1))}
+        inference_cache['inv_covariance_full'][:-1, :-1] = precision
+        if conditionals:
+            inference_cache['conditional_vars'] = 1. / np.diagonal(precision)
+            inference_cache['conditional_coefs'] = -precision * inference_cache['conditional_vars'].reshape((-1, 1))
+            inference_cache['conditional_coefs'][np.diag_indices(k)] = 0
+            logging.info('Finished computing conditional matrix components')
+        if cholesky:
+            inference_cache['covariance_chol'] = np.linalg.cholesky(covariance)
+        return inference_cache
+
+    @staticmethod
+    def get_conditional_mvn(mu, cov, index, intensities):
+        """ Returns mu and covariance for conditional normal distribution for single unknown value, computed directly
+        from the partitioned covariance matrix. Sampling uses the conditional regressions of inference_arrays instead;
+        this is the reference implementation they are checked against.
 
         mu -- array of len k
         cov -- k x k matrix of covariance values corresponding to mu array
         index -- index of unknown value in intensities
-        intensities -- array of len k with known intensity values (including value for unknown index),
-                       not required if only returning matrix_comp
-        matrix_comp -- dictionary containing pre-computed matrix components,
-                       cov_12, cov_22_inv, cov_bar for faster performance
-        return_matrix_comp -- will return matrix_comp dictionary, not mu and covariance
+        intensities -- array of len k with known intensity values (including value for unknown index)
 
         Quadrants are as follows (after translation of desired index to 1,1 position):
         [1,1 [.. ... 1,2 ... ..]]
@@ -110,26 +400,10 @@ class TargetJointDistribution(object):
         [..] ... ... ... ... ..]]
 
         """
+        cov_11 = cov[index, index]
+        cov_12 = np.delete(cov[index], index)
+        cov_22 = np.delete(np.delete(cov, index, axis=0), index, axis=1)
+        regression = np.linalg.solve(cov_22, cov_12)
 
-        if matrix_comp is None:
-            # split covariance matrix into quadrants and compute each one separately, storing in dict as necessary
-            cov_11 = cov[index, index]
-            matrix_comp = {'cov_12': np.concatenate((cov[index][:index], cov[index][(index+1):])).reshape((1, -1))}
-            cov_21 = np.concatenate((cov[:,index][:index], cov[:, index][(index+1):])).reshape((-1,1))
-
-            cov_22_t = np.concatenate((cov[:index, :index], cov[:index, (index+1):]), axis=1)
-            cov_22_b = np.concatenate((cov[(index+1):, :index], cov[(index+1):, (index+1):]), axis=1)
-            cov_22 = np.concatenate((cov_22_t, cov_22_b), axis=0)
-
-            matrix_comp['cov_22_inv'] = np.linalg.inv(cov_22)
-            matrix_comp['cov_bar'] = cov_11 - np.dot(np.dot(matrix_comp['cov_12'], matrix_comp['cov_22_inv']), cov_21)
-
-        if return_matrix_comp:
-            return matrix_comp
-
-        mu_1 = mu[index]
-        mu_2 = np.delete(mu, index)
-        a = np.delete(intensities, index)
-
-        mu_bar = mu_1 + np.dot(np.dot(matrix_comp['cov_12'], matrix_comp['cov_22_inv']), (a - mu_2).reshape((-1,1)))
-        return mu_bar.flatten()[0], matrix_comp['cov_bar'].flatten()[0]
+        mu_bar = np.ravel(mu)[index] + np.dot(regression, np.delete(intensities, index) - np.delete(mu, index))
+        return mu_bar, cov_11 - np.dot(regression, cov_12)
@@ -152,6 +152,25 @@ class TargetCollection(MutableSequence):
         result.merge_nearby_intervals()
         return result
 
+    @classmethod
+    def from_state(cls, targets, min_merge_dist=DEFAULT_MERGE_DISTANCE, is_sorted=False, is_merged=False):
+        """
+        Restores a TargetCollection of targets in the given order without sorting or merging them,
+        e.g. when loading a serialized collection.
+
+        :param targets: a list of Target objects
+        :param min_merge_dist: The minimum distance the targets were merged with
+        :param is_sorted: Whether the collection was sorted
+        :param is_merged: Whether the collection was merged
+        :return: A TargetCollection of the targets with the given state
+        """
+        result = cls(min_merge_dist=min_merge_dist)
+        for t in targets:
+            result.append(t)
+        result._sorted = is_sorted
+        result._merged = is_merged
+        return result
+
     ## List method implementations, we override this to guarantee we maintain
     # the sorted and merged state
     def __len__(self):
@@ -1,5 +1,6 @@
 import cPickle
 import logging
+import os
 import sys
 
 import numpy as np
@@ -7,14 +8,19 @@ import pandas as pd
 from mando import command
 from mando import main
 
-from LogisticNormal import hln_EM
+from LogisticNormal import hln_EM, hln_minibatch_EM
 from MCMC.ConvergenceAnalysis import ConvergenceAnalysis
+from MCMC.LaplaceScreen import LaplaceScreen
 from MCMC.VisualizeMCMC import VisualizeMCMC
 from cnv import __version__
 from cnv.Targets.TargetCollection import DEFAULT_MERGE_DISTANCE
 from cnv.Targets.TargetCollection import TargetCollection
 from cnv.Targets.Target import Target
 from cnv.utilities import SimulateData
+from cnv.utilities.MatrixQC import matrix_qc
+from cnv.utilities.Metrics import Metrics
+from cnv.utilities.Profiling import Profile
+from compiled_model import read_compiled_model, write_compiled_model
 from coverage_matrix import CoverageMatrix
 from hln_parameters import HLN_Parameters
 
@@ -24,6 +30,48 @@ def configure_logging(verbose=0):
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                         datefmt='%m/%d/%Y %I:%M:%S %p', level=level)
 
+def training_targets(targets_params, use_baseline_sum=False):
+    """ Returns the targets to train on and their coverage matrix column labels, with the baseline targets replaced by
+    a single BaselineSum target if use_baseline_sum """
+    targets = targets_params['full_targets']
+    targetCols = [target.label for target in targets]
+    if use_baseline_sum:
+        # assuming all targets listed before baselines -- get index of first one
+        first_baseline_i = targets.t_index(next(target for target in targets if 'Baseline' in target.label))
+        targetCols = targetCols[:first_baseline_i] + ['BaselineSum']
+        # we can slice the TargetCollection
+        targets = targets_params['full_targets'][:first_baseline_i]
+
+        chrom_span = '{}-{}'.format(targets_params['full_targets'][first_baseline_i].chrom,
+                                    targets_params['full_targets'][-1].chrom)
+        sum_target = Target(chrom_span, None, None, 'BaselineSum')
+        targets.append(sum_target)
+    return targets, targetCols
+
+def report_matrix_qc(qc_df, cohort):
+    """ Log problems found by quality control of a coverage matrix, returning the number of errors (missing targets)
+    that prevent training """
+    errors = 0
+    for column in cohort['missing_columns']:
+        logging.error('Coverage matrix is missing target {}.'.format(column))
+        errors += 1
+    # samples with missing values, besides the missing columns
+    for sample, row in qc_df[qc_df['missing_targets'] > len(cohort['missing_columns'])].iterrows():
+        logging.error('Sample {} is missing coverage for {} targets.'.format(sample, row['missing_targets']))
+        errors += 1
+    for sample, row in qc_df[qc_df['zero_targets'] > 0].iterrows():
+        logging.warning('Sample {} has no coverage for {} targets.'.format(sample, row['zero_targets']))
+    if cohort['target_base_mean'] is not None:
+        logging.info('Coefficient of variation of '
+                     'target-to-baseline-sum ratio: {}'.format(cohort['target_base_sd'] / cohort['target_base_mean']))
+    n_flagged = np.sum(qc_df['flagged'])
+    if n_flagged > 0:
+        logging.warning('{} of {} samples flagged by QC ({} with low correlation to the cohort mean intensities, {} '
+                        'with outlying target-to-baseline-sum ratios).'.format(
+                            n_flagged, len(qc_df), np.sum(qc_df['low_correlation']),
+                            np.sum(qc_df['target_base_outlier'])))
+    return errors
+
 @command('version')
 def version():
     """Provide the current version"""
@@ -33,7 +81,7 @@ def version():
 
 @command('create-matrix')
 def create_matrix(targetsBedfile, bamfilesFofn, outputFile, targetArgfile=None, unwanted_filters=None,
-                  min_dist=DEFAULT_MERGE_DISTANCE, verbose=0):
+                  min_dist=DEFAULT_MERGE_DISTANCE, metrics_file=None, profile=False, verbose=0):
     """ Create coverage_matrix from given bamfilesFofn.
 
     :param targetsBedfile: Source of targets, and that may include baseline intervals
@@ -45,6 +93,10 @@ def create_matrix(targetsBedfile, bamfilesFofn, outputFile, targetArgfile=None,
     :param min_dist: Any two intervals that are closer than this distance will be merged together,
         and any read pairs with insert lengths greater than this distance will be skipped. The default value of 629
         was derived to be one less than the separation between intervals for Exon 69 and Exon 70 of DMD.
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
+    :param profile: Profile hot paths, writing a pstats dump to {outputFile without extension}_profile.pstats and a
+                    table of per-target read fetch time, reads scanned and reads rejected by each filter to
+                    {outputFile without extension}_profile.tsv
     :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
 
     Valid filter names: unmapped, MAPQ_below_60, PCR_duplicate, mate_is_unmapped, not_proper_pair, tandem_pair,
@@ -53,6 +105,7 @@ def create_matrix(targetsBedfile, bamfilesFofn, outputFile, targetArgfile=None,
     """
     # set appropriate logging level
     configure_logging(verbose)
+    metrics = Metrics('create-matrix')
 
     if bamfilesFofn.endswith('.bam'):
         bamfilesFofn = bamfilesFofn.split(',')
@@ -70,29 +123,48 @@ def create_matrix(targetsBedfile, bamfilesFofn, outputFile, targetArgfile=None,
             cPickle.dump(targets_params, f, protocol=cPickle.HIGHEST_PROTOCOL)
 
     matrix_instance = CoverageMatrix(unwanted_filters=unwanted_filters)
-    coverage_matrix_df = matrix_instance.create_coverage_matrix(bamfilesFofn, targets)
+    if profile:
+        profiler = Profile()
+        matrix_instance.target_profile = profiler.target_profile('coverage', [target.label for target in targets])
+        profiler.enable()
+    with metrics.phase('coverage', matrix_instance.scan_counters) as counters:
+        coverage_matrix_df = matrix_instance.create_coverage_matrix(bamfilesFofn, targets)
+        counters['samples'] = len(coverage_matrix_df)
+        counters['targets'] = len(targets)
+
+    if profile:
+        profiler.disable()
+        profiler.write(os.path.splitext(outputFile)[0])
 
     coverage_matrix_df.to_csv(outputFile)
     logging.info('Finished creating {}'.format(outputFile))
+    metrics.write(metrics_file)
 
 
 @command('evaluate-sample')
 def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=10000, burn_in_prop=0.3, autocor_slice=50,
                     exclude_covar=False, no_gelman_rubin=False, num_chains=4, use_single_process=False, max_iterations=25000,
-                    threshold_loglike_diff=-30, norm_cutoff=0.5, verbose=0):
+                    threshold_loglike_diff=-30, norm_cutoff=0.5, min_ess=0, segment_rate=0., max_segment_length=10,
+                    copy_update='metropolis', prune_threshold=1e-8, parallel_tempering=False, num_temperatures=4,
+                    max_temperature=2., swap_interval=20, fast_screen=False, init_from_mode=False, init_overdispersion=2.,
+                    intensity_update='single', rao_blackwell=False, adaptive_scan=False, scan_floor=0.5,
+                    estimate_norm_copy_num=False, norm_proposal_weight=0.5, collapse_baseline=False,
+                    metrics_file=None, diagnostics=False, profile=False, verbose=0):
     """Test for copy number variation in a given sample
 
     :param subjectFilePath: Path to subject bam (.bam.bai must be in same directory) or coverage count matrix
                             (in csv format) (targets must match those in parametersFile)
     :param parametersFile: Pickled file containing a dict with CoverageMatrix arguments and
-                           instance of HLN_Parameters (mu, covariance, targets)
+                           instance of HLN_Parameters (mu, covariance, targets), or a compiled model directory
+                           written by compile-model
     :param outputPrefix: Output file name without extension -- generates three output files (.txt
                         file of posteriors, _summary.txt, and .pdf with stacked bar chart)
     :param n_iterations: The number of MCMC iterations desired (should be divisible by 100) [10000]
     :param burn_in_prop: The proportion of MCMC iterations to exclude as part of burn-in period
                          (should be divisible by 0.05) [0.3]
     :param autocor_slice: The autocorrelation slice coefficient to use when reporting posterior probabilities
-                          ie. only every 50th iteration will be kept [50]
+                          ie. only every 50th iteration will be kept, 0 selects it automatically from the
+                          integrated autocorrelation times of the chain [50]
     :param exclude_covar: Exclude covariance estimates in calculations of conditional and joint probabilities
     :param no_gelman_rubin: Will not perform Gelman-Rubin convergence analysis before metastability analysis
     :param num_chains: Number of independent chains to use during G-R analysis, will use separate process for each unless
@@ -104,6 +176,56 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
                                    with normal ploidy state [-30]
     :param norm_cutoff: The cutoff for posterior probability of the normal target copy number, below
                         which targets are flagged [0.5]
+    :param min_ess: Minimum effective sample size for every non-baseline target, if greater than 0 sampling continues
+                    until it is reached (up to max_iterations) [0]
+    :param segment_rate: Rate (between 0 and 1) of additional proposals of a shared copy number for a random contiguous
+                         run of targets, per non-baseline target per iteration [0]
+    :param max_segment_length: Maximum number of contiguous targets in a segment proposal [10]
+    :param copy_update: Copy number update used by the sampler, either metropolis (joint proposal with intensity from the
+                        prior) or gibbs (exact sampling from the conditional over cnv_support, then a separate intensity
+                        update) [metropolis]
+    :param prune_threshold: With gibbs copy updates, copy numbers with conditional probability below this threshold
+                            are adaptively pruned from a target's support [1e-8]
+    :param parallel_tempering: Run n_iterations of replica exchange sampling over tempered chains (in parallel unless
+                               --use_single_process specified) instead of G-R and metastability analysis
+    :param num_temperatures: Number of tempered chains used in parallel tempering, including the untempered chain [4]
+    :param max_temperature: Temperature of the hottest chain used in parallel tempering [2]
+    :param swap_interval: Number of iterations between swap moves in parallel tempering [20]
+    :param fast_screen: Approximate copy number posteriors with Laplace approximations over the normal ploidy state and
+                        single-target changes to it first, and only run MCMC if any target has normal copy number
+                        posterior below norm_cutoff or the approximation is unreliable
+    :param init_from_mode: Initialize chains around a data-driven ploidy guess and the conditional mode of intensities
+                           given it instead of drawing from the priors, allowing a shorter burn-in
+    :param init_overdispersion: Scale of initial intensity spread around the mode, relative to the approximate posterior
+                                spread [2]
+    :param intensity_update: Intensity update used by the sampler, either single (one target at a time from the
+                             conditional prior) or elliptical (all intensities jointly by elliptical slice sampling,
+                             interleaved with copy number only updates) [single]
+    :param rao_blackwell: Estimate copy number posteriors by averaging each target's conditional copy number distribution
+                          over retained iterations instead of counting sampled copy numbers (lower variance, so fewer
+                          iterations and smaller autocor_slice values can be used)
+    :param adaptive_scan: Update targets in random order each iteration, weighted towards targets with uncertain copy
+                          numbers, with weights adapted during the burn-in period and then frozen
+    :param scan_floor: Minimum adaptive scan weight of each target, relative to a weight of up to 1 added for
+                       copy number uncertainty [0.5]
+    :param estimate_norm_copy_num: Estimate the normal copy number of X chromosome targets (sex of sample) before sampling,
+                                   from Laplace approximations and the target-to-baseline-sum ratio statistics of the
+                                   training samples (if trained with --use_baseline_sum, assuming female training
+                                   samples), to initialize chains and bias copy number proposals. Sampling is rerun if
+                                   the sampled posteriors disagree with the estimate
+    :param norm_proposal_weight: With estimate_norm_copy_num, additional probability of proposing the estimated normal
+                                 copy number in copy number proposals [0.5]
+    :param collapse_baseline: Collapse individual baseline targets of the model into a single baseline sum target
+                              (approximating the sum of their intensities as log normal) so only non-baseline targets
+                              and the baseline sum are sampled
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
+    :param diagnostics: Write MCMC mixing diagnostics to {outputPrefix}_diagnostics.npz (per-target acceptance rates,
+                        effective sample sizes and G-R PSRF, log-likelihood trace summaries, the largest detected mode
+                        jump, and intensity and log-likelihood traces thinned by autocor_slice)
+    :param profile: Profile hot paths, writing a pstats dump to {outputPrefix}_profile.pstats and a table of per-target
+                    costs (read fetch time, reads scanned and rejected for bam input, and time and accepted and
+                    rejected proposals of single-target updates) to {outputPrefix}_profile.tsv. Implies
+                    --use_single_process
     :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
 
     """
@@ -111,23 +233,39 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
     configure_logging(verbose)
 
     logging.info("Running evaluate samples")
-
-    # Read the parameters file.
-    targets_params = cPickle.load(open(parametersFile, 'rb'))
-    full_targets = targets_params['full_targets']
-    targets_to_test = targets_params['parameters'].targets
-
-    # Parse subject file
-    if subjectFilePath.endswith('.csv'):
-        subject_df = pd.read_csv(subjectFilePath, index_col=0)
-    else:
-        subject_df = CoverageMatrix(unwanted_filters=targets_params['unwanted_filters']).create_coverage_matrix([subjectFilePath], full_targets)
-    subject_id = subject_df['sample'][0]
-    if len(subject_df) > 1:
-        logging.warning('Multiple samples in provided CSV. Evaluating only first sample {}.'.format(subject_id))
-    target_columns = [target.label for target in targets_to_test]
-    # evaluate only first subject if multiple samples in provided CSV
-    subject_data = subject_df.iloc[0][target_columns].values.astype('float').flatten()
+    metrics = Metrics('evaluate-sample')
+    if profile:
+        # costs of updates run in pool processes would not be collected
+        use_single_process = True
+        profiler = Profile()
+        profiler.enable()
+
+    with metrics.phase('load') as counters:
+        # Read the parameters file, or memory map a compiled model.
+        if os.path.isdir(parametersFile):
+            targets_params = read_compiled_model(parametersFile)
+        else:
+            targets_params = cPickle.load(open(parametersFile, 'rb'))
+        counters['compiled_model'] = os.path.isdir(parametersFile)
+        full_targets = targets_params['full_targets']
+        hln_parameters = targets_params['parameters']
+        targets_to_test = hln_parameters.targets
+
+        # Parse subject file
+        if subjectFilePath.endswith('.csv'):
+            subject_df = pd.read_csv(subjectFilePath, index_col=0)
+        else:
+            matrix_instance = CoverageMatrix(unwanted_filters=targets_params['unwanted_filters'])
+            if profile:
+                matrix_instance.target_profile = profiler.target_profile('coverage', [target.label for target in full_targets])
+            subject_df = matrix_instance.create_coverage_matrix([subjectFilePath], full_targets)
+            counters.update(matrix_instance.scan_counters())
+        subject_id = subject_df['sample'][0]
+        if len(subject_df) > 1:
+            logging.warning('Multiple samples in provided CSV. Evaluating only first sample {}.'.format(subject_id))
+        target_columns = [target.label for target in targets_to_test]
+        # evaluate only first subject if multiple samples in provided CSV
+        subject_data = subject_df.iloc[0][target_columns].values.astype('float').flatten()
 
     # Note that having 0 in support causes problems in the joint probability calculation if off-target reads exist
     cnv_support = np.array([1e-10, 1, 2, 3]).astype(float)
@@ -141,6 +279,12 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
                                                                                            targets_to_test[i].label else 'individual'),
                                                                                            len(full_targets) - first_baseline_i))
             break
+    if collapse_baseline and len(targets_to_test) - first_baseline_i > 1:
+        hln_parameters = hln_parameters.collapse_baseline(first_baseline_i)
+        targets_to_test = hln_parameters.targets
+        target_columns = [target.label for target in targets_to_test]
+        subject_data = np.concatenate((subject_data[:first_baseline_i], [np.sum(subject_data[first_baseline_i:])]))
+        logging.info('Collapsed individual baseline targets into a single baseline sum target')
     # Report non-baseline target coverage
     logging.info('Non-baseline target coverage: {}\n'.format(np.sum(subject_data[:first_baseline_i])))
 
@@ -159,7 +303,7 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
         baseline_sum_i = len(targets_to_test)
 
     # Check and report test sample and reference set correlation (for non-baseline-sum targets)
-    target_xvals = np.exp(np.concatenate((targets_params['parameters'].mu.flatten(), [0]))[:baseline_sum_i])
+    target_xvals = np.exp(np.concatenate((hln_parameters.mu.flatten(), [0]))[:baseline_sum_i])
     control_intensities = target_xvals / np.sum(target_xvals)
 
     sample_intensities = subject_data[:baseline_sum_i] / np.sum(subject_data[:baseline_sum_i])
@@ -170,18 +314,65 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
         logging.warning('Low correlation between test and training samples.\n'
                         'Results likely to be inaccurate if correlation < 0.9.')
 
-    # ploidy model (and sampling) actually run within convergence analysis instance
-    convergence_analysis = ConvergenceAnalysis(cnv_support, targets_params['parameters'], subject_data, first_baseline_i,
-                                               exclude_covar, n_iterations, burn_in_prop, use_single_process)
-    if not no_gelman_rubin:
-        convergence_analysis.gelman_rubin_analysis(num_chains, len(targets_to_test), max_iterations=max_iterations)
-
-    # Check whether result is far from optimal mode (assuming normal ploidy) and repeat to avoid metastability error
-    # note that this will only catch metastabality errors that lead to false positives, not false negatives
-    copy_posteriors, loglike_diff = convergence_analysis.metastability_error_analysis(thresh_loglike_diff=threshold_loglike_diff,
-                                                                                      autocor_slice=autocor_slice,
-                                                                                      max_iterations=max_iterations)
-    norm_copy_num = convergence_analysis.norm_copy_num
+    estimated_norm_copy_num = None
+    screened = False
+    if fast_screen or estimate_norm_copy_num:
+        with metrics.phase('screen'):
+            laplace_screen = LaplaceScreen(cnv_support, hln_parameters, subject_data, first_baseline_i, exclude_covar)
+            if estimate_norm_copy_num:
+                estimated_norm_copy_num, norm_probs = laplace_screen.estimate_norm_copy_num(
+                    control_tb_mean, targets_params.get('target_base_sd', None))
+                logging.info('Estimated normal copy number before sampling: {} (probabilities of {}: {})'.format(
+                    estimated_norm_copy_num, laplace_screen.candidate_norm_copy_nums(), norm_probs))
+
+            if fast_screen:
+                copy_posteriors, norm_copy_num, reliable = laplace_screen.screen(estimated_norm_copy_num)
+                norm_index = np.where(cnv_support == norm_copy_num)[0][0]
+                if reliable and np.all(copy_posteriors[:first_baseline_i, norm_index] >= norm_cutoff):
+                    logging.info('Fast screen found no targets with normal copy number posterior below {}, skipping MCMC'.format(norm_cutoff))
+                    screened = True
+                    # the normal state is the most probable state in the screen
+                    loglike_diff = 0.
+                else:
+                    logging.info('Fast screen {}, running MCMC'.format('flagged targets' if reliable else 'approximation unreliable'))
+
+    if not screened:
+        # ploidy model (and sampling) actually run within convergence analysis instance
+        with metrics.phase('model_setup'):
+            convergence_analysis = ConvergenceAnalysis(cnv_support, hln_parameters, subject_data, first_baseline_i,
+                                                       exclude_covar, n_iterations, burn_in_prop, use_single_process,
+                                                       segment_rate=segment_rate, max_segment_length=max_segment_length,
+                                                       copy_update=copy_update, prune_threshold=prune_threshold,
+                                                       init_from_mode=init_from_mode, init_overdispersion=init_overdispersion,
+                                                       intensity_update=intensity_update, rao_blackwell=rao_blackwell,
+                                                       scan='adaptive' if adaptive_scan else 'systematic',
+                                                       scan_adapt_iterations=int(round(burn_in_prop * n_iterations)),
+                                                       scan_floor=scan_floor, norm_copy_num=estimated_norm_copy_num,
+                                                       norm_proposal_weight=norm_proposal_weight)
+        ploidy_model = convergence_analysis.ploidy_model
+        if profile:
+            ploidy_model.joint_target.target_profile = profiler.target_profile('sampling', target_columns)
+        if parallel_tempering:
+            # tempered chains replace both convergence analysis and reruns for metastability error
+            with metrics.phase('parallel_tempering', ploidy_model.WorkCounters):
+                copy_posteriors, loglike_diff = convergence_analysis.parallel_tempering_analysis(num_temperatures, max_temperature,
+                                                                                                 swap_interval,
+                                                                                                 thresh_loglike_diff=threshold_loglike_diff,
+                                                                                                 autocor_slice=autocor_slice)
+        else:
+            if not no_gelman_rubin:
+                with metrics.phase('gelman_rubin', ploidy_model.WorkCounters) as counters:
+                    convergence_analysis.gelman_rubin_analysis(num_chains, len(targets_to_test), max_iterations=max_iterations)
+                    counters['chains'] = num_chains
+
+            # Check whether result is far from optimal mode (assuming normal ploidy) and repeat to avoid metastability error
+            # note that this will only catch metastabality errors that lead to false positives, not false negatives
+            # (sampling, reruns and likelihood comparisons are recorded as separate phases)
+            copy_posteriors, loglike_diff = convergence_analysis.metastability_error_analysis(thresh_loglike_diff=threshold_loglike_diff,
+                                                                                              autocor_slice=autocor_slice,
+                                                                                              max_iterations=max_iterations,
+                                                                                              min_ess=min_ess, metrics=metrics)
+        norm_copy_num = convergence_analysis.norm_copy_num
     logging.info('Evaluating with normal copy number: {}'.format(norm_copy_num))
 
     logging.info('Difference in optimized mode and expected ploidy likelihoods is {}'.format(loglike_diff))
@@ -192,11 +383,26 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
     mcmc_df['chrom'] = [target.chrom for target in targets_to_test]
     mcmc_df['start'] = [target.start for target in targets_to_test]
     mcmc_df['end'] = [target.end for target in targets_to_test]
+    if screened:
+        mcmc_df['ESS'] = np.nan
+    else:
+        mcmc_df['ESS'], loglike_ess = ploidy_model.EffectiveSampleSize(ploidy_model.burn_in)
+        logging.info('Effective sample size of log-likelihood: {}, minimum target effective sample size: {}'.format(
+            loglike_ess, np.amin(mcmc_df['ESS'][:first_baseline_i]) if first_baseline_i > 0 else None))
+        logging.info('Single-target updates per effective sample: {}'.format(
+            ploidy_model.UpdatesPerEffectiveSample(ploidy_model.burn_in)))
     mcmc_df.to_csv('{}.txt'.format(outputPrefix), sep='\t')
-
-    # Create stacked bar plot and write to pdf
-    visualize_instance = VisualizeMCMC(cnv_support, target_columns, copy_posteriors[:first_baseline_i])
-    visualize_instance.visualize_copy_numbers('Copy Number Posteriors for Subject {}'.format(subject_id), '{}.pdf'.format(outputPrefix))
+    if diagnostics:
+        if screened:
+            logging.info('MCMC skipped after fast screen, no diagnostics written')
+        else:
+            np.savez_compressed('{}_diagnostics.npz'.format(outputPrefix), targets=np.array(target_columns),
+                                **convergence_analysis.diagnostics())
+
+    with metrics.phase('plot'):
+        # Create stacked bar plot and write to pdf
+        visualize_instance = VisualizeMCMC(cnv_support, target_columns, copy_posteriors[:first_baseline_i])
+        visualize_instance.visualize_copy_numbers('Copy Number Posteriors for Subject {}'.format(subject_id), '{}.pdf'.format(outputPrefix))
 
     # Log targets which seem to have abnormal copy numbers
     norm_index = np.where(cnv_support == norm_copy_num)[0][0]
@@ -258,10 +464,15 @@ def evaluate_sample(subjectFilePath, parametersFile, outputPrefix, n_iterations=
     with open('{}_summary.txt'.format(outputPrefix), 'w') as outfile_main:
         ## outfile_main.write('###### Metadata here\n')
         reporting_df.to_csv(outfile_main, index=False, sep='\t')
+    if profile:
+        profiler.disable()
+        profiler.write(outputPrefix)
+    metrics.write(metrics_file)
 
 @command('train-model')
 def train_model(targetsFile, coverageMatrixFile, outputFile, use_baseline_sum=False, max_iterations=150, tol=1e-8,
-                fit_diag_only=False, verbose=0):
+                fit_diag_only=False, jobs=1, e_step='batched', warm_start=None, accelerate=False, chunk_size=0,
+                heldout_samples=100, qc_file=None, metrics_file=None, verbose=0):
     """Train a model that detects copy number variation.
 
     :param targetsFile: Pickled file containing target intervals and CoverageMatrix arguments
@@ -272,81 +483,206 @@ def train_model(targetsFile, coverageMatrixFile, outputFile, use_baseline_sum=Fa
     :param max_iterations: Maximum number of iterations to use during EM routine before termination [150]
     :param tol: Tolerance for convergence at which to terminate during EM routine [1e-8]
     :param fit_diag_only: Returns diagonal matrix after fitting only variances (all off-diag 0)
+    :param jobs: Number of processes to distribute the per-sample conditional mode computations of each EM iteration
+                 across [1]
+    :param e_step: Compute the conditional modes of batches of samples together with vectorized Newton-Raphson
+                   iterations (batched), or one sample at a time (single) [batched]
+    :param warm_start: Pickled model file trained on the same targets (e.g. before adding samples) to start EM from,
+                       along with the conditional modes it cached for samples that are in both, so only new samples
+                       are computed from scratch
+    :param accelerate: Accelerate EM convergence with SQUAREM extrapolation, falling back to plain EM steps when an
+                       extrapolation lowers the likelihood or isn't a valid covariance
+    :param chunk_size: Stream the coverage matrix in chunks of this many samples instead of loading it, training with
+                       mini-batch EM (one update per chunk) in a single process without acceleration, so memory is
+                       bounded by the chunk size. max_iterations limits the passes over the matrix, and training stops
+                       once the held-out log-likelihood improves by less than tol (relative). 0 loads the whole
+                       matrix [0]
+    :param heldout_samples: Number of samples held out of training to monitor convergence with when streaming [100]
+    :param qc_file: Path to write the per-sample QC table of the coverage matrix to, as written by qc-matrix
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
     :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
     """
     # set appropriate logging level
     configure_logging(verbose)
     logging.info("Running sample training.")
+    metrics = Metrics('train-model')
     if fit_diag_only:
         logging.info('Fitting only diagonal variance terms.')
 
     # Read the targets file.
     with open(targetsFile) as f:
         targets_params = cPickle.load(f)
-        targets = targets_params['full_targets']
 
-    # Read the coverageMatrixFile.
-    coverage_df = pd.read_csv(coverageMatrixFile, header=0, index_col=0)
+    # Read the coverageMatrixFile, or chunks of it each time it's needed if streaming.
+    if chunk_size:
+        read_chunks = lambda: pd.read_csv(coverageMatrixFile, header=0, index_col=0, chunksize=chunk_size)
+    else:
+        coverage_df = pd.read_csv(coverageMatrixFile, header=0, index_col=0)
+        read_chunks = lambda: [coverage_df]
 
     # Get the appropriate target columns
-    targetCols = [target.label for target in targets]
-    if use_baseline_sum:
-        # assuming all targets listed before baselines -- get index of first one
-        first_baseline_i = targets.t_index(next(target for target in targets if 'Baseline' in target.label))
-        targetCols = targetCols[:first_baseline_i] + ['BaselineSum']
-        # we can slice the TargetCollection
-        targets = targets_params['full_targets'][:first_baseline_i]
-
-        chrom_span = '{}-{}'.format(targets_params['full_targets'][first_baseline_i].chrom,
-                                    targets_params['full_targets'][-1].chrom)
-        sum_target = Target(chrom_span, None, None, 'BaselineSum')
-        targets.append(sum_target)
-
-        # Include info about distribution of target:baseline_sum coverage across samples
-        target_sums = np.sum(coverage_df[targetCols[:first_baseline_i]].values.astype(float), axis=1)
-        target_base_ratios = target_sums.flatten() / coverage_df['BaselineSum'].values.flatten()
-        target_base_mean = np.mean(target_base_ratios)
-        target_base_sd = np.std(target_base_ratios)
-        logging.info('Coefficient of variation of '
-                     'target-to-baseline-sum ratio: {}'.format(target_base_sd / target_base_mean))
-        targets_params['target_base_mean'] = target_base_mean
-        targets_params['target_base_sd'] = target_base_sd
+    targets, targetCols = training_targets(targets_params, use_baseline_sum)
 
     # Run some sanity checks.
-    errors = 0
-    for index, subject in coverage_df.iterrows():
-        # Every subject has coverage for every target.
-        for targetCol in targetCols:
-            if targetCol not in subject:
-                logging.error('Sample {} is missing target {}.'.format(subject['sample'], targetCol))
-                errors += 1
-            elif subject[targetCol] == 0:
-                logging.warning('Sample {} has no coverage for target {}.'.format(subject['sample'], targetCol))
-    if errors > 0:
+    with metrics.phase('qc') as counters:
+        qc_df, cohort = matrix_qc(read_chunks, targetCols)
+        counters['samples'] = cohort['samples']
+        counters['flagged_samples'] = int(np.sum(qc_df['flagged']))
+    if qc_file is not None:
+        qc_df.to_csv(qc_file, sep='\t')
+    if report_matrix_qc(qc_df, cohort) > 0:
         sys.exit(1)
 
+    if use_baseline_sum:
+        # Include info about distribution of target:baseline_sum coverage across samples
+        targets_params['target_base_mean'] = cohort['target_base_mean']
+        targets_params['target_base_sd'] = cohort['target_base_sd']
+
+    initial_mu = initial_cov = initial_mu_hat = None
+    if warm_start is not None:
+        with open(warm_start) as f:
+            warm_params = cPickle.load(f)
+        if [target.label for target in warm_params['parameters'].targets] != targetCols:
+            logging.error('Warm start model {} was not trained on the same targets.'.format(warm_start))
+            sys.exit(1)
+        initial_mu = warm_params['parameters'].mu
+        initial_cov = warm_params['parameters'].covariance
+        if chunk_size:
+            # no per-sample state is kept when streaming
+            logging.info('Warm starting from {}.'.format(warm_start))
+        else:
+            cached_modes = warm_params.get('conditional_modes', pd.DataFrame(columns=targetCols[:-1]))
+            cached_modes = cached_modes[~cached_modes.index.duplicated()].reindex(coverage_df['sample'])
+            initial_mu_hat = cached_modes.values.astype(float).T
+            logging.info('Warm starting from {} with cached conditional modes for {} of {} samples.'.format(
+                warm_start, np.sum(cached_modes.notnull().all(axis=1)), len(coverage_df)))
+
+    if chunk_size:
+        # mini-batch EM runs in this process, and its stepwise updates aren't extrapolated
+        if jobs != 1:
+            logging.warning('--jobs is not supported with --chunk_size, training in a single process.')
+            jobs = 1
+        if accelerate:
+            logging.warning('--accelerate is not supported with --chunk_size, training without SQUAREM.')
+            accelerate = False
+
     # Compute the logistic normal hyperparameters.
     # Omit the non-target columns.
-    mu, covariance = hln_EM(coverage_df[targetCols].values.astype(float), max_iterations=max_iterations,
-                            tol=tol, fit_diag_only=fit_diag_only)
+    em_stats = {}
+    with metrics.phase('em') as counters:
+        if chunk_size:
+            mu, covariance = hln_minibatch_EM(
+                lambda: (chunk[targetCols].values.astype(float) for chunk in read_chunks()),
+                n_heldout=heldout_samples, max_passes=max_iterations, tol=tol, fit_diag_only=fit_diag_only,
+                stats=em_stats, e_step=e_step, initial_mu=initial_mu, initial_cov=initial_cov)
+            modes = None
+            counters['training_samples'] = em_stats['training_subjects']
+            counters['heldout_samples'] = heldout_samples
+            counters['heldout_loglikes'] = em_stats['heldout_loglikes']
+        else:
+            mu, covariance, modes = hln_EM(coverage_df[targetCols].values.astype(float),
+                                           max_iterations=max_iterations, tol=tol, fit_diag_only=fit_diag_only,
+                                           stats=em_stats, jobs=jobs, e_step=e_step, initial_mu=initial_mu,
+                                           initial_cov=initial_cov, initial_mu_hat=initial_mu_hat,
+                                           return_modes=True, accelerate=accelerate)
+            counters['training_samples'] = len(coverage_df)
+            if accelerate:
+                counters['em_extrapolations'] = em_stats['extrapolations']
+                counters['em_rejected_extrapolations'] = em_stats['rejected_extrapolations']
+                counters['em_iterations_saved'] = em_stats['iterations_saved']
+        counters['em_iterations'] = em_stats['iterations']
+        counters['em_iteration_seconds'] = em_stats['iteration_seconds']
+        counters['targets'] = len(targetCols)
+        counters['jobs'] = jobs
+        counters['warm_start'] = warm_start is not None
 
     # Pickle the intervals, hyperparameters and CoverageMatrix arguments into the outputFile.
     logging.info('Trained for {} total targets'.format(len(targets)))
     logging.info('Writing intervals plus hyperparameters to file {}.'.format(outputFile))
     targets_params['parameters'] = HLN_Parameters(targets, mu, covariance)
+    if modes is not None:
+        # cache of each sample's conditional modes, for warm starting later training
+        targets_params['conditional_modes'] = pd.DataFrame(modes.T, index=coverage_df['sample'].values,
+                                                           columns=targetCols[:-1])
 
     with open(outputFile, 'w') as f:
         cPickle.dump(targets_params, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    metrics.write(metrics_file)
+
+@command('qc-matrix')
+def qc_matrix(targetsFile, coverageMatrixFile, outputFile, use_baseline_sum=False, chunk_size=0, metrics_file=None,
+              verbose=0):
+    """Check a coverage matrix before training, writing a tab separated table of per-sample QC: missing and zero
+    coverage targets, total coverage, correlation with the cohort mean target intensities, target-to-baseline-sum
+    ratio z-scores, and outlier flags (correlation below 0.9 or |z-score| above 1.5, as evaluate-sample warns).
+
+    :param targetsFile: Pickled file containing target intervals and CoverageMatrix arguments
+    :param coverageMatrixFile: CSV file containing coverage data for all samples of interest
+    :param outputFile: Output file name for the per-sample QC table
+    :param use_baseline_sum: Check the sum of baseline targets, instead of each baseline target individually
+    :param chunk_size: Read the coverage matrix in chunks of this many samples instead of loading it, 0 loads the whole
+                       matrix [0]
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
+    :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
+    """
+    configure_logging(verbose)
+    metrics = Metrics('qc-matrix')
+    with open(targetsFile) as f:
+        targets_params = cPickle.load(f)
+    _, targetCols = training_targets(targets_params, use_baseline_sum)
+
+    if chunk_size:
+        read_chunks = lambda: pd.read_csv(coverageMatrixFile, header=0, index_col=0, chunksize=chunk_size)
+    else:
+        coverage_df = pd.read_csv(coverageMatrixFile, header=0, index_col=0)
+        read_chunks = lambda: [coverage_df]
+
+    with metrics.phase('qc') as counters:
+        qc_df, cohort = matrix_qc(read_chunks, targetCols)
+        counters['samples'] = cohort['samples']
+        counters['flagged_samples'] = int(np.sum(qc_df['flagged']))
+    report_matrix_qc(qc_df, cohort)
+    qc_df.to_csv(outputFile, sep='\t')
+    logging.info('Wrote QC of {} samples to {}'.format(len(qc_df), outputFile))
+    metrics.write(metrics_file)
+
+@command('compile-model')
+def compile_model(parametersFile, outputDir, metrics_file=None, verbose=0):
+    """Compile a trained model into a directory of memory mappable arrays with a JSON manifest, including the precision
+    matrix, cholesky factor and per-target conditional distributions used during sampling, so evaluate-sample can load
+    it without recomputing them for every sample
+
+    :param parametersFile: Pickled file containing a dict with CoverageMatrix arguments and
+                           instance of HLN_Parameters (mu, covariance, targets), as written by train-model
+    :param outputDir: Output directory for the compiled model (created if needed), to pass to evaluate-sample as its
+                      parametersFile
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
+    :param -v, --verbose: 0 - Logging level warning; 1 - Logging level info; 2 - Logging level debug [0]
+    """
+    configure_logging(verbose)
+    metrics = Metrics('compile-model')
+    with open(parametersFile, 'rb') as f:
+        targets_params = cPickle.load(f)
+    with metrics.phase('compile') as counters:
+        manifest = write_compiled_model(targets_params, outputDir, source=os.path.basename(parametersFile))
+        counters['targets'] = len(targets_params['parameters'].targets)
+        counters['arrays'] = len(manifest['arrays'])
+    logging.info('Wrote compiled model of {} targets to {}'.format(counters['targets'], outputDir))
+    metrics.write(metrics_file)
 
 @command('create-bams')
-def create_bams(targetsFile, outputPrefix):
+def create_bams(targetsFile, outputPrefix, metrics_file=None):
     """Makes simulated data to run the program with, given a target bed file and an output file prefix.
 
     :param targetsFile: A BED file with targets to simulate coverage for.
     :param outputPrefix: an output file prefix used to name the output bam and fofn file.
+    :param metrics_file: Path to a JSON file to write wall and CPU time, peak memory and throughput of each phase to
     :return:
     """
-    SimulateData.make_simulated_data(outputPrefix, targetsFile)
+    metrics = Metrics('create-bams')
+    with metrics.phase('simulate'):
+        SimulateData.make_simulated_data(outputPrefix, targetsFile)
+    metrics.write(metrics_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+""" Compiled models: trained parameters written as a directory of .npy arrays with a JSON manifest, along with the
+arrays inference derives from them (precision matrix, cholesky factor and per-target conditional regressions), so
+evaluate-sample can memory map them instead of unpickling the model and recomputing them for every sample """
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from cnv import __version__
+from cnv.hln_parameters import HLN_Parameters
+from cnv.MCMC.TargetJointDistribution import TargetJointDistribution
+from cnv.Targets.Target import Target
+from cnv.Targets.TargetCollection import TargetCollection
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+# arrays derived from mu and covariance used to build HLN_Parameters.inference_cache
+CACHE_ARRAYS = ('mu_full', 'inv_covariance_full', 'conditional_coefs', 'conditional_vars', 'covariance_chol')
+# entries of the parameters dict written to the manifest (other than targets and HLN_Parameters)
+MANIFEST_PARAMS = ('unwanted_filters', 'target_base_mean', 'target_base_sd')
+
+
+def _json_value(value):
+    """Converts numpy scalars to python values for the manifest"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _target_arrays(targets):
+    """Returns a dict of arrays of the fields of a list of targets, with -1 for missing starts and ends"""
+    return {'chrom': np.array([target.chrom for target in targets], dtype=str),
+            'start': np.array([-1 if target.start is None else target.start for target in targets], dtype=np.int64),
+            'end': np.array([-1 if target.end is None else target.end for target in targets], dtype=np.int64),
+            'label': np.array([target.label for target in targets], dtype=str),
+            'name': np.array([target.name or '' for target in targets], dtype=str),
+            'has_name': np.array([target.name is not None for target in targets])}
+
+
+def _targets_from_arrays(arrays, state):
+    """Returns a TargetCollection of the targets in a dict of arrays from _target_arrays, with the collection state"""
+    targets = [Target(str(chrom), None if start == -1 else int(start), None if end == -1 else int(end), str(label),
+                      str(name) if has_name else None)
+               for chrom, start, end, label, name, has_name in zip(arrays['chrom'], arrays['start'], arrays['end'],
+                                                                   arrays['label'], arrays['name'],
+                                                                   arrays['has_name'])]
+    return TargetCollection.from_state(targets, min_merge_dist=state['min_merge_dist'],
+                                       is_sorted=state['sorted'], is_merged=state['merged'])
+
+
+def _collection_state(targets):
+    return {'min_merge_dist': targets.min_dist, 'sorted': targets._sorted, 'merged': targets._merged}
+
+
+def write_compiled_model(targets_params, output_dir, source=None):
+    """Writes the parameters dict of a trained model (as pickled by train-model) to a compiled model directory,
+    which is created if needed. Cached conditional modes of training samples are not included.
+
+    The cholesky factor of the covariance is left out (and computed when needed) if the covariance isn't positive
+    definite.
+    """
+    hln_parameters = targets_params['parameters']
+    covariance = np.asarray(hln_parameters.covariance, dtype=float)
+    include_cholesky = True
+    try:
+        np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        logging.warning('Covariance is not positive definite, compiling the model without its cholesky factor')
+        include_cholesky = False
+    arrays = TargetJointDistribution.inference_arrays(hln_parameters.mu, covariance, cholesky=include_cholesky)
+    arrays['mu'] = np.asarray(hln_parameters.mu, dtype=float)
+    arrays['covariance'] = covariance
+    for prefix, targets in (('targets', hln_parameters.targets), ('full_targets', targets_params['full_targets'])):
+        for field, values in _target_arrays(targets).iteritems():
+            arrays['{}_{}'.format(prefix, field)] = values
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(output_dir, name + '.npy'), array)
+
+    manifest = {'format_version': FORMAT_VERSION,
+                'genecnv_version': __version__,
+                'source': source,
+                'arrays': dict((name, {'shape': list(array.shape), 'dtype': array.dtype.str})
+                               for name, array in arrays.iteritems()),
+                'targets': _collection_state(hln_parameters.targets),
+                'full_targets': _collection_state(targets_params['full_targets']),
+                'params': dict((key, _json_value(targets_params[key]))
+                               for key in MANIFEST_PARAMS if key in targets_params)}
+    with open(os.path.join(output_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_compiled_model(model_dir, mmap_mode='r'):
+    """Reads a compiled model directory, returning a parameters dict like those pickled by train-model whose
+    HLN_Parameters have their inference_cache set. Arrays are memory mapped (read only by default, see numpy.load).
+    Raises ValueError if the model was compiled with a different format version.
+    """
+    with open(os.path.join(model_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError('Compiled model {} has format version {}, expected {}; recompile it with compile-model'.format(
+            model_dir, manifest.get('format_version'), FORMAT_VERSION))
+    arrays = dict((name, np.load(os.path.join(model_dir, name + '.npy'), mmap_mode=mmap_mode))
+                  for name in manifest['arrays'])
+    for name, description in manifest['arrays'].iteritems():
+        if list(arrays[name].shape) != description['shape']:
+            raise ValueError('Array {} of compiled model {} has shape {}, expected {}'.format(
+                name, model_dir, arrays[name].shape, description['shape']))
+
+    targets_params = dict(manifest['params'])
+    for prefix in ('targets', 'full_targets'):
+        targets_params[prefix] = _targets_from_arrays(
+            dict((field, arrays['{}_{}'.format(prefix, field)])
+                 for field in ('chrom', 'start', 'end', 'label', 'name', 'has_name')), manifest[prefix])
+    hln_parameters = HLN_Parameters(targets_params.pop('targets'), arrays['mu'], arrays['covariance'])
+    hln_parameters.inference_cache = dict((name, arrays[name]) for name in CACHE_ARRAYS if name in arrays)
+    targets_params['parameters'] = hln_parameters
+    return targets_params
@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import re
+import time
 from collections import Counter
 
 import numpy as np
@@ -103,6 +104,10 @@ class CoverageMatrix(object):
     def __init__(self, unwanted_filters=None):
         self.logger = logging.getLogger(__name__)
         self.list_of_checks = self.filter_list_of_checks(unwanted_filters) if unwanted_filters else self.default_checks
+        # total number of reads scanned across all calls to get_subject_coverage
+        self.reads_scanned = 0
+        # per-target costs are added to this TargetProfile (cnv.utilities.Profiling) if set
+        self.target_profile = None
 
 
     def filter_list_of_checks(self, unwanted_filters):
@@ -121,6 +126,10 @@ class CoverageMatrix(object):
         # Filter the list of checks to remove the unwanted filters
         return filter(lambda x: x[1] not in unwanted_filters, self.default_checks)
 
+    def scan_counters(self):
+        """Returns the total number of reads scanned so far (e.g. for Metrics phases)"""
+        return {'reads': self.reads_scanned}
+
     def passes_checks(self, read, insert_length, min_interval_separation, skipped_counts):
         """ Only count reads that pass the necessary quality checks, and keep counts of those that don't """
         for check, check_name in self.list_of_checks:
@@ -134,16 +143,24 @@ class CoverageMatrix(object):
         """ Get vector of coverage counts for any given bamfile across any provided target regions """
         coverage_vector = []
         assert isinstance(targets, TargetCollection)
-        for target in targets:
+        for target_i, target in enumerate(targets):
             read_pairs = {} # Counting dictionary
+            if self.target_profile is not None:
+                # count skipped reads for this target separately (added to skipped_counts after the target)
+                start_time = time.time()
+                target_skipped_counts = Counter()
+            else:
+                target_skipped_counts = skipped_counts
             # Scan through all reads in each target, and count the number of unique read pairs
+            n_reads = 0
             for read in bamfile.file.fetch(reference=target.chrom, start=target.start, end=target.end):
+                n_reads += 1
                 insert_length = read.template_length
                 # Multiply insert_length by -1 if the read is reverse
                 if read.is_reverse:
                     insert_length *= -1
                 # Only count reads that pass the necessary quality checks, and keep counts of those that don't
-                if self.passes_checks(read, insert_length, targets.min_dist, skipped_counts):
+                if self.passes_checks(read, insert_length, targets.min_dist, target_skipped_counts):
                     # Keep track of each read pair, and count coverage at the end in order to only count each read pair once
                     pair_start = min(read.reference_start, read.next_reference_start)
                     tpl = (read.query_name, pair_start, insert_length)
@@ -154,6 +171,14 @@ class CoverageMatrix(object):
                 self.logger.warning('For {}, the following read_pairs appeared more than twice within {}: {}'.format(
                     bamfile.filename, target.label, duplicate_read_pairs))
 
+            self.reads_scanned += n_reads
+            if self.target_profile is not None:
+                self.target_profile.add(target_i, fetch_seconds=time.time() - start_time, reads=n_reads,
+                                        rejected_reads=sum(target_skipped_counts.values()),
+                                        **{'rejected_{}'.format(check_name): count
+                                           for check_name, count in target_skipped_counts.iteritems()})
+                if skipped_counts is not None:
+                    skipped_counts.update(target_skipped_counts)
             # Count the number of unique read pairs as the amount of coverage for any target
             target_coverage = len(read_pairs)
             coverage_vector.append(target_coverage)
@@ -1,7 +1,48 @@
+import numpy as np
+
+from cnv.Targets.Target import Target
+
+
 class HLN_Parameters(object):
     """Container for the subject testing model parameters
     This currently includes the target intervals, and the model hyperparameters."""
+    # arrays precomputed from mu and covariance by TargetJointDistribution.inference_arrays, set when loaded from a
+    # compiled model (a class attribute so previously pickled parameters have none)
+    inference_cache = None
+
     def __init__(self, targets, mu, covariance):
         self.targets = targets
         self.mu = mu
         self.covariance = covariance
+
+    def collapse_baseline(self, first_baseline_i):
+        """Returns parameters with the individual baseline targets (from first_baseline_i on, the last of which has
+        intensity 0) collapsed into a single BaselineSum target with intensity 0, as if trained with use_baseline_sum.
+
+        The sum of the exponentiated baseline intensities is approximated as log normal by matching its first two
+        moments (Fenton-Wilkinson), with covariances of its log with the other intensities matched in the same way, so
+        the other intensities relative to the baseline sum remain multivariate normal.
+        """
+        mu_full = np.concatenate((self.mu.flatten(), [0]))
+        cov_full = np.zeros((len(mu_full), len(mu_full)))
+        cov_full[:-1, :-1] = self.covariance
+        base_cov = cov_full[first_baseline_i:, first_baseline_i:]
+
+        # first two moments of the sum of exponentiated baseline intensities
+        base_means = np.exp(mu_full[first_baseline_i:] + np.diagonal(base_cov) / 2)
+        sum_mean = np.sum(base_means)
+        sum_second_moment = np.sum(np.outer(base_means, base_means) * np.exp(base_cov))
+        log_sum_var = np.log(sum_second_moment / sum_mean ** 2)
+        log_sum_mu = np.log(sum_mean) - log_sum_var / 2
+        # covariance of each non-baseline intensity with the log of the sum
+        log_sum_cov = np.dot(cov_full[:first_baseline_i, first_baseline_i:], base_means) / sum_mean
+
+        mu = mu_full[:first_baseline_i] - log_sum_mu
+        covariance = (cov_full[:first_baseline_i, :first_baseline_i] - log_sum_cov.reshape((-1, 1)) -
+                      log_sum_cov.reshape((1, -1)) + log_sum_var)
+
+        targets = self.targets[:first_baseline_i]
+        chrom_span = '{}-{}'.format(self.targets[first_baseline_i].chrom, self.targets[-1].chrom)
+        targets.append(Target(chrom_span, None, None, 'BaselineSum'))
+
+        return HLN_Parameters(targets, mu.reshape((-1, 1)) if self.mu.ndim == 2 else mu, covariance)
@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+
+from cnv.MCMC.Autocorrelation import autocorrelation, integrated_autocorrelation_time, effective_sample_size
+
+
+class AutocorrelationTest(unittest.TestCase):
+    def test_autocorrelation_matches_direct(self):
+        np.random.seed(1)
+        trace = np.random.randn(500)
+        centered = trace - np.mean(trace)
+        direct = [np.sum(centered[:len(trace) - lag] * centered[lag:]) / np.sum(centered ** 2) for lag in range(5)]
+        np.testing.assert_allclose(autocorrelation(trace)[:5, 0], direct)
+
+    def test_ar1_autocorrelation_time(self):
+        # AR(1) process has integrated autocorrelation time (1 + phi) / (1 - phi)
+        np.random.seed(2)
+        phi = 0.8
+        n = 50000
+        traces = np.zeros((n, 2))
+        for i in xrange(1, n):
+            traces[i] = phi * traces[i - 1] + np.random.randn(2)
+        taus = integrated_autocorrelation_time(traces)
+        for tau in taus:
+            self.assertAlmostEqual(tau, (1 + phi) / (1 - phi), delta=1.)
+
+    def test_constant_trace(self):
+        self.assertEqual(effective_sample_size(np.zeros(100))[0], 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from cnv.compiled_model import MANIFEST, read_compiled_model, write_compiled_model
+from cnv.hln_parameters import HLN_Parameters
+from cnv.MCMC.PloidyModel import PloidyModel
+from cnv.MCMC.TargetJointDistribution import TargetJointDistribution
+from cnv.Targets.Target import Target
+from cnv.Targets.TargetCollection import TargetCollection
+
+
+class CompiledModelTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        full_targets = TargetCollection([Target('X', 1000 * i, 1000 * i + 50, 'Ex{}'.format(i), 'DMD') for i in xrange(4)] +
+                                        [Target('1', 1000 * i, 1000 * i + 50, 'Baseline{}'.format(i)) for i in xrange(3)])
+        targets = full_targets[:4]
+        targets.append(Target('1-1', None, None, 'BaselineSum'))
+        factor = np.random.randn(4, 4)
+        self.targets_params = {'full_targets': full_targets,
+                               'unwanted_filters': None,
+                               'target_base_mean': np.float64(0.5),
+                               'target_base_sd': np.float64(0.1),
+                               'parameters': HLN_Parameters(targets, np.random.randn(4, 1),
+                                                            np.dot(factor, factor.T) + np.eye(4))}
+        self.model_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir)
+
+    def test_round_trip(self):
+        write_compiled_model(self.targets_params, self.model_dir)
+        compiled_params = read_compiled_model(self.model_dir)
+        hln_parameters = self.targets_params['parameters']
+        compiled_parameters = compiled_params['parameters']
+        self.assertIsInstance(compiled_parameters.covariance, np.memmap)
+        np.testing.assert_array_equal(compiled_parameters.mu, hln_parameters.mu)
+        np.testing.assert_array_equal(compiled_parameters.covariance, hln_parameters.covariance)
+        for key in ('targets', 'full_targets'):
+            original = hln_parameters.targets if key == 'targets' else self.targets_params[key]
+            compiled = compiled_parameters.targets if key == 'targets' else compiled_params[key]
+            self.assertEqual([(t.chrom, t.start, t.end, t.label, t.name) for t in compiled],
+                             [(t.chrom, t.start, t.end, t.label, t.name) for t in original])
+            self.assertEqual((compiled.min_dist, compiled._sorted, compiled._merged),
+                             (original.min_dist, original._sorted, original._merged))
+        self.assertEqual(compiled_params['target_base_mean'], 0.5)
+        self.assertIsNone(compiled_params['unwanted_filters'])
+
+        inference_cache = compiled_parameters.inference_cache
+        intensities = np.random.randn(4)
+        for index in xrange(4):
+            mu_bar, cov_bar = TargetJointDistribution.get_conditional_mvn(hln_parameters.mu, hln_parameters.covariance,
+                                                                          index, intensities)
+            self.assertAlmostEqual(hln_parameters.mu[index, 0] + np.dot(inference_cache['conditional_coefs'][index],
+                                                                        intensities - hln_parameters.mu.flatten()),
+                                   mu_bar)
+            self.assertAlmostEqual(inference_cache['conditional_vars'][index], cov_bar)
+
+    def test_sampling(self):
+        write_compiled_model(self.targets_params, self.model_dir)
+        hln_parameters = read_compiled_model(self.model_dir)['parameters']
+        data = np.random.multinomial(5000, np.ones(5) / 5.).astype(float)
+        for intensity_update in ('single', 'elliptical'):
+            ploidy_model = PloidyModel([1e-10, 1, 2, 3], hln_parameters, data=data, first_baseline_i=4,
+                                       intensity_update=intensity_update)
+            ploidy_model.RunMCMC(20)
+            self.assertEqual(ploidy_model.total_iterations, 20)
+
+    def test_format_version(self):
+        write_compiled_model(self.targets_params, self.model_dir)
+        with open(os.path.join(self.model_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        manifest['format_version'] = 0
+        with open(os.path.join(self.model_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        self.assertRaises(ValueError, read_compiled_model, self.model_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import numpy as np
+import scipy.optimize
 
 from cnv.MCMC.TargetJointDistribution import TargetJointDistribution
 
@@ -15,5 +16,33 @@ class ConditionalMVNTest(unittest.TestCase):
         test_mu_bar, test_cov_bar = TargetJointDistribution.get_conditional_mvn(test_mu, test_cov, test_index, test_input)
         self.assertListEqual([test_mu_bar, test_cov_bar], true_results)
 
+    def test_inference_arrays(self):
+        np.random.seed(0)
+        factor = np.random.randn(5, 5)
+        mu = np.random.randn(5)
+        cov = np.dot(factor, factor.T) + np.eye(5)
+        inference_cache = TargetJointDistribution.inference_arrays(mu, cov, cholesky=True)
+        intensities = np.random.randn(5)
+        for index in xrange(5):
+            mu_bar, cov_bar = TargetJointDistribution.get_conditional_mvn(mu, cov, index, intensities)
+            self.assertAlmostEqual(mu[index] + np.dot(inference_cache['conditional_coefs'][index], intensities - mu), mu_bar)
+            self.assertAlmostEqual(inference_cache['conditional_vars'][index], cov_bar)
+        np.testing.assert_allclose(np.dot(inference_cache['covariance_chol'], inference_cache['covariance_chol'].T), cov)
+        np.testing.assert_allclose(np.dot(inference_cache['inv_covariance_full'][:-1, :-1], cov), np.eye(5), atol=1e-10)
+
+    def test_optimize_intensities(self):
+        mu = np.array([0.2, -0.1, 0.1]).reshape((-1, 1))
+        cov = np.array([[0.1, 0.02, 0.], [0.02, 0.1, 0.01], [0., 0.01, 0.1]])
+        data = np.array([400., 150., 330., 250.])
+        copies = np.array([[2., 1., 2., 2.], [2., 2., 2., 2.]])
+        joint_target = TargetJointDistribution(mu, cov, [1e-10, 1, 2, 3], data)
+
+        optimal, loglikes = joint_target.optimize_intensities(copies)
+        for optimal_i, loglike_i, copies_i in zip(optimal, loglikes, copies):
+            result = scipy.optimize.minimize(joint_target.log_joint_likelihood, mu.flatten(), args=(copies_i, True), tol=1e-10)
+            np.testing.assert_allclose(optimal_i[:-1], result.x, atol=1e-4)
+            self.assertAlmostEqual(loglike_i, joint_target.log_joint_likelihood(optimal_i, copies_i))
+            self.assertAlmostEqual(loglike_i, -result.fun, places=6)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
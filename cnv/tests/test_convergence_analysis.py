@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from cnv.MCMC.ConvergenceAnalysis import ConvergenceAnalysis
+from cnv.utilities.Metrics import Metrics
+from test_resources import simulated_coverage, simulated_parameters
+
+CNV_SUPPORT = np.array([1e-10, 1, 2, 3])
+
+
+class ConvergenceAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.hln_parameters = simulated_parameters()
+        self.copies = 2. * np.ones(7)
+        self.copies[2] = 1.
+        self.data = simulated_coverage(self.hln_parameters, self.copies)
+
+    def test_min_ess_work(self):
+        convergence_analysis = ConvergenceAnalysis(CNV_SUPPORT, self.hln_parameters, self.data, 6, n_iterations=400,
+                                                   use_single_process=True)
+        ploidy_model = convergence_analysis.ploidy_model
+        chain_length = convergence_analysis.run_chain(min_ess=1e6, max_iterations=800)
+        self.assertEqual(chain_length, 800)
+        self.assertEqual(ploidy_model.total_iterations, 800)
+        self.assertEqual(convergence_analysis.n_iterations, 400)
+
+        # a rerun chain starts from n_iterations and only its new iterations are counted
+        ploidy_model.initStates()
+        ploidy_model.RunMCMC(convergence_analysis.n_iterations, log_progress=False)
+        self.assertEqual(ploidy_model.total_iterations, 1200)
+        chain_length = convergence_analysis.run_chain(min_ess=1e6, max_iterations=800)
+        self.assertEqual(chain_length, 800)
+        self.assertEqual(ploidy_model.total_iterations, 1600)
+        self.assertEqual(ploidy_model.total_target_updates, 1600 * 7)
+
+    def test_parallel_tempering(self):
+        convergence_analysis = ConvergenceAnalysis(CNV_SUPPORT, self.hln_parameters, self.data, 6, n_iterations=1000,
+                                                   use_single_process=True)
+        copy_posteriors, _ = convergence_analysis.parallel_tempering_analysis(num_temperatures=3, swap_interval=20,
+                                                                              autocor_slice=10)
+        ploidy_model = convergence_analysis.ploidy_model
+        self.assertTrue(np.all((convergence_analysis.swap_acceptance >= 0) & (convergence_analysis.swap_acceptance <= 1)))
+        # 50 rounds of swaps alternate between the (0, 1) and (1, 2) pairs
+        np.testing.assert_array_equal(convergence_analysis.swap_proposals, [25, 25])
+        # the cold chain is put back together in the ploidy model, untempered
+        self.assertEqual(ploidy_model.joint_target.inverse_temperature, 1.)
+        self.assertEqual(len(ploidy_model.likelihoods), 1000)
+        self.assertEqual(ploidy_model.mcmc_copy_data.shape, (7, 1000))
+        self.assertEqual(ploidy_model.mcmc_intens.shape, (1000, 7))
+        np.testing.assert_array_equal(CNV_SUPPORT[np.argmax(copy_posteriors, axis=1)], self.copies)
+        self.assertGreater(copy_posteriors[2, 1], 0.9)
+
+    def test_pool_work_counters(self):
+        # chains run in pool processes count towards the work of the ploidy model
+        convergence_analysis = ConvergenceAnalysis(CNV_SUPPORT, self.hln_parameters, self.data, 6, n_iterations=400,
+                                                   use_single_process=False)
+        ploidy_model = convergence_analysis.ploidy_model
+        metrics = Metrics('test')
+        with metrics.phase('gelman_rubin', ploidy_model.WorkCounters):
+            convergence_analysis.gelman_rubin_analysis(2, 7, iter_step_size=200, max_iterations=400)
+        self.assertGreaterEqual(ploidy_model.total_iterations, 2 * 400)
+        self.assertEqual(ploidy_model.total_target_updates, 7 * ploidy_model.total_iterations)
+        self.assertEqual(metrics.phases[0]['sweeps'], ploidy_model.total_iterations)
+        self.assertGreater(metrics.phases[0]['sweeps_per_second'], 0)
+
+        with metrics.phase('parallel_tempering', ploidy_model.WorkCounters):
+            convergence_analysis.parallel_tempering_analysis(num_temperatures=2, swap_interval=100)
+        self.assertEqual(metrics.phases[1]['sweeps'], 2 * 400)
+
+    def test_metastability_phases(self):
+        # an estimated normal copy number of 1 and an unreachable log-likelihood threshold force every kind of rerun
+        convergence_analysis = ConvergenceAnalysis(CNV_SUPPORT, self.hln_parameters, self.data, 6, n_iterations=1000,
+                                                   use_single_process=True, norm_copy_num=1.)
+        metrics = Metrics('test')
+        convergence_analysis.metastability_error_analysis(thresh_loglike_diff=np.inf, autocor_slice=10, max_tries=1,
+                                                          metrics=metrics)
+        self.assertEqual([phase['phase'] for phase in metrics.phases],
+                         ['sampling', 'norm_copy_num_rerun', 'likelihood_comparison', 'likelihood_comparison',
+                          'metastability_rerun', 'likelihood_comparison', 'likelihood_comparison'])
+        self.assertEqual([phase['sweeps'] for phase in metrics.phases if phase['phase'] != 'likelihood_comparison'],
+                         [1000, 1000, 1500])
+        self.assertEqual([phase.get('try') for phase in metrics.phases], [None, None, None, 0, 1, 1, 1])
+        self.assertEqual(sum(phase['sweeps'] for phase in metrics.phases),
+                         convergence_analysis.ploidy_model.total_iterations)
+
+if __name__ == '__main__':
+    unittest.main()
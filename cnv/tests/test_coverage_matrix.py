@@ -7,6 +7,7 @@ from cnv.Targets.TargetCollection import DEFAULT_MERGE_DISTANCE
 from cnv.Targets.TargetCollection import TargetCollection
 from cnv import coverage_matrix as cm, utilities as cnv_util
 from cnv.coverage_matrix import WrappedBAM
+from cnv.utilities.Profiling import TargetProfile
 from test_resources import EXAMPLE_BAM_PATH
 
 
@@ -40,5 +41,22 @@ class CoverageMatrixTests(unittest.TestCase):
                          'There are {} targets but the coverage_vector has length {}'.format(len(self.targets), len(coverage_vector)))
         self.assertEqual(coverage_vector.count(0), 0, 'The example bamfile has 0 coverage in one of the targets')
 
+    def test_subject_coverage_profile(self):
+        skipped_counts = Counter()
+        coverage_vector = self.matrix_instance.get_subject_coverage(WrappedBAM(EXAMPLE_BAM_PATH), self.targets,
+                                                                    skipped_counts)
+        profile_instance = cm.CoverageMatrix()
+        profile_instance.target_profile = TargetProfile([target.label for target in self.targets])
+        profiled_skipped_counts = Counter()
+        self.assertEqual(profile_instance.get_subject_coverage(WrappedBAM(EXAMPLE_BAM_PATH), self.targets,
+                                                               profiled_skipped_counts), coverage_vector)
+        self.assertEqual(profiled_skipped_counts, skipped_counts)
+
+        profile_df = profile_instance.target_profile.to_frame()
+        self.assertEqual(list(profile_df.index), [target.label for target in self.targets])
+        self.assertEqual(profile_df['reads'].sum(), profile_instance.reads_scanned)
+        self.assertEqual(profile_df['rejected_reads'].sum(), sum(skipped_counts.values()))
+        self.assertTrue((profile_df['fetch_seconds'] >= 0).all())
+
 if __name__ == '__main__':
     unittest.main()
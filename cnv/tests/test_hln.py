@@ -3,7 +3,10 @@ import numpy as np
 import scipy.io as sio
 from test_resources import *
 
-from cnv.LogisticNormal import hln_EM
+from cnv.LogisticNormal import (_conditional_modes, _conditional_modes_wrapper, _init_e_step_process, gen_hln_samples,
+                                 hln_EM, hln_minibatch_EM)
+from cnv.hln_parameters import HLN_Parameters
+from cnv.Targets.Target import Target
 
 class LogisticNormalTest(unittest.TestCase):
     def test_FileExists(self):
@@ -21,5 +24,89 @@ class LogisticNormalTest(unittest.TestCase):
         for i in xrange(len(ml_cov.flatten())):
             self.assertAlmostEqual(ml_cov.flatten()[i], testFile['cov2'].flatten()[i])
 
+    def test_parallel_e_step(self):
+        testData = sio.loadmat(MATLAB_HLN_PATH)['Y']
+        stats = {}
+        mu, cov = hln_EM(testData, max_iterations=5, stats=stats)
+        parallel_mu, parallel_cov = hln_EM(testData, max_iterations=5, jobs=3)
+        self.assertEqual(stats['iterations'], 5)
+        np.testing.assert_allclose(parallel_mu, mu)
+        np.testing.assert_allclose(parallel_cov, cov)
+
+        # pool processes keep the coverage matrix, and are only sent a slice of its subjects with each E-step
+        _init_e_step_process(testData)
+        initial_mu_hat = np.tile(mu, [1, 5])
+        chunk_modes = _conditional_modes_wrapper((slice(5, 10), mu, cov, 0, initial_mu_hat, 'batched'))
+        np.testing.assert_allclose(chunk_modes[0], _conditional_modes(testData[5:10], mu, cov, 0, initial_mu_hat)[0])
+
+    def test_batched_e_step(self):
+        testData = sio.loadmat(MATLAB_HLN_PATH)['Y']
+        mu, cov = hln_EM(testData, max_iterations=5, e_step='single')
+        batched_mu, batched_cov = hln_EM(testData, max_iterations=5, e_step='batched')
+        np.testing.assert_allclose(batched_mu, mu, rtol=1e-6)
+        np.testing.assert_allclose(batched_cov, cov, rtol=1e-6)
+        self.assertRaises(ValueError, hln_EM, testData, e_step='unknown')
+
+    def test_warm_start(self):
+        testData = sio.loadmat(MATLAB_HLN_PATH)['Y']
+        cold_stats = {}
+        cold_mu, cold_cov = hln_EM(testData, max_iterations=500, tol=1e-10, stats=cold_stats)
+        # warm start from a model of the first subjects, with cached modes for them only
+        first_mu, first_cov, first_modes = hln_EM(testData[:7], max_iterations=500, tol=1e-10, return_modes=True)
+        initial_mu_hat = np.concatenate((first_modes, np.nan * np.ones((len(first_mu), 3))), axis=1)
+        warm_stats = {}
+        warm_mu, warm_cov = hln_EM(testData, max_iterations=500, tol=1e-10, stats=warm_stats, initial_mu=first_mu,
+                                   initial_cov=first_cov, initial_mu_hat=initial_mu_hat)
+        np.testing.assert_allclose(warm_mu, cold_mu, rtol=1e-6)
+        np.testing.assert_allclose(warm_cov, cold_cov, rtol=1e-6)
+        self.assertLess(warm_stats['iterations'], cold_stats['iterations'])
+
+    def test_accelerated_EM(self):
+        np.random.seed(3)
+        factor = 0.2 * np.random.randn(9, 2)
+        Y, _ = gen_hln_samples(200, 5000, 0.5 * np.random.randn(9), np.dot(factor, factor.T) + 0.02 * np.eye(9))
+        stats = {}
+        mu, cov = hln_EM(Y, max_iterations=500, tol=1e-8, stats=stats)
+        accelerated_stats = {}
+        accelerated_mu, accelerated_cov = hln_EM(Y, max_iterations=500, tol=1e-8, stats=accelerated_stats,
+                                                 accelerate=True)
+        np.testing.assert_allclose(accelerated_mu, mu, atol=1e-5)
+        np.testing.assert_allclose(accelerated_cov, cov, atol=1e-5)
+        self.assertLess(accelerated_stats['iterations'], stats['iterations'])
+        self.assertGreater(accelerated_stats['extrapolations'], accelerated_stats['rejected_extrapolations'])
+        self.assertEqual(accelerated_stats['iterations_saved'],
+                         2 * (accelerated_stats['extrapolations'] - accelerated_stats['rejected_extrapolations']))
+
+    def test_minibatch_EM(self):
+        np.random.seed(2)
+        Y, _ = gen_hln_samples(600, 5000, np.array([0.5, -0.5, 0.2, 0.]), 0.1 * np.eye(4) + 0.05)
+        mu, cov = hln_EM(Y, max_iterations=100)
+        stats = {}
+        stream_mu, stream_cov = hln_minibatch_EM(lambda: (Y[i:i + 100] for i in xrange(0, len(Y), 100)),
+                                                 n_heldout=50, max_passes=10, stats=stats)
+        self.assertEqual(stats['training_subjects'], 550)
+        self.assertEqual(stats['updates'], 6 * stats['iterations'])
+        self.assertEqual(len(stats['heldout_loglikes']), stats['iterations'])
+        # held-out subjects aren't trained on, so estimates differ by more than EM's tolerance
+        np.testing.assert_allclose(stream_mu, mu, atol=0.05)
+        np.testing.assert_allclose(stream_cov, cov, atol=0.05)
+
+class CollapseBaselineTest(unittest.TestCase):
+    def test_collapse_matches_simulation(self):
+        np.random.seed(4)
+        targets = [Target('X', i, i + 1, 'Ex{}'.format(i)) for i in xrange(3)]
+        targets += [Target('1', i, i + 1, 'Baseline{}'.format(i)) for i in xrange(4)]
+        mu = np.array([0.5, -0.2, 0.1, 0.3, -0.1, 0.2])
+        factor = 0.1 * np.random.randn(6, 6)
+        covariance = np.dot(factor, factor.T) + 0.01 * np.eye(6)
+        collapsed = HLN_Parameters(targets, mu, covariance).collapse_baseline(3)
+
+        self.assertEqual([target.label for target in collapsed.targets], ['Ex0', 'Ex1', 'Ex2', 'BaselineSum'])
+        intensities = np.random.multivariate_normal(mu, covariance, size=200000)
+        intensities = np.concatenate((intensities, np.zeros((len(intensities), 1))), axis=1)
+        relative = intensities[:, :3] - np.log(np.sum(np.exp(intensities[:, 3:]), axis=1)).reshape((-1, 1))
+        np.testing.assert_allclose(collapsed.mu, np.mean(relative, axis=0), atol=0.002)
+        np.testing.assert_allclose(collapsed.covariance, np.cov(relative.T), atol=0.002)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import unittest
+
+import numpy as np
+
+from cnv.MCMC.LaplaceScreen import LaplaceScreen
+from test_resources import simulated_coverage, simulated_parameters
+
+CNV_SUPPORT = np.array([1e-10, 1, 2, 3])
+
+
+class LaplaceScreenTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.hln_parameters = simulated_parameters()
+        # target-to-baseline-sum ratio statistics of simulated female training samples
+        ratios = []
+        for _ in xrange(200):
+            coverage = simulated_coverage(self.hln_parameters, 2. * np.ones(7))
+            ratios.append(np.sum(coverage[:6]) / coverage[6])
+        self.target_base_mean = np.mean(ratios)
+        self.target_base_sd = np.std(ratios)
+
+    def screen(self, copies):
+        return LaplaceScreen(CNV_SUPPORT, self.hln_parameters, simulated_coverage(self.hln_parameters, copies), 6)
+
+    def test_screen_normal(self):
+        copy_posteriors, norm_copy_num, reliable = self.screen(2. * np.ones(7)).screen()
+        self.assertEqual(norm_copy_num, 2.)
+        self.assertTrue(reliable)
+        np.testing.assert_allclose(np.sum(copy_posteriors, axis=1), 1.)
+        self.assertTrue(np.all(copy_posteriors[:, 2] > 0.9))
+
+    def test_screen_deletion(self):
+        copies = 2. * np.ones(7)
+        copies[3] = 1.
+        copy_posteriors, norm_copy_num, reliable = self.screen(copies).screen(2.)
+        np.testing.assert_allclose(np.sum(copy_posteriors, axis=1), 1.)
+        # the normal state is no longer the most probable candidate
+        self.assertFalse(reliable)
+        self.assertGreater(copy_posteriors[3, 1], 0.9)
+        self.assertTrue(np.all(np.delete(copy_posteriors[:, 2], 3) > 0.9))
+
+    def test_estimate_norm_copy_num(self):
+        for norm_copy_num in (1., 2.):
+            copies = np.concatenate((norm_copy_num * np.ones(6), [2.]))
+            laplace_screen = self.screen(copies)
+            self.assertEqual(laplace_screen.candidate_norm_copy_nums(), [1., 2.])
+            estimate, norm_probs = laplace_screen.estimate_norm_copy_num()
+            self.assertEqual(estimate, norm_copy_num)
+            self.assertAlmostEqual(np.sum(norm_probs), 1.)
+
+            # with the target-to-baseline-sum ratio z-scores of the training samples
+            estimate, ratio_norm_probs = laplace_screen.estimate_norm_copy_num(self.target_base_mean, self.target_base_sd)
+            self.assertEqual(estimate, norm_copy_num)
+            self.assertAlmostEqual(np.sum(ratio_norm_probs), 1.)
+            self.assertGreater(ratio_norm_probs[int(norm_copy_num) - 1], 0.99)
+
+    def test_ratio_only(self):
+        # with equal marginal likelihoods of the normal states, the ratio z-scores alone decide the estimate
+        laplace_screen = self.screen(np.concatenate((np.ones(6), [2.])))
+        laplace_screen.joint_target.laplace_log_marginals = lambda ploidies: (np.zeros(len(ploidies)), None, None)
+        self.assertEqual(laplace_screen.estimate_norm_copy_num()[1].tolist(), [0.5, 0.5])
+        estimate, norm_probs = laplace_screen.estimate_norm_copy_num(self.target_base_mean, self.target_base_sd)
+        self.assertEqual(estimate, 1.)
+        self.assertGreater(norm_probs[0], 0.99)
+
+    def test_not_x_chromosome(self):
+        self.hln_parameters = simulated_parameters(chrom='7')
+        laplace_screen = self.screen(2. * np.ones(7))
+        estimate, norm_probs = laplace_screen.estimate_norm_copy_num()
+        self.assertEqual(estimate, 2.)
+        self.assertEqual(norm_probs.tolist(), [1.])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from cnv.utilities.MatrixQC import matrix_qc
+
+
+class MatrixQCTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        coverage = np.random.poisson([400, 200, 100, 50, 1000], size=(40, 5)).astype(float)
+        # a sample with an unusual target-to-baseline ratio, one with a different target profile, and missing data
+        coverage[1, 4] = 3000
+        coverage[2, :4] = [50, 100, 200, 400]
+        coverage[3, 0] = np.nan
+        coverage[4, 1] = 0
+        self.coverage_df = pd.DataFrame(coverage, columns=['Ex1', 'Ex2', 'Ex3', 'Ex4', 'BaselineSum'])
+        self.coverage_df.insert(0, 'sample', ['sample_{}'.format(i) for i in xrange(40)])
+        self.target_columns = ['Ex1', 'Ex2', 'Ex3', 'Ex4', 'BaselineSum']
+
+    def test_matrix_qc(self):
+        qc_df, cohort = matrix_qc(lambda: [self.coverage_df], self.target_columns)
+        self.assertEqual(cohort['samples'], 40)
+        self.assertEqual(cohort['missing_columns'], [])
+        coverage = self.coverage_df[self.target_columns].values
+        ratios = np.nansum(coverage[:, :4], axis=1) / coverage[:, 4]
+        self.assertAlmostEqual(cohort['target_base_mean'], np.mean(ratios))
+
+        self.assertEqual(qc_df.loc['sample_3', 'missing_targets'], 1)
+        self.assertEqual(qc_df.loc['sample_4', 'zero_targets'], 1)
+        self.assertTrue(qc_df.loc['sample_1', 'target_base_outlier'])
+        self.assertTrue(qc_df.loc['sample_2', 'low_correlation'])
+        self.assertEqual(sorted(qc_df.index[qc_df['flagged']])[:3], ['sample_1', 'sample_2', 'sample_3'])
+
+        intensities = coverage[0, :4] / np.sum(coverage[0, :4])
+        self.assertAlmostEqual(qc_df.loc['sample_0', 'correlation'],
+                               np.corrcoef(intensities, cohort['mean_intensities'])[0, 1])
+
+    def test_chunks_match(self):
+        qc_df, cohort = matrix_qc(lambda: [self.coverage_df], self.target_columns)
+        chunked_qc_df, chunked_cohort = matrix_qc(
+            lambda: (self.coverage_df[i:i + 7] for i in xrange(0, 40, 7)), self.target_columns)
+        pd.testing.assert_frame_equal(chunked_qc_df, qc_df)
+        self.assertAlmostEqual(chunked_cohort['target_base_sd'], cohort['target_base_sd'])
+
+    def test_missing_columns(self):
+        qc_df, cohort = matrix_qc(lambda: [self.coverage_df], self.target_columns + ['Ex5'])
+        self.assertEqual(cohort['missing_columns'], ['Ex5'])
+        self.assertTrue(np.all(qc_df['missing_targets'] >= 1))
+        self.assertTrue(np.all(np.isnan(qc_df['target_base_ratio'])))
@@ -77,6 +77,125 @@ class TestPloidyModel(unittest.TestCase):
                           for mcmc_target_result in copy_posteriors],
                          list(copy_numbers))
 
+    def test_02_diagnostics(self):
+        """Diagnostics of a chain continued from a previous run cover all iterations of both runs."""
+        cnv_support = [1e-10, 1, 2, 3]
+        test_hln_params = cPickle.load(open(TEST_HLN_PARAMS, 'rb'))
+        n_targets = len(test_hln_params['targets'])
+        test_params = HLN_Parameters(test_hln_params['targets'], test_hln_params['mu'], test_hln_params['covariance'])
+        intensities = IntensitiesDistribution(test_params.mu, test_params.covariance).sample()
+        p_vector = 2. * np.exp(intensities) / np.sum(2. * np.exp(intensities))
+
+        ploidy_instance = PloidyModel(cnv_support, test_params, data=np.random.multinomial(10000, p_vector))
+        ploidy_instance.RunMCMC(700, log_progress=False)
+        ploidy_instance.RunMCMC(400, ploidy_instance.mcmc_copy_data, ploidy_instance.mcmc_intens,
+                                ploidy_instance.likelihoods, ploidy_instance.acceptance, log_progress=False)
+        self.assertEqual(ploidy_instance.acceptance.shape, (1100, n_targets))
+
+        diagnostics = ploidy_instance.Diagnostics(burn_in=300, autocor_slice=50)
+        self.assertEqual(diagnostics['n_iterations'], 1100)
+        self.assertEqual(len(diagnostics['acceptance']), n_targets)
+        self.assertTrue(np.all((diagnostics['acceptance'] >= 0) & (diagnostics['acceptance'] <= 1)))
+        self.assertEqual(diagnostics['thinned_intensities'].shape, (16, n_targets))
+        self.assertEqual(list(diagnostics['thinned_iterations'][:2]), [300, 350])
+        self.assertGreaterEqual(diagnostics['mode_jump_index'], 500)
+
+    def simulated_subject(self, n_reads=40000):
+        """Simulated parameters and coverage of a subject with a deletion and a duplication"""
+        np.random.seed(4)
+        hln_parameters = simulated_parameters()
+        copies = 2. * np.ones(7)
+        copies[1] = 1.
+        copies[4] = 3.
+        return hln_parameters, copies, simulated_coverage(hln_parameters, copies, n_reads)
+
+    def test_03_init_from_mode(self):
+        """Chains initialized around the mode start from the simulated copy numbers and give the same posteriors as
+        chains drawn from the priors."""
+        cnv_support = [1e-10, 1, 2, 3]
+        hln_parameters, copies, data = self.simulated_subject()
+        default_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6)
+        default_model.RunMCMC(4000, log_progress=False)
+        default_posteriors = default_model.ReportMCMCData(burn_in=1000, autocor_slice=5)
+
+        mode_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6, init_from_mode=True,
+                                 init_copy_jitter=0.)
+        mode_ploidy, mode_intensities, mode_cov_chol = mode_model.ModeStates()
+        np.testing.assert_array_equal(mode_ploidy, copies)
+        np.testing.assert_array_equal(mode_model.ploidy, copies)
+        self.assertEqual(mode_cov_chol.shape, (6, 6))
+        # the intensities of the mode reproduce the observed proportions of coverage
+        p_vector = copies * np.exp(mode_intensities)
+        np.testing.assert_allclose(p_vector / np.sum(p_vector), data / np.sum(data), rtol=0.05)
+
+        mode_model.RunMCMC(1500, log_progress=False)
+        mode_posteriors = mode_model.ReportMCMCData(burn_in=100, autocor_slice=5)
+        np.testing.assert_array_equal(np.array(cnv_support)[np.argmax(mode_posteriors, axis=1)], copies)
+        self.assertLess(np.amax(np.absolute(mode_posteriors - default_posteriors)), 0.05)
+
+    def test_04_adaptive_scan(self):
+        """Adaptive scan weights favor targets with uncertain copy numbers and are frozen after adaptation, and the
+        posteriors match those of the systematic scan."""
+        cnv_support = [1e-10, 1, 2, 3]
+        hln_parameters, copies, data = self.simulated_subject()
+        systematic_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6)
+        systematic_model.RunMCMC(4000, log_progress=False)
+        systematic_posteriors = systematic_model.ReportMCMCData(burn_in=1000, autocor_slice=5)
+
+        adaptive_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6, scan='adaptive',
+                                     scan_adapt_iterations=1000, scan_floor=0.5)
+        copy_counts = np.zeros((7, 4))
+        copy_counts[:, 2] = 10
+        copy_counts[0] = [0, 5, 5, 0]
+        adaptive_model.updates_per_iteration = 7
+        weights = adaptive_model.ScanWeights(copy_counts)
+        np.testing.assert_allclose(weights, np.array([1., 0.5, 0.5, 0.5, 0.5, 0.5, 0.]) / 3.5)
+
+        adaptive_model.RunMCMC(1000, log_progress=False)
+        adapted_weights = np.copy(adaptive_model.scan_weights)
+        self.assertAlmostEqual(np.sum(adapted_weights), 1.)
+        self.assertEqual(adapted_weights[-1], 0)
+        # continuing the chain after adaptation leaves the weights unchanged
+        adaptive_model.RunMCMC(3000, adaptive_model.mcmc_copy_data, adaptive_model.mcmc_intens,
+                               adaptive_model.likelihoods, adaptive_model.acceptance, log_progress=False)
+        np.testing.assert_array_equal(adaptive_model.scan_weights, adapted_weights)
+        self.assertEqual(adaptive_model.total_target_updates, 4000 * 7)
+
+        adaptive_posteriors = adaptive_model.ReportMCMCData(burn_in=1000, autocor_slice=5)
+        np.testing.assert_array_equal(np.array(cnv_support)[np.argmax(adaptive_posteriors, axis=1)], copies)
+        self.assertLess(np.amax(np.absolute(adaptive_posteriors - systematic_posteriors)), 0.05)
+
+    def test_05_rao_blackwell(self):
+        """Rao-Blackwellized posteriors average the full conditionals of the retained iterations, agree with the
+        counting estimator and vary less between short chains."""
+        cnv_support = [1e-10, 1, 2, 3]
+        # few reads leave some copy numbers uncertain
+        hln_parameters, copies, data = self.simulated_subject(n_reads=1000)
+        ploidy_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6)
+        ploidy_model.RunMCMC(4000, log_progress=False)
+        counting_posteriors = np.copy(ploidy_model.ReportMCMCData(burn_in=1000, autocor_slice=5))
+        ploidy_model.rao_blackwell = True
+        rb_posteriors = ploidy_model.ReportMCMCData(burn_in=1000, autocor_slice=5)
+        self.assertLess(np.amax(np.absolute(rb_posteriors - counting_posteriors)), 0.05)
+        np.testing.assert_allclose(np.sum(rb_posteriors, axis=1), 1.)
+        np.testing.assert_array_equal(rb_posteriors[6], [0, 0, 1, 0])
+
+        # the average of the conditionals of iterations retained after burn-in and thinning (in batches)
+        conditionals = ploidy_model.joint_target.copy_conditional_probs_rows(
+            ploidy_model.mcmc_copy_data[:, 1000::5].T, ploidy_model.mcmc_intens[1000::5], 6)
+        self.assertEqual(conditionals.shape, (600, 6, 4))
+        np.testing.assert_allclose(rb_posteriors[:6], np.mean(conditionals, axis=0))
+        np.testing.assert_allclose(ploidy_model.RaoBlackwellPosteriors(1000, 5, batch_size=7), rb_posteriors)
+
+        counting_chains, rb_chains = [], []
+        for _ in xrange(5):
+            ploidy_model = PloidyModel(cnv_support, hln_parameters, data=data, first_baseline_i=6)
+            ploidy_model.RunMCMC(300, log_progress=False)
+            counting_chains.append(np.copy(ploidy_model.ReportMCMCData(burn_in=100, autocor_slice=1)))
+            ploidy_model.rao_blackwell = True
+            rb_chains.append(ploidy_model.ReportMCMCData(burn_in=100, autocor_slice=1))
+        self.assertLess(np.sum(np.std(rb_chains, axis=0)), np.sum(np.std(counting_chains, axis=0)))
+
 
 if __name__ == '__main__':
     unittest.main()
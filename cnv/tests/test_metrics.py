@@ -0,0 +1,36 @@
+import json
+import os
+import tempfile
+import unittest
+
+from cnv.utilities.Metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_phase_counters(self):
+        work = {'sweeps': 10}
+        metrics = Metrics('test')
+        with metrics.phase('sampling', lambda: dict(work)) as counters:
+            work['sweeps'] += 100
+            counters['chains'] = 4
+        phase = metrics.phases[0]
+        self.assertEqual(phase['phase'], 'sampling')
+        self.assertEqual(phase['sweeps'], 100)
+        self.assertEqual(phase['chains'], 4)
+        self.assertIn('sweeps_per_second', phase)
+        self.assertNotIn('chains_per_second', phase)
+        self.assertGreaterEqual(phase['cpu_seconds'], 0)
+
+    def test_write(self):
+        metrics = Metrics('test')
+        with metrics.phase('load'):
+            pass
+        metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.json')
+        metrics.write(metrics_file)
+        with open(metrics_file) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['command'], 'test')
+        self.assertEqual([phase['phase'] for phase in summary['phases']], ['load'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import itertools
+import unittest
+import numpy as np
+
+from cnv.MCMC.TargetJointDistribution import TargetJointDistribution
+from cnv.utilities.Profiling import TargetProfile
+
+
+class ProposalTest(unittest.TestCase):
+    """Check that copy number moves leave the exact posterior (enumerated over a small support) invariant."""
+    def setUp(self):
+        np.random.seed(3)
+        self.support = np.array([1e-10, 1, 2, 3])
+        self.mu = np.array([0.2, -0.1, 0.1]).reshape((-1, 1))
+        self.covariance = np.array([[0.1, 0.02, 0.], [0.02, 0.1, 0.01], [0., 0.01, 0.1]])
+        self.intensities = np.array([0.25, -0.05, 0.1, 0.])
+        self.data = np.array([10., 8., 5., 6.])
+        self.joint_target = TargetJointDistribution(self.mu, self.covariance, self.support, self.data)
+
+    def exact_posterior(self, n_sampled_targets):
+        """Posterior over copy numbers of the first n_sampled_targets, given the intensities (others fixed at 2)"""
+        states = list(itertools.product(self.support, repeat=n_sampled_targets))
+        loglikes = np.array([self.joint_target.log_joint_likelihood(
+            self.intensities, np.concatenate((state, 2. * np.ones(len(self.data) - n_sampled_targets))))
+                             for state in states])
+        probs = np.exp(loglikes - np.amax(loglikes))
+        return states, probs / np.sum(probs)
+
+    def test_segment_moves(self):
+        states, probs = self.exact_posterior(3)
+        copies = 2. * np.ones(4)
+        counts = dict((state, 0) for state in states)
+        n_draws = 40000
+        for _ in xrange(n_draws):
+            copies, _ = self.joint_target.sample_segment(copies, self.intensities, 3, 3)
+            counts[tuple(copies[:3])] += 1
+        empirical = np.array([counts[state] for state in states]) / float(n_draws)
+        self.assertLess(np.amax(np.absolute(empirical - probs)), 0.02)
+
+    def test_gibbs_conditional(self):
+        states, probs = self.exact_posterior(1)
+        conditional = self.joint_target.copy_conditional_probs(2. * np.ones(4), self.intensities, 0)
+        np.testing.assert_allclose(conditional, probs)
+
+        active_support = np.array([False, True, True, True])
+        conditional = self.joint_target.copy_conditional_probs(2. * np.ones(4), self.intensities, 0, active_support)
+        self.assertEqual(conditional[0], 0)
+        np.testing.assert_allclose(conditional[1:], probs[1:] / np.sum(probs[1:]))
+
+    def test_biased_copy_proposals(self):
+        states, probs = self.exact_posterior(1)
+        self.joint_target.set_copy_proposal(2., 0.7)
+        copies = 2. * np.ones(4)
+        counts = np.zeros(len(self.support))
+        n_draws = 40000
+        for _ in xrange(n_draws):
+            copies[0], _ = self.joint_target.sample_copy(copies, self.intensities, 0)
+            counts[np.where(self.support == copies[0])[0][0]] += 1
+        self.assertLess(np.amax(np.absolute(counts / n_draws - probs)), 0.02)
+
+    def test_conditional_rows(self):
+        copies = np.array([[2., 1., 3., 2.], [1e-10, 2., 2., 2.]])
+        intensities = np.array([self.intensities, [0.1, 0.3, -0.2, 0.]])
+        rows = self.joint_target.copy_conditional_probs_rows(copies, intensities, 3)
+        self.assertEqual(rows.shape, (2, 3, 4))
+        for row_i in xrange(2):
+            for target_i in xrange(3):
+                np.testing.assert_allclose(rows[row_i, target_i], self.joint_target.copy_conditional_probs(
+                    copies[row_i], intensities[row_i], target_i))
+
+    def test_elliptical_slice_intensities(self):
+        # posterior mean of the intensities given copies, estimated by importance sampling from the prior
+        copies = np.array([2., 1., 2., 2.])
+        prior_draws = np.random.multivariate_normal(self.mu.flatten(), self.covariance, size=200000)
+        padded_draws = np.concatenate((prior_draws, np.zeros((len(prior_draws), 1))), axis=1)
+        log_weights = (np.dot(padded_draws, self.data) -
+                       np.sum(self.data) * np.log(np.dot(np.exp(padded_draws), copies)))
+        weights = np.exp(log_weights - np.amax(log_weights))
+        expected_mean = np.dot(weights, prior_draws) / np.sum(weights)
+
+        intensities = np.copy(self.intensities)
+        n_draws = 20000
+        draws = np.zeros((n_draws, 3))
+        for i in xrange(n_draws):
+            intensities, _ = self.joint_target.sample_intensities_elliptical(copies, intensities)
+            draws[i] = intensities[:-1]
+        self.assertEqual(intensities[-1], 0)
+        np.testing.assert_allclose(np.mean(draws, axis=0), expected_mean, atol=0.02)
+
+    def test_target_profile(self):
+        self.joint_target.target_profile = TargetProfile(['A', 'B', 'C', 'D'])
+        copies = 2. * np.ones(4)
+        accepted = 0
+        for _ in xrange(100):
+            copies[1], self.intensities[1], accept = self.joint_target.sample(copies, self.intensities, 1, False)
+            accepted += accept
+        profile_df = self.joint_target.target_profile.to_frame()
+        self.assertEqual(profile_df.loc['B', 'proposals'], 100)
+        self.assertEqual(profile_df.loc['B', 'accepted'], accepted)
+        self.assertEqual(profile_df.loc['B', 'rejected'], 100 - accepted)
+        self.assertEqual(profile_df.loc['A', 'proposals'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,33 @@
 import os
 import unittest
 
+import numpy as np
+
 from cnv import inputs
+from cnv.hln_parameters import HLN_Parameters
+from cnv.Targets.Target import Target
 
 _data_direc = os.path.join(os.path.dirname(__file__), "data")
 EXAMPLE_BAM_PATH = os.path.join(_data_direc, 'example.bam')
 MATLAB_HLN_PATH = os.path.join(_data_direc, 'hln_test.mat')
 TEST_HLN_PARAMS = os.path.join(_data_direc, 'test_hln_params.pick')
 
+def simulated_parameters(n_targets=6, chrom='X'):
+    """Model parameters for n_targets non-baseline targets on chrom (each about 10% of the baseline sum coverage,
+    with correlated intensities) followed by a BaselineSum target"""
+    targets = [Target(chrom, 1000 * i, 1000 * i + 100, 'Ex{}'.format(i + 1)) for i in xrange(n_targets)]
+    targets.append(Target('1-22', None, None, 'BaselineSum'))
+    mu = np.log(0.1) + np.linspace(-0.2, 0.2, n_targets)
+    covariance = 0.005 * np.eye(n_targets) + 0.002
+    return HLN_Parameters(targets, mu, covariance)
+
+def simulated_coverage(hln_parameters, copies, n_reads=40000):
+    """Coverage counts of a subject with the given copy numbers (including the baseline sum), with intensities drawn
+    from the model's prior"""
+    intensities = np.concatenate((np.random.multivariate_normal(hln_parameters.mu, hln_parameters.covariance), [0]))
+    p_vector = copies * np.exp(intensities)
+    return np.random.multinomial(n_reads, p_vector / np.sum(p_vector)).astype(float)
+
 class ResourceTest(unittest.TestCase):
 
     def test_tso_bed_exists(self):
@@ -0,0 +1,106 @@
+""" Vectorized quality control of a coverage matrix: missing and zero coverage targets, correlation with the cohort's
+mean target intensities and target-to-baseline-sum ratio z-scores of every sample, with outlier flags """
+
+import numpy as np
+import pandas as pd
+
+# thresholds beyond which evaluate-sample warns results are likely to be inaccurate
+MIN_CORRELATION = 0.9
+MAX_ABS_ZSCORE = 1.5
+
+QC_COLUMNS = ['missing_targets', 'zero_targets', 'total_coverage', 'correlation', 'target_base_ratio',
+              'target_base_zscore', 'low_correlation', 'target_base_outlier', 'flagged']
+
+
+def _coverage(chunk, target_columns):
+    """Coverage of the target columns of a chunk of the matrix, with NaN for missing columns or values"""
+    return chunk.reindex(columns=target_columns).values.astype(float)
+
+
+def _intensities(coverage):
+    """Proportion of each sample's coverage (row) in each target, treating missing values as 0"""
+    coverage = np.nan_to_num(coverage)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return coverage / np.sum(coverage, axis=1).reshape((-1, 1))
+
+
+def _target_base_ratios(coverage):
+    """Ratio of each sample's non-baseline target coverage to its BaselineSum coverage (the last column)"""
+    coverage = np.nan_to_num(coverage)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(coverage[:, :-1], axis=1) / coverage[:, -1]
+
+
+def row_correlations(rows, vector):
+    """Pearson correlation of each row of a 2D array with a vector"""
+    centered_rows = rows - np.mean(rows, axis=1).reshape((-1, 1))
+    centered_vector = vector - np.mean(vector)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.dot(centered_rows, centered_vector) /
+                (np.linalg.norm(centered_rows, axis=1) * np.linalg.norm(centered_vector)))
+
+
+def matrix_qc(read_chunks, target_columns, min_correlation=MIN_CORRELATION, max_abs_zscore=MAX_ABS_ZSCORE):
+    """Quality control of every sample of a coverage matrix, in two vectorized passes over its chunks (the first
+    computing cohort statistics). If the last target column is BaselineSum, target-to-baseline-sum ratios are z-scored
+    against the cohort's, and BaselineSum is left out of intensities (as in evaluate-sample).
+
+    read_chunks -- callable returning an iterable over data frames of the matrix (e.g. [coverage_df], or pd.read_csv
+                   with a chunksize), called twice
+    target_columns -- labels of the target columns
+
+    Returns a data frame indexed by sample (the sample column, or the matrix index if there isn't one) with the
+    QC_COLUMNS (ratio columns are NaN without BaselineSum), where a sample is flagged if it has missing targets, its
+    correlation is below min_correlation or the absolute value of its z-score is above max_abs_zscore, and a dict of
+    cohort statistics: the number of samples, the target columns missing from the matrix, the cohort mean intensities,
+    and the mean and standard deviation of target-to-baseline-sum ratios (None without BaselineSum).
+    """
+    baseline_sum = target_columns[-1] == 'BaselineSum'
+    n_intensities = len(target_columns) - 1 if baseline_sum else len(target_columns)
+
+    n_samples = 0
+    intensity_sum = np.zeros(n_intensities)
+    ratios = []
+    missing_columns = []
+    for chunk in read_chunks():
+        missing_columns = [column for column in target_columns if column not in chunk.columns]
+        coverage = _coverage(chunk, target_columns)
+        intensity_sum += np.nansum(_intensities(coverage[:, :n_intensities]), axis=0)
+        if baseline_sum:
+            ratios.append(_target_base_ratios(coverage))
+        n_samples += len(coverage)
+    cohort = {'samples': n_samples,
+              'missing_columns': missing_columns,
+              'mean_intensities': intensity_sum / max(n_samples, 1),
+              'target_base_mean': None,
+              'target_base_sd': None}
+    if baseline_sum:
+        ratios = np.concatenate(ratios)
+        cohort['target_base_mean'] = np.mean(ratios)
+        cohort['target_base_sd'] = np.std(ratios)
+
+    frames = []
+    for chunk in read_chunks():
+        coverage = _coverage(chunk, target_columns)
+        missing = np.isnan(coverage)
+        frame = pd.DataFrame(index=pd.Index(chunk['sample'] if 'sample' in chunk.columns else chunk.index,
+                                            name='sample'), columns=QC_COLUMNS)
+        frame['missing_targets'] = np.sum(missing, axis=1)
+        frame['zero_targets'] = np.sum(coverage == 0, axis=1)
+        frame['total_coverage'] = np.nansum(coverage, axis=1)
+        frame['correlation'] = row_correlations(_intensities(coverage[:, :n_intensities]),
+                                                cohort['mean_intensities'])
+        if baseline_sum:
+            frame['target_base_ratio'] = _target_base_ratios(coverage)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frame['target_base_zscore'] = ((frame['target_base_ratio'] - cohort['target_base_mean']) /
+                                               cohort['target_base_sd'])
+        else:
+            frame['target_base_ratio'] = np.nan
+            frame['target_base_zscore'] = np.nan
+        frame['low_correlation'] = ~(frame['correlation'] >= min_correlation)
+        frame['target_base_outlier'] = np.absolute(frame['target_base_zscore']) > max_abs_zscore
+        frame['flagged'] = (frame['missing_targets'] > 0) | frame['low_correlation'] | frame['target_base_outlier']
+        frames.append(frame)
+
+    return pd.concat(frames) if frames else pd.DataFrame(columns=QC_COLUMNS), cohort
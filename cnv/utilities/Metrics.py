@@ -0,0 +1,104 @@
+""" Timing and resource usage metrics for each phase of a command, written as JSON """
+
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager
+
+from cnv import __version__
+
+
+def _cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _io_bytes():
+    """Returns bytes read and written by this process (from /proc/self/io), or None where unavailable"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+class Metrics(object):
+    """Records wall and CPU time, peak resident memory and bytes read/written for each phase of a command, along with
+    any counters (e.g. reads or iterations) added by the caller, and derived throughputs.
+
+    Usage:
+        metrics = Metrics('evaluate-sample')
+        with metrics.phase('sampling', ploidy_model.WorkCounters) as counters:
+            ...
+            counters['chains'] = num_chains
+        metrics.write(metrics_file)
+    """
+    # counters that are also reported per second of wall time
+    rate_counters = ('reads', 'sweeps', 'target_updates', 'samples', 'em_iterations')
+
+    def __init__(self, command):
+        self.command = command
+        self.phases = []
+        self.start_wall = time.time()
+        self.start_cpu = _cpu_seconds()
+
+    @contextmanager
+    def phase(self, name, counter_source=None):
+        """Context manager timing a phase, yielding a dict to which counters for the phase can be added.
+
+        counter_source -- optional callable returning a dict of cumulative counters (e.g. reads scanned so far), whose
+                          increase over the phase is added to the phase counters
+        """
+        counters = {}
+        start_counts = counter_source() if counter_source is not None else {}
+        start_wall = time.time()
+        start_cpu = _cpu_seconds()
+        start_child_cpu = _cpu_seconds(resource.RUSAGE_CHILDREN)
+        start_io = _io_bytes()
+        try:
+            yield counters
+        finally:
+            wall_seconds = time.time() - start_wall
+            if counter_source is not None:
+                for counter, value in counter_source().iteritems():
+                    counters[counter] = value - start_counts.get(counter, 0)
+            phase_metrics = {'phase': name,
+                             'wall_seconds': wall_seconds,
+                             'cpu_seconds': _cpu_seconds() - start_cpu,
+                             # CPU time of finished child processes (e.g. multiprocessing pools)
+                             'child_cpu_seconds': _cpu_seconds(resource.RUSAGE_CHILDREN) - start_child_cpu,
+                             'peak_rss_mb': _peak_rss_mb()}
+            end_io = _io_bytes()
+            if start_io is not None and end_io is not None:
+                phase_metrics['read_bytes'] = end_io[0] - start_io[0]
+                phase_metrics['write_bytes'] = end_io[1] - start_io[1]
+            for counter, value in counters.iteritems():
+                phase_metrics[counter] = value
+                if counter in self.rate_counters and wall_seconds > 0:
+                    phase_metrics['{}_per_second'.format(counter)] = value / wall_seconds
+            self.phases.append(phase_metrics)
+            logging.debug('Phase {} took {:.3f} seconds'.format(name, wall_seconds))
+
+    def summary(self):
+        """Returns the metrics for the command and all of its phases as a dict"""
+        return {'command': self.command,
+                'version': __version__,
+                'wall_seconds': time.time() - self.start_wall,
+                'cpu_seconds': _cpu_seconds() - self.start_cpu,
+                'peak_rss_mb': _peak_rss_mb(),
+                'phases': self.phases}
+
+    def write(self, metrics_file):
+        """Write the metrics summary as JSON to metrics_file (nothing is written if metrics_file is None)"""
+        if metrics_file is None:
+            return
+        with open(metrics_file, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        logging.info('Wrote metrics to {}'.format(metrics_file))
@@ -0,0 +1,87 @@
+""" Hot path profiling of a command: a pstats dump of function costs, and a table of costs attributed to each target """
+
+import cProfile
+import logging
+from collections import Counter, OrderedDict
+
+import pandas as pd
+
+
+class TargetProfile(object):
+    """Accumulates cost counters (e.g. seconds, reads or proposals) for each target of a collection, which hot paths
+    add to by target index when a profile is attached to them (they check for None, so costs are only measured while
+    profiling)."""
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.counters = [Counter() for _ in self.labels]
+
+    def add(self, target_i, **counters):
+        """Add the given counter values to the counters of the target with index target_i"""
+        self.counters[target_i].update(counters)
+
+    def to_frame(self):
+        """Returns the counters as a data frame with a row per target (indexed by label) and a column per counter"""
+        frame = pd.DataFrame(self.counters, index=pd.Index(self.labels, name='target')).fillna(0)
+        count_columns = [column for column in frame.columns if not column.endswith('seconds')]
+        frame[count_columns] = frame[count_columns].astype(int)
+        return frame
+
+
+class Profile(object):
+    """Profiles a command with cProfile while it is entered, along with any target profiles created with
+    target_profile, and writes a pstats dump ({prefix}_profile.pstats, e.g. for python -m pstats or snakeviz) and a
+    tab separated table of per-target costs ({prefix}_profile.tsv) sorted by the largest time column.
+
+    Usage:
+        profile = Profile()
+        matrix_instance.target_profile = profile.target_profile('coverage', target_labels)
+        with profile:
+            ...
+        profile.write(output_prefix)
+    """
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.target_profiles = OrderedDict()
+
+    def target_profile(self, name, labels):
+        """Returns a new TargetProfile for the targets with the given labels, whose counters are written with the
+        name as a prefix of their columns"""
+        self.target_profiles[name] = TargetProfile(labels)
+        return self.target_profiles[name]
+
+    def enable(self):
+        """Start (or resume) collecting function profile data"""
+        self.profiler.enable()
+
+    def disable(self):
+        """Stop collecting function profile data"""
+        self.profiler.disable()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disable()
+
+    def target_table(self):
+        """Returns the counters of all target profiles in a single data frame (outer joined on target labels),
+        sorted by the largest time (seconds) column"""
+        frames = []
+        for name, target_profile in self.target_profiles.iteritems():
+            frame = target_profile.to_frame()
+            frame.columns = ['{}_{}'.format(name, column) for column in frame.columns]
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame()
+        table = frames[0].join(frames[1:], how='outer') if len(frames) > 1 else frames[0]
+        time_columns = [column for column in table.columns if column.endswith('seconds')]
+        if time_columns:
+            table = table.sort_values(max(time_columns, key=lambda column: table[column].sum()), ascending=False)
+        return table
+
+    def write(self, prefix):
+        """Write the pstats dump and per-target table to {prefix}_profile.pstats and {prefix}_profile.tsv"""
+        self.profiler.dump_stats('{}_profile.pstats'.format(prefix))
+        self.target_table().to_csv('{}_profile.tsv'.format(prefix), sep='\t')
+        logging.info('Wrote profile to {0}_profile.pstats and {0}_profile.tsv'.format(prefix))
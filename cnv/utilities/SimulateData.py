@@ -10,17 +10,17 @@ from numpy.random import poisson
 from cnv.Targets.TargetCollection import TargetCollection
 
 
-def _validate_file_names(outputPrefix):
+def _validate_file_names(outputPrefix, numBams=10):
     fofn = _make_fofn_name(outputPrefix)
-    bams = _make_bam_names(outputPrefix)
+    bams = _make_bam_names(outputPrefix, numBams)
     bams.append(fofn)
     for f in bams:
         if os.path.exists(f):
             raise IOError("File named " + f + " was going to be created but already exists.")
 
 
-def _output_fofn(output_prefix):
-    bam_names = _make_bam_names(output_prefix)
+def _output_fofn(output_prefix, numBams=10):
+    bam_names = _make_bam_names(output_prefix, numBams)
     with open(_make_fofn_name(output_prefix), 'w') as f:
         f.write("\n".join(bam_names))
 
@@ -71,10 +71,10 @@ def _write_fake_bam_file(bam_name, header, targets, intensities):
                 rname += 1
     pysam.index(bam_name)
 
-def make_simulated_data(output_prefix, target_file):
-    _validate_file_names(output_prefix)
+def make_simulated_data(output_prefix, target_file, num_bams=10):
+    _validate_file_names(output_prefix, num_bams)
 
-    _output_fofn(output_prefix)
+    _output_fofn(output_prefix, num_bams)
 
     targets = TargetCollection.load_from_txt_file(target_file)
     header = targets.make_fake_sam_header()
@@ -83,7 +83,7 @@ def make_simulated_data(output_prefix, target_file):
     intensities = abs(normal(size=len(targets)))
     intensities = intensities / sum(intensities)
     # Write a bunch of bam files
-    for bam in _make_bam_names(output_prefix):
+    for bam in _make_bam_names(output_prefix, num_bams):
         _write_fake_bam_file(bam, header, targets, intensities)
 
 